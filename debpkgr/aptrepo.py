@@ -26,42 +26,88 @@ pip install python-debian chardet
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import functools
+import io
 import logging
 import os
 import shutil
+import stat
 import time
-import gzip
-import bz2
 import tempfile
 import re
 
+from concurrent import futures
 from six import string_types
 from debian import deb822
 
 from . import compressr
 from . import debpkg
+from . import paragraph
+from . import pdiff
+from . import spool
 from . import utils
 from . import signer
+from .errors import VerificationError
 from .hasher import hash_file
 
 REPO_VERSION = '1.0'
 
+# Pool layouts: everything in pool/<component>/, Debian-style
+# pool/<component>/<prefix>/<source>/, or one directory per SHA256 shared
+# by all components and dists
+POOL_LAYOUT_FLAT = 'flat'
+POOL_LAYOUT_SHARDED = 'sharded'
+POOL_LAYOUT_CONTENT = 'content'
+POOL_LAYOUTS = (POOL_LAYOUT_FLAT, POOL_LAYOUT_SHARDED, POOL_LAYOUT_CONTENT)
+
 log = logging.getLogger(__name__)
 
 
 class AptRepoMeta(object):
-    __slots__ = ['release', '_component_arch_binaries', 'upstream_url']
+    __slots__ = ['release', '_component_arch_binaries', 'upstream_url',
+                 'compressions', 'pdiffs', 'by_hash', 'by_hash_retention',
+                 'spill', 'sort_packages']
     """
     Object for storing Apt Repo MetaData
     """
     _Compression_Types = ['xz', 'bz2', 'gz']
+    # Compressed Packages variants written next to the plain file, as
+    # (extension, level) pairs
+    _Default_Compressions = (('gz', 9), ('bz2', 9))
     _Hash_Algorithms = dict(sha1=("sha1", "SHA1"),
                             md5=("md5sum", "MD5sum"),
                             sha256=("sha256", "SHA256"))
+    _Write_Block_Size = 1 << 20
+    _Levels_Dir = os.path.join('.debpkgr', 'levels')
 
     def __init__(self, release=None, origin=None, label=None, version=None,
                  description=None, codename=None, components=None,
-                 architectures=None, upstream_url=None):
+                 architectures=None, upstream_url=None, compressions=None,
+                 pdiffs=0, by_hash=False, by_hash_retention=3, spill=False,
+                 sort_packages=True):
+        """
+        compressions: compressed variants of the Packages files to write,
+        as a mapping (or sequence of pairs) of extension ('xz', 'gz' or
+        'bz2') to compression level; a level of None selects the codec's
+        default. The uncompressed Packages file is always written.
+
+        pdiffs: number of PDiff patches (Packages.diff/) to keep for apt
+        clients to update their indices incrementally; 0 disables them
+
+        by_hash: if True, every index is also published as
+        by-hash/SHA256/<digest> next to it, and Release advertises
+        Acquire-By-Hash, so clients never fetch an index that does not
+        match the Release they have. The objects of the previous
+        by_hash_retention publishes are kept for clients that are slow to
+        catch up.
+
+        spill: if True, added packages are kept on disk rather than in
+        memory until the indices are written (see ComponentArchBinary)
+
+        sort_packages: if True, added packages are indexed by name, version
+        and architecture rather than in the order they were added, so the
+        same set of packages always produces the same indices
+        """
         if release is None:
             release = deb822.Release()
         else:
@@ -83,6 +129,22 @@ class AptRepoMeta(object):
         self.set_date()
         self._component_arch_binaries = []
         self.upstream_url = upstream_url
+        if compressions is None:
+            compressions = self._Default_Compressions
+        elif hasattr(compressions, 'items'):
+            compressions = compressions.items()
+        compressions = tuple(compressions)
+        for ext, _ in compressions:
+            if ext not in self._Compression_Types:
+                raise ValueError(
+                    "Compression %s not supported (expected: %s)" % (
+                        ext, ', '.join(self._Compression_Types)))
+        self.compressions = compressions
+        self.pdiffs = pdiffs
+        self.by_hash = by_hash
+        self.by_hash_retention = by_hash_retention
+        self.spill = spill
+        self.sort_packages = sort_packages
 
     def set_date(self):
         self.release.setdefault(
@@ -156,7 +218,8 @@ class AptRepoMeta(object):
             meta.setdefault('label', self.release['Label'])
             meta.setdefault('description', self.release['Description'])
         obj = ComponentArchBinary(release=release, meta=meta,
-                                  dist=self.release['Codename'])
+                                  dist=self.release['Codename'],
+                                  spill=self.spill, sort=self.sort_packages)
         if obj.component not in self.components:
             raise ValueError("Component %s not supported (expected: %s)" % (
                 obj.component, ', '.join(self.components)))
@@ -174,15 +237,188 @@ class AptRepoMeta(object):
         return os.path.join(
             self.release_dir(base_path), 'Release')
 
-    def create(self, base_path):
+    def create(self, base_path, incremental=False, workers=None):
+        """
+        If incremental is True, the Packages files of component/arch
+        indices that did not change since they were last written (see
+        ComponentArchBinary.dirty) are kept, and their checksums are taken
+        from the current Release.
+
+        If workers is greater than 1, that many indices are written
+        concurrently. The Release file is the same either way.
+
+        Indices whose contents match what Release already lists are not
+        rewritten; if nothing changed at all, neither is Release. Returns
+        True if Release was written (and needs signing).
+        """
+        objs = list(self.iter_component_arch_binaries())
+        published = self._published_release(base_path)
+        writer = functools.partial(self._write_index, base_path,
+                                   incremental=incremental,
+                                   published=published)
+        if workers is not None and workers > 1:
+            with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                # map() returns results in order, so the checksums are
+                # merged exactly as in the serial case
+                results = list(executor.map(writer, objs))
+        else:
+            results = [writer(obj) for obj in objs]
         all_checksums = dict()
-        for obj in self.iter_component_arch_binaries():
-            checksums = obj.write_packages(
-                base_path, self.release_dir(base_path))
+        changed = False
+        for checksums, written in results:
+            changed = changed or written
             for k, vlist in checksums.items():
                 all_checksums.setdefault(k, []).extend(vlist)
+        if self.by_hash:
+            self.release['Acquire-By-Hash'] = 'yes'
+            self.link_by_hash(base_path, all_checksums)
+        else:
+            self.release.pop('Acquire-By-Hash', None)
         self.release.update(all_checksums)
+        if not changed and self._release_unchanged(published):
+            log.debug("Nothing changed in %s", self.release_dir(base_path))
+            return False
+        # Last: clients switch to the new indices all at once
         self.write_release(base_path)
+        return True
+
+    def _published_release(self, base_path):
+        """Return the Release currently on disk, or None"""
+        try:
+            with open(self.release_path(base_path), 'rb') as fh:
+                return deb822.Release(fh)
+        except (IOError, OSError):
+            return None
+
+    def _release_unchanged(self, published):
+        # Compare everything but the Date
+        if published is None:
+            return False
+        current = [x for x in published.dump().splitlines()
+                   if not x.startswith('Date:')]
+        new = [x for x in self.release.dump().splitlines()
+               if not x.startswith('Date:')]
+        return current == new
+
+    def link_by_hash(self, base_path, checksums):
+        """
+        Link the files listed in checksums as by-hash/SHA256/<digest> in
+        their directories, and expire old by-hash objects
+        """
+        release_dir = self.release_dir(base_path)
+        current = dict()
+        for entry in checksums.get('SHA256', []):
+            path = os.path.join(release_dir, entry['name'])
+            by_hash_dir = utils.makedirs(os.path.join(
+                os.path.dirname(path), 'by-hash', 'SHA256'))
+            dst = os.path.join(by_hash_dir, entry['sha256'])
+            if not os.path.exists(dst):
+                utils.place_file(path, dst, strategy=utils.PLACEMENT_AUTO)
+            current.setdefault(by_hash_dir, set()).add(entry['sha256'])
+        for by_hash_dir, digests in sorted(current.items()):
+            self._expire_by_hash(by_hash_dir, digests)
+
+    def _expire_by_hash(self, by_hash_dir, digests):
+        # Objects written together share their mtime; keeping as many of
+        # the newest old objects as by_hash_retention publishes produced
+        # keeps those publishes complete
+        old = []
+        for fname in os.listdir(by_hash_dir):
+            if fname in digests:
+                continue
+            path = os.path.join(by_hash_dir, fname)
+            old.append((os.stat(path).st_mtime, fname, path))
+        old.sort(reverse=True)
+        for _, _, path in old[self.by_hash_retention * len(digests):]:
+            log.debug("Expiring %s", path)
+            os.unlink(path)
+
+    def _write_index(self, base_path, obj, incremental=False,
+                     published=None):
+        """
+        Return the checksums of the index of obj, and whether it had to
+        be written
+        """
+        checksums = None
+        if incremental and not obj.dirty:
+            checksums = self._reusable_checksums(base_path, obj)
+        if checksums is not None:
+            log.debug("Reusing Packages for %s/%s", obj.component,
+                      obj.architecture)
+            obj.dirty = False
+            return checksums, False
+        current = None
+        if published is not None:
+            current = self._reusable_checksums(base_path, obj, published)
+        checksums = obj.write_packages(
+            base_path, self.release_dir(base_path),
+            compressions=self.compressions, pdiffs=self.pdiffs,
+            published=current)
+        obj.dirty = False
+        if checksums is current:
+            log.debug("Packages for %s/%s did not change", obj.component,
+                      obj.architecture)
+            return checksums, False
+        return checksums, True
+
+    def _reusable_checksums(self, base_path, obj, release=None):
+        """
+        Return the Release checksums of the Packages files of obj, or None
+        if the Release does not describe exactly the files that would be
+        written, if they are missing or have a different size, or if they
+        were compressed with other levels.
+        release defaults to the Release being built.
+        """
+        if release is None:
+            release = self.release
+        pkgs_relative_path = obj.packages_relative_path
+        release_dir = self.release_dir(base_path)
+        levels_path = self._levels_path(
+            base_path, os.path.join(release_dir, pkgs_relative_path))
+        try:
+            with open(levels_path, 'rb') as fh:
+                levels = fh.read()
+        except (IOError, OSError):
+            return None
+        if levels != self._format_levels(self.compressions):
+            return None
+        names = [pkgs_relative_path] + [
+            pkgs_relative_path + '.' + ext for ext, _ in self.compressions]
+        if self.pdiffs:
+            names.append(os.path.join(
+                pkgs_relative_path + pdiff.DIFF_DIR_SUFFIX, pdiff.INDEX))
+        for name in names:
+            try:
+                os.stat(os.path.join(release_dir, name))
+            except OSError:
+                return None
+        checksums = dict()
+        for key_name, outer_name in self._Hash_Algorithms.values():
+            entries = dict((x['name'], x)
+                           for x in release.get(outer_name, [])
+                           if x['name'] in names)
+            if len(entries) != len(names):
+                return None
+            for name, entry in entries.items():
+                size = os.stat(os.path.join(release_dir, name)).st_size
+                if str(size) != str(entry['size']):
+                    return None
+            checksums[outer_name] = [entries[x] for x in names]
+        return checksums
+
+    @classmethod
+    def _levels_path(cls, base_path, pkg_file):
+        # Records the compression levels the Packages variants were
+        # written with, as neither their names nor Release tell. Kept
+        # with the ingest cache, out of the published tree.
+        return os.path.join(base_path, cls._Levels_Dir,
+                            os.path.relpath(pkg_file, base_path))
+
+    @classmethod
+    def _format_levels(cls, compressions):
+        return ''.join(
+            '%s %s\n' % (ext, 'default' if level is None else level)
+            for ext, level in compressions).encode('ascii')
 
     def write_release(self, base_path):
         self.release.pop('Date', None)
@@ -190,69 +426,157 @@ class AptRepoMeta(object):
 
         path = self.release_path(base_path)
         utils.makedirs(os.path.dirname(path))
-        self.release.dump(open(path, "wb"))
+        # Readers see either the old or the new Release, never a mix
+        with utils.AtomicFile(path) as fh:
+            self.release.dump(fh)
 
     def dists_dir(self):
         return os.path.join(self.base_path, 'dists',
                             self.metadata.release['Codename'])
 
+    @classmethod
+    def RenderPackages(cls, packages):
+        """
+        Yield the contents of the Packages file listing packages, in
+        blocks of about _Write_Block_Size bytes
+        """
+        buf = io.BytesIO()
+        first = True
+        for pkg in packages:
+            if first:
+                first = False
+            else:
+                buf.write(b"\n")
+            pkg.dump(buf)
+            if buf.tell() >= cls._Write_Block_Size:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue()
+
     @classmethod
     def WritePackages(cls, base_path, release_dir,
-                      relative_path_fname, packages):
+                      relative_path_fname, packages, compressions=None,
+                      pdiffs=0, published=None):
         """
         packages: iterator of objects with a dump() method (debpkg.DebPkg or
         deb822.Packages)
+        compressions: (extension, level) pairs, see AptRepoMeta
+        pdiffs: number of PDiff patches to keep, see AptRepoMeta
+        published: the Release checksums of the Packages files on disk, if
+        they can be reused (see AptRepoMeta._reusable_checksums). If the
+        new Packages file is identical, the files on disk are kept, and
+        published is returned as the checksums.
         """
-        short_names = [relative_path_fname,
-                       relative_path_fname + '.gz',
-                       relative_path_fname + '.bz2',
-                       ]
+        if compressions is None:
+            compressions = cls._Default_Compressions
+        compressions = list(compressions)
+        short_names = [relative_path_fname] + [
+            relative_path_fname + '.' + ext for ext, _ in compressions]
         pkg_files = [os.path.join(release_dir, x) for x in short_names]
-        utils.makedirs(os.path.dirname(pkg_files[0]))
+        dirname, basename = os.path.split(pkg_files[0])
+        utils.makedirs(dirname)
 
-        pkg_plain, pkg_gz, pkg_bz2 = pkg_files
+        # Everything is written next to the current files first, so the
+        # stanzas are rendered only once even if nothing changed
+        tmp_dir = tempfile.mkdtemp(dir=dirname, prefix='.' + basename + '.')
         try:
-            # This will make sure the iterator will continue to work if one
-            # exists, because it will point to a deleted file
-            try:
-                os.unlink(pkg_plain)
-            except OSError as e:
-                if e.errno != 2:
-                    raise
-            shutil.rmtree(pkg_plain, ignore_errors=True)
-            with open(pkg_plain, 'wb') as pfh:
-                first = True
-                for pkg in packages:
-                    if first:
-                        first = False
-                    else:
-                        pfh.write(b"\n")
-                    pkg.dump(pfh)
-        except IOError:
-            raise
-        try:
-            with open(pkg_plain, 'rb') as fhi:
-                with gzip.open(pkg_gz, 'wb') as fhout:
-                    shutil.copyfileobj(fhi, fhout)
-                fhi.seek(0)
-                with bz2.BZ2File(pkg_bz2, 'wb', compresslevel=9) as fhout:
-                    shutil.copyfileobj(fhi, fhout)
-        except IOError:
-            raise
+            new_files = [os.path.join(tmp_dir, os.path.basename(x))
+                         for x in pkg_files]
+            extensions = [ext for ext, _ in compressions]
+            if published is None:
+                # Every output is compressed, hashed and sized from the
+                # same blocks, so nothing is read back from disk
+                hashers = cls._write_variants(
+                    new_files[0], [None] + extensions, compressions,
+                    cls.RenderPackages(packages))
+            else:
+                # Only compress if the plain file turns out to be new
+                hashers = cls._write_variants(
+                    new_files[0], [None], compressions,
+                    cls.RenderPackages(packages))
+                plain = hashers[new_files[0]]
+                entry = published['SHA256'][0]
+                if (entry['sha256'], str(entry['size'])) == (
+                        plain.digests['sha256'], str(plain.size)):
+                    return [x['name'] for x in published['SHA256']], published
+                # Reading the plain file back is much cheaper than
+                # rendering the stanzas again
+                with open(new_files[0], 'rb') as fh:
+                    hashers.update(cls._write_variants(
+                        new_files[0], extensions, compressions,
+                        iter(lambda: fh.read(cls._Write_Block_Size), b'')))
+
+            index_path = None
+            if pdiffs:
+                # Diffed from disk, while the old file is still in place
+                old_path = pkg_files[0]
+                if not os.path.isfile(old_path):
+                    old_path = None
+                index_path = pdiff.update(pkg_files[0], old_path,
+                                          new_files[0], pdiffs)
+
+            # Variants that are no longer generated go away. Readers of the
+            # replaced files keep reading the old contents.
+            stale = set(pkg_files[0] + '.' + ext
+                        for ext in cls._Compression_Types)
+            for pkg_file in stale.difference(pkg_files):
+                try:
+                    os.unlink(pkg_file)
+                except OSError as e:
+                    if e.errno != 2:
+                        raise
+            shutil.rmtree(pkg_files[0], ignore_errors=True)
+            for src, dst in zip(new_files, pkg_files):
+                os.rename(src, dst)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        levels_path = cls._levels_path(base_path, pkg_files[0])
+        utils.makedirs(os.path.dirname(levels_path))
+        with utils.AtomicFile(levels_path) as fh:
+            fh.write(cls._format_levels(compressions))
 
-        HA = cls._Hash_Algorithms
         checksums = dict()
-        for relative_fname in short_names:
-            src = os.path.join(release_dir, relative_fname)
-            hashes = hash_file(src, algs=HA)
-            size = str(os.stat(src).st_size)
-            common = dict(name=relative_fname, size=size)
-            for alg_name, (key_name, outer_name) in HA.items():
-                info = dict(common)
-                info[key_name] = hashes[alg_name]
-                checksums.setdefault(outer_name, []).append(info)
+        for relative_fname, src in zip(short_names, new_files):
+            hasher = hashers[src]
+            cls._add_checksums(checksums, relative_fname, hasher.digests,
+                               hasher.size)
+
+        if index_path is not None:
+            relative_fname = os.path.relpath(index_path, release_dir)
+            short_names.append(relative_fname)
+            cls._add_checksums(checksums, relative_fname,
+                               hash_file(index_path,
+                                         algs=cls._Hash_Algorithms),
+                               os.stat(index_path).st_size)
         return short_names, checksums
 
+    @classmethod
+    def _write_variants(cls, fpath, extensions, compressions, blocks):
+        """
+        Write blocks to fpath, compressed with each of extensions (None
+        for the uncompressed file). Returns the hashers of the files, as
+        compressr.MultiWriter does.
+        """
+        writer = compressr.MultiWriter(
+            fpath, extensions, algorithms=list(cls._Hash_Algorithms),
+            threads=True, levels=dict(compressions))
+        try:
+            for block in blocks:
+                writer.write(block)
+        finally:
+            writer.close()
+        return writer.hashers
+
+    @classmethod
+    def _add_checksums(cls, checksums, relative_fname, hashes, size):
+        common = dict(name=relative_fname, size=str(size))
+        for alg_name, (key_name, outer_name) in cls._Hash_Algorithms.items():
+            info = dict(common)
+            info[key_name] = hashes[alg_name]
+            checksums.setdefault(outer_name, []).append(info)
+
     def create_Packages_download_requests(self, base_path):
         """
         Iterate over the release file and create a list of download request
@@ -281,30 +605,40 @@ class AptRepoMeta(object):
 
         return dl_reqs
 
-    def validate_component_arch_packages_downloads(self, dl_reqs):
+    def _verify_download(self, dl):
+        for alg_name, (key_name, _) in self._Hash_Algorithms.items():
+            if key_name in dl.data:
+                break
+        digests = hash_file(dl.destination, [alg_name])
+        if digests[alg_name] != dl.data[key_name]:
+            raise VerificationError("Checksum did not match")
+
+    def validate_component_arch_packages_downloads(self, dl_reqs,
+                                                   keep_compressed=False):
         """
         Validate the specified download requests, and, if successful,
         initialize the Packages object of the corresporning component_arch
 
         dl_reqs is a list of utils.DownloadRequest objects
+
+        If keep_compressed is True, compressed Packages files are read
+        through a decompressing stream instead of being uncompressed to
+        disk.
         """
         cmprsr = compressr.Opener()
         # Validate downloads
         for dl in dl_reqs:
-            algorithms = []
-            for alg_name, (key_name, _) in self._Hash_Algorithms.items():
-                if key_name in dl.data:
-                    algorithms.append(alg_name)
-                    break
-
-            digests = hash_file(dl.destination, algorithms)
-            if digests[alg_name] != dl.data[key_name]:
-                raise Exception("Checksum did not match")
+            if not dl.data.get('verified'):
+                # Not checked while downloading
+                self._verify_download(dl)
 
             component = dl.data['component']
             arch = dl.data['architecture']
             caobj = self.get_component_arch_binary(component, arch)
             ext = os.path.splitext(dl.destination)[1].lstrip('.')
+            if ext in self._Compression_Types and keep_compressed:
+                caobj.packages_file = cmprsr.open(dl.destination, "rb")
+                continue
             if ext in self._Compression_Types:
                 dest = dl.destination[:-len(ext) - 1]
                 shutil.copyfileobj(cmprsr.open(dl.destination, "rb"),
@@ -317,9 +651,32 @@ class AptRepoMeta(object):
 
 
 class ComponentArchBinary(object):
-    __slots__ = ['release', '_packages', '_packages_file', 'dist']
+    """
+    The packages of one component and architecture.
+
+    dirty is True until the Packages files were written (or loaded from
+    disk), and becomes True again whenever a package is added.
 
-    def __init__(self, release=None, packages=None, meta=None, dist=None):
+    If spill is True, only the rendered stanzas of added packages are
+    kept, in a spool.StanzaSpool on disk, so memory use does not grow with
+    the number of packages; iter_packages() then yields
+    spool.SpooledStanza objects instead of DebPkg objects. Once the index
+    is written, the spool is removed and packages are read from the
+    Packages file; adding more packages spools its stanzas again.
+
+    If sort is True, added packages are written to the index in
+    debpkg.PackageSortKey order; packages loaded from an existing index
+    keep their order.
+
+    Packages in a Packages file can be found with lookup() without
+    reading the whole file; the offsets of all packages are indexed on
+    the first lookup.
+    """
+    __slots__ = ['release', '_packages', '_packages_file', 'dist', 'dirty',
+                 'spill', '_spool', 'sort', '_index', '_spooled_file']
+
+    def __init__(self, release=None, packages=None, meta=None, dist=None,
+                 spill=False, sort=False):
         if release is None:
             release = deb822.Release()
         if meta is None:
@@ -330,6 +687,13 @@ class ComponentArchBinary(object):
         self._packages = packages
         self._packages_file = None
         self.dist = dist
+        self.dirty = True
+        self.spill = spill
+        self._spool = None
+        self.sort = sort
+        self._index = None
+        # True if _packages_file was written from the spool
+        self._spooled_file = False
 
     @property
     def component(self):
@@ -340,10 +704,25 @@ class ComponentArchBinary(object):
         return self.release['Architecture']
 
     def add_package(self, pkg):
-        if self._packages is None:
-            self._packages = []
-            self._packages_file = None
-        self._packages.append(pkg)
+        if self.spill:
+            if self._spool is None:
+                new_spool = spool.StanzaSpool()
+                if self._spooled_file:
+                    # Still part of this index
+                    for para in self.iter_packages(fast=True):
+                        key = _sort_key(para) if self.sort else None
+                        new_spool.add(para.raw, key=key)
+                    self._packages_file.close()
+                self._spool = new_spool
+                self._set_packages_file(None)
+            key = _sort_key(pkg) if self.sort else None
+            self._spool.add(pkg.stanza, key=key)
+        else:
+            if self._packages is None:
+                self._packages = []
+                self._set_packages_file(None)
+            self._packages.append(pkg)
+        self.dirty = True
         return self
 
     @property
@@ -352,21 +731,81 @@ class ComponentArchBinary(object):
 
     @packages_file.setter
     def packages_file(self, value):
-        self._packages_file = value
+        self._set_packages_file(value)
         self._packages_file.seek(0)
+        self.dirty = True
+
+    def _set_packages_file(self, value):
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+        self._packages_file = value
+        self._spooled_file = False
+
+    def lookup(self, name, version=None):
+        """
+        Return the packages called name, and with the specified version if
+        one is given, in index order
+        """
+        if self._spool is not None:
+            candidates = (paragraph.Paragraph(x.stanza) for x in self._spool)
+        elif self._packages is not None:
+            return [x for x in self._packages if x.name == name and (
+                version is None or x.full_version == version)]
+        elif self._packages_file is None:
+            return []
+        else:
+            if self._index is None:
+                self._index = paragraph.ParagraphIndex(self._packages_file)
+            candidates = self._index.lookup(name)
+        return [x for x in candidates if x['Package'] == name and (
+            version is None or x['Version'] == version)]
+
+    def iter_packages(self, fields=None, fast=False):
+        """
+        Iterate over the packages. Packages read from a Packages file are
+        deb822.Packages objects; if fields is specified, only those fields
+        are extracted from them.
 
-    def iter_packages(self):
+        If fast is True, they are read-only paragraph.Paragraph objects
+        instead, which are much cheaper to parse.
+        """
+        if self._spool is not None:
+            return iter(self._spool)
         if self._packages is not None:
             return iter(self._packages)
         if self._packages_file is None:
             return iter([])
         self._packages_file.seek(0)
-        return deb822.Packages.iter_paragraphs(self._packages_file)
+        if fast:
+            return paragraph.iter_paragraphs(self._packages_file,
+                                             fields=fields)
+        # apt_pkg would read compressed files as they are
+        return deb822.Packages.iter_paragraphs(
+            self._packages_file, fields=fields, use_apt_pkg=False)
+
+    def index_packages(self, fast=False):
+        """
+        Iterate over the packages in the order they are indexed in. fast is
+        passed to iter_packages().
+        """
+        if self.sort and self._spool is None and self._packages is not None:
+            return iter(sorted(self._packages, key=_sort_key))
+        return self.iter_packages(fast=fast)
 
     def load_packages(self, base_path):
-        pkgs_relative_path = self.relative_path('Packages')
-        self._packages_file = open(
-            os.path.join(base_path, pkgs_relative_path))
+        """
+        Read packages from the Packages file in base_path, or from a
+        compressed one if there is no uncompressed file
+        """
+        path = os.path.join(base_path, self.relative_path('Packages'))
+        if not os.path.exists(path):
+            for ext in AptRepoMeta._Compression_Types:
+                if os.path.exists(path + '.' + ext):
+                    path += '.' + ext
+                    break
+        self._set_packages_file(compressr.Opener().open(path, 'rb'))
+        self.dirty = False
 
     def relative_path(self, fname):
         return os.path.join(
@@ -383,23 +822,75 @@ class ComponentArchBinary(object):
     def pool_path(self, base_path):
         return os.path.join(base_path, self.pool_relative_path)
 
+    def package_relative_path(self, pkg, layout=None):
+        """
+        Return the path of pkg in the pool, relative to the repository
+        root, for the given pool layout (flat by default)
+        """
+        if layout is None or layout == POOL_LAYOUT_FLAT:
+            return os.path.join(self.pool_relative_path, pkg.filename)
+        if layout == POOL_LAYOUT_SHARDED:
+            source = pkg.source
+            if source.startswith('lib') and len(source) > 3:
+                prefix = source[:4]
+            else:
+                prefix = source[:1]
+            return os.path.join(self.pool_relative_path, prefix, source,
+                                pkg.filename)
+        if layout == POOL_LAYOUT_CONTENT:
+            digest = pkg.sha256
+            return os.path.join('pool', 'sha256', digest[:2], digest,
+                                pkg.filename)
+        raise ValueError("Unknown pool layout %r" % (layout, ))
+
     def write_release(self, base_path):
         path = self.release_path(base_path)
         utils.makedirs(os.path.dirname(path))
         self.release.dump(open(path, "wb"))
 
-    def write_packages(self, base_path, release_dir):
-        pkgs_relative_path = os.path.join(
+    @property
+    def packages_relative_path(self):
+        """Path of the Packages file, relative to the release directory"""
+        return os.path.join(
             self.component, 'binary-{}'.format(self.architecture), 'Packages')
+
+    def write_packages(self, base_path, release_dir, compressions=None,
+                       pdiffs=0, published=None):
         pkg_files, checksums = AptRepoMeta.WritePackages(
-            base_path, release_dir, pkgs_relative_path, self.iter_packages())
+            base_path, release_dir, self.packages_relative_path,
+            self.index_packages(fast=True),
+            compressions=compressions, pdiffs=pdiffs, published=published)
+        if self._spool is not None:
+            # The Packages file now holds the same stanzas; don't keep
+            # the run files around until garbage collection
+            self._spool.close()
+            self._spool = None
+            self._set_packages_file(open(
+                os.path.join(release_dir, self.packages_relative_path),
+                'rb'))
+            self._spooled_file = True
         return checksums
 
 
+def _sort_key(pkg):
+    if isinstance(pkg, debpkg.DebPkg):
+        return pkg.sort_key
+    return debpkg.PackageSortKey(pkg['Package'], pkg['Version'],
+                                 pkg['Architecture'])
+
+
 class AptRepo(object):
 
     def __init__(self, path, metadata=None, gpg_sign_options=None,
-                 repo_name=None):
+                 repo_name=None, ingest_cache=None, pool_layout=None):
+        """
+        ingest_cache: optional cache.IngestCache; packages that did not
+        change since they were cached are not read again
+
+        pool_layout: one of POOL_LAYOUTS, defaults to POOL_LAYOUT_FLAT.
+        With POOL_LAYOUT_CONTENT a package added to several components or
+        dists is stored only once.
+        """
         self.base_path = path
         if gpg_sign_options is not None:
             if not isinstance(gpg_sign_options, signer.SignOptions):
@@ -411,6 +902,12 @@ class AptRepo(object):
             metadata = AptRepoMeta()
         self.metadata = metadata
         self._repo_name = repo_name
+        self.ingest_cache = ingest_cache
+        if pool_layout is None:
+            pool_layout = POOL_LAYOUT_FLAT
+        if pool_layout not in POOL_LAYOUTS:
+            raise ValueError("Unknown pool layout %r" % (pool_layout, ))
+        self.pool_layout = pool_layout
 
     @property
     def repo_name(self):
@@ -433,40 +930,197 @@ class AptRepo(object):
         return dl_request
 
     @classmethod
-    def download(cls, requests):
-        return utils.download(requests)
+    def download(cls, requests, workers=None, per_host=None):
+        """
+        Download requests concurrently (see utils.Downloader), and return
+        a utils.DownloadResult for each of them, in order. A failed
+        request does not stop the others.
+        """
+        downloader = utils.Downloader(workers=workers, per_host=per_host)
+        return downloader.download(requests)
 
     def add_packages(self, filenames, component, architecture,
-                     with_symlinks=False):
+                     with_symlinks=False, single_pass=False, workers=None,
+                     placement=None):
+        """
+        If single_pass is True, each .deb is read only once: control data,
+        hashes and size all come from the same stream (see DebPkg.ingest)
+
+        If workers is greater than 1, packages are parsed and hashed in a
+        pool of that many processes and copied into the pool directory by
+        as many threads. Packages are still added in the order of filenames.
+
+        placement selects how files are put in the pool (see
+        utils.place_file); it defaults to a plain copy, and is ignored if
+        with_symlinks is True.
+        """
         component = self.metadata.get_component_arch_binary(
             component, architecture)
-        dst_dir = component.pool_path(self.base_path)
-        utils.makedirs(dst_dir)
-        rel_path = component.pool_relative_path
-
-        for filename in filenames:
-            sz = str(os.stat(filename).st_size)
-            pkg = debpkg.DebPkg.from_file(filename, Size=sz)
-            dst_path = os.path.join(dst_dir, pkg.filename)
-            pkg.relative_path = os.path.join(rel_path, pkg.filename)
-            self._add_package(filename, dst_path, with_symlinks=with_symlinks)
-            component.add_package(pkg)
 
+        if workers is not None and workers > 1:
+            self._add_packages_parallel(
+                filenames, component, with_symlinks=with_symlinks,
+                single_pass=single_pass, workers=workers,
+                placement=placement)
+        else:
+            for filename in filenames:
+                pkg = self._read_package(filename, single_pass=single_pass)
+                dst_path = self._pool_destination(component, pkg)
+                self._add_package(filename, dst_path,
+                                  with_symlinks=with_symlinks,
+                                  placement=placement, pkg=pkg)
+                component.add_package(pkg)
+
+        if self.ingest_cache is not None:
+            self.ingest_cache.commit()
         return component
 
-    def _add_package(self, filename, destination, with_symlinks=False):
-        if with_symlinks:
+    def _read_package(self, filename, single_pass=False):
+        cache = self.ingest_cache
+        if cache is not None:
+            pkg = cache.get(filename)
+            if pkg is not None:
+                return pkg
+        pkg = read_package(filename, single_pass=single_pass)
+        if cache is not None:
+            cache.put(filename, pkg)
+        return pkg
+
+    def _add_packages_parallel(self, filenames, component, with_symlinks,
+                               single_pass, workers, placement):
+        cache = self.ingest_cache
+        filenames = list(filenames)
+        # Cached packages are only loaded when their turn comes, so (with
+        # spill) memory use does not grow with the number of packages
+        if cache is None:
+            cached = [False] * len(filenames)
+        else:
+            cached = [cache.contains(x) for x in filenames]
+        missing = [x for x, hit in zip(filenames, cached) if not hit]
+        reader = functools.partial(read_package, single_pass=single_pass)
+        max_pending = workers * 4
+        with futures.ProcessPoolExecutor(max_workers=workers) as procs, \
+                futures.ThreadPoolExecutor(max_workers=workers) as threads:
+            # map() yields results in submission order, which keeps the
+            # outcome identical to the serial path
+            chunksize = max(1, len(missing) // max_pending)
+            fresh = procs.map(reader, missing, chunksize=chunksize)
+            pending = set()
+            for filename, hit in zip(filenames, cached):
+                if hit:
+                    pkg = cache.get(filename)
+                    if pkg is None:
+                        # Changed since it was looked up
+                        pkg = reader(filename)
+                        cache.put(filename, pkg)
+                else:
+                    pkg = next(fresh)
+                    if cache is not None:
+                        cache.put(filename, pkg)
+                dst_path = self._pool_destination(component, pkg)
+                pending.add(threads.submit(
+                    self._add_package, filename, dst_path,
+                    with_symlinks=with_symlinks, placement=placement,
+                    pkg=pkg))
+                component.add_package(pkg)
+                # Let go of finished copies, and of their packages
+                if len(pending) >= max_pending:
+                    done, pending = futures.wait(
+                        pending, return_when=futures.FIRST_COMPLETED)
+                    for copy in done:
+                        copy.result()
+            for copy in pending:
+                copy.result()
+        return component
+
+    def add_stream(self, fileobj, component, architecture, size=None):
+        """
+        Add a package read from a stream, e.g. an upload.
+        The bytes are written straight into the pool while the package is
+        parsed and hashed, so it lands and gets indexed with a single
+        write. Returns the new DebPkg.
+        """
+        component = self.metadata.get_component_arch_binary(
+            component, architecture)
+        upload_dir = utils.makedirs(self._prefix('pool'))
+        # The final file name is only known once the control data was read
+        with utils.AtomicFile(os.path.join(upload_dir, 'upload.deb')) as fobj:
+            pkg = debpkg.DebPkg.from_stream(fileobj, size=size,
+                                            destination=fobj)
+            fobj.commit(self._pool_destination(component, pkg))
+        component.add_package(pkg)
+        return pkg
+
+    def _pool_destination(self, component, pkg):
+        """Set the Filename of pkg and return its absolute path"""
+        pkg.relative_path = component.package_relative_path(
+            pkg, layout=self.pool_layout)
+        dst_path = self._prefix(pkg.relative_path)
+        utils.makedirs(os.path.dirname(dst_path))
+        return dst_path
+
+    def _add_package(self, filename, destination, with_symlinks=False,
+                     placement=None, pkg=None):
+        """
+        If pkg (the DebPkg for filename) is specified and destination
+        already holds the same content, nothing is written.
+        """
+        if self._destination_matches(filename, destination, pkg,
+                                     with_symlinks=with_symlinks):
+            log.debug("Skipping %s, %s is up to date", filename, destination)
+        elif with_symlinks:
             log.debug("Symlinking %s -> %s", filename, destination)
-            if os.path.exists(destination):
+            if os.path.lexists(destination):
                 log.debug("    Removing existing destination")
                 os.unlink(destination)
             os.symlink(filename, destination)
         else:
-            log.debug("Copying %s -> %s", filename, destination)
-            shutil.copy(filename, destination)
+            if os.path.islink(destination):
+                # Do not copy through a symlink left by a previous run
+                os.unlink(destination)
+            if placement is None:
+                placement = utils.PLACEMENT_COPY
+            log.debug("Placing (%s) %s -> %s", placement, filename,
+                      destination)
+            used = utils.place_file(filename, destination, strategy=placement)
+            log.debug("    Placed with %s", used)
+        if pkg is not None and self.ingest_cache is not None and \
+                not with_symlinks:
+            # Next time, the destination can be checked without reading it
+            self.ingest_cache.put(destination, pkg)
+
+    def _destination_matches(self, filename, destination, pkg,
+                             with_symlinks=False):
+        try:
+            st = os.lstat(destination)
+        except OSError:
+            return False
+        if with_symlinks:
+            return stat.S_ISLNK(st.st_mode) and \
+                os.readlink(destination) == filename
+        if pkg is None or stat.S_ISLNK(st.st_mode):
+            return False
+        if str(st.st_size) != pkg.size:
+            return False
+        if os.path.samefile(filename, destination):
+            return True
+        if self.ingest_cache is not None:
+            cached = self.ingest_cache.get(destination)
+            if cached is not None:
+                return cached.sha256 == pkg.sha256
+        digests = hash_file(destination, algs=['sha256'])
+        return digests['sha256'] == pkg.sha256
 
     def create(self, files=None, with_symlinks=False, component=None,
-               architecture=None):
+               architecture=None, single_pass=False, workers=None,
+               placement=None, incremental=False):
+        """
+        If incremental is True, only the indices of components and
+        architectures that packages were added to are rewritten (see
+        AptRepoMeta.create)
+
+        workers also applies to writing the indices
+        """
         # If component and architecture are not specified, default to the
         # first ones
         if files:
@@ -475,9 +1129,38 @@ class AptRepo(object):
             if not architecture:
                 architecture = self.metadata.architectures[0]
             self.add_packages(files, with_symlinks=with_symlinks,
-                              component=component, architecture=architecture)
-        self.metadata.create(self.base_path)
-        self.sign(self.metadata.release_path(self.base_path))
+                              component=component, architecture=architecture,
+                              single_pass=single_pass, workers=workers,
+                              placement=placement)
+        needs_signing = self.metadata.create(self.base_path,
+                                             incremental=incremental,
+                                             workers=workers)
+        release_path = self.metadata.release_path(self.base_path)
+        # An unchanged Release still needs signing if it never was, e.g.
+        # because signing was just enabled or failed last time
+        if not needs_signing and self.gpg_sign_options:
+            needs_signing = not self._signature_current(release_path)
+        if needs_signing:
+            self.sign(release_path)
+
+    @classmethod
+    def _signature_current(cls, release_path):
+        """
+        Return True if Release.gpg or InRelease exists, and every one
+        that does is at least as recent as the Release file
+        """
+        mtime = os.stat(release_path).st_mtime
+        signatures = [release_path + '.gpg', os.path.join(
+            os.path.dirname(release_path), 'InRelease')]
+        found = False
+        for path in signatures:
+            try:
+                if os.stat(path).st_mtime < mtime:
+                    return False
+            except OSError:
+                continue
+            found = True
+        return found
 
     def sign(self, release_file):
         if not self.gpg_sign_options:
@@ -505,7 +1188,7 @@ class AptRepo(object):
         req = cls.make_download_request(
             utils.DownloadRequest(release_file, dest, data=None))
         try:
-            cls.download([req])
+            utils.check_downloads(cls.download([req]))
         except:  # noqa: E722
             log.error('Failed to open %s', release_file, exc_info=True)
             raise
@@ -513,18 +1196,36 @@ class AptRepo(object):
         return cls(base_path, meta)
 
     @classmethod
-    def parse(cls, base_path, path, codename=None):
+    def parse(cls, base_path, path, codename=None, keep_compressed=False):
+        """
+        If keep_compressed is True, downloaded indices stay compressed on
+        disk (see validate_component_arch_packages_downloads)
+        """
         repoobj = cls.parse_release(base_path, path, codename=codename)
         meta = repoobj.metadata
         dl_reqs = meta.create_Packages_download_requests(base_path)
-        repoobj.download([cls.make_download_request(x) for x in dl_reqs])
-        meta.validate_component_arch_packages_downloads(dl_reqs)
+        utils.check_downloads(repoobj.download(
+            [cls.make_download_request(x) for x in dl_reqs]))
+        meta.validate_component_arch_packages_downloads(
+            dl_reqs, keep_compressed=keep_compressed)
         return repoobj
 
 
+def read_package(filename, single_pass=False):
+    """
+    Build a DebPkg from filename, with Size filled in.
+    This is a module-level function so it can run in a process pool.
+    """
+    if single_pass:
+        return debpkg.DebPkg.ingest(filename)
+    sz = str(os.stat(filename).st_size)
+    return debpkg.DebPkg.from_file(filename, Size=sz)
+
+
 def create_repo(path, files, codename=None, components=None,
                 arches=None, desc=None, origin=None, label=None,
-                with_symlinks=False):
+                with_symlinks=False, ingest_cache=None, pool_layout=None,
+                compressions=None, pdiffs=0, by_hash=False):
     if arches is not None:
         if isinstance(arches, string_types):
             arches = [x for x in arches.split() if x]
@@ -535,12 +1236,17 @@ def create_repo(path, files, codename=None, components=None,
                            codename=codename,
                            components=components,
                            architectures=arches,
-                           description=desc)
-    repo = AptRepo(path, metadata=metadata)
+                           description=desc,
+                           compressions=compressions,
+                           pdiffs=pdiffs,
+                           by_hash=by_hash)
+    repo = AptRepo(path, metadata=metadata, ingest_cache=ingest_cache,
+                   pool_layout=pool_layout)
     repo.create(files, with_symlinks=with_symlinks)
     return repo
 
 
-def parse_repo(base_path, path, codename=None):
-    repo = AptRepo.parse(base_path, path, codename=codename)
+def parse_repo(base_path, path, codename=None, keep_compressed=False):
+    repo = AptRepo.parse(base_path, path, codename=codename,
+                         keep_compressed=keep_compressed)
     return repo
@@ -0,0 +1,258 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Minimal ar(1) reader for .deb files
+
+Only the control.tar member is ever decompressed; every other member is
+skipped over, so the archive can be consumed as a forward-only stream
+(read_stream) or located by header offsets in a memory map (DebArchive).
+'''
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import bz2
+import io
+import mmap
+import tarfile
+import zlib
+from collections import namedtuple
+
+try:
+    import lzma
+except ImportError:
+    from backports import lzma
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .errors import ArchiveError
+
+AR_MAGIC = b'!<arch>\n'
+AR_HEADER_SIZE = 60
+AR_FMAG = b'`\n'
+
+CONTROL_PART = 'control.tar'
+CONTROL_FILE = 'control'
+MD5_FILE = 'md5sums'
+MAINT_SCRIPTS = ('preinst', 'postinst', 'prerm', 'postrm', 'config')
+
+BLOCKSIZE = 65536
+
+ArMember = namedtuple("ArMember", "name offset size")
+ControlParts = namedtuple("ControlParts", "control md5sums scripts")
+
+
+def _decompress_zst(data):
+    if zstandard is None:
+        raise ArchiveError(
+            "control.tar.zst found, but zstandard is not installed")
+    return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+_Decompressors = {
+    '': bytes,
+    'gz': lambda data: zlib.decompress(data, 16 + zlib.MAX_WBITS),
+    'xz': lzma.decompress,
+    'bz2': bz2.decompress,
+    'zst': _decompress_zst,
+}
+
+
+def parse_header(header, offset):
+    """
+    Parse a 60-byte ar member header.
+    offset is the position of the header itself; the returned ArMember
+    points at the member data that follows it.
+    """
+    if len(header) != AR_HEADER_SIZE or header[58:60] != AR_FMAG:
+        raise ArchiveError("Invalid ar member header at offset %d" % offset)
+    # GNU ar terminates names with a slash
+    name = bytes(header[:16]).decode('ascii').rstrip().rstrip('/')
+    try:
+        size = int(bytes(header[48:58]).decode('ascii'))
+    except ValueError:
+        raise ArchiveError("Invalid ar member size at offset %d" % offset)
+    return ArMember(name, offset + AR_HEADER_SIZE, size)
+
+
+def is_control_part(name):
+    if name == CONTROL_PART:
+        return True
+    base, _, ext = name.rpartition('.')
+    return base == CONTROL_PART and ext in _Decompressors
+
+
+def decompress(name, data):
+    ext = name[len(CONTROL_PART):].lstrip('.')
+    try:
+        return _Decompressors[ext](data)
+    except (IOError, EOFError, zlib.error, lzma.LZMAError) as e:
+        raise ArchiveError("Failed to decompress %s: %s" % (name, e))
+
+
+def read_control_tar(name, data):
+    """
+    Extract control, md5sums and the maintainer scripts from the
+    (compressed) control.tar member data.
+    md5sums is None if the package does not ship one.
+    """
+    tar = tarfile.open(fileobj=io.BytesIO(decompress(name, data)), mode='r:')
+    contents = dict()
+    for tinfo in tar:
+        if not tinfo.isfile():
+            continue
+        fname = tinfo.name
+        if fname.startswith('./'):
+            fname = fname[2:]
+        if fname == CONTROL_FILE or fname == MD5_FILE or \
+                fname in MAINT_SCRIPTS:
+            contents[fname] = tar.extractfile(tinfo).read()
+    tar.close()
+    if CONTROL_FILE not in contents:
+        raise ArchiveError("'%s' file not found in %s" % (CONTROL_FILE, name))
+    scripts = dict((x, contents[x]) for x in MAINT_SCRIPTS if x in contents)
+    return ControlParts(contents[CONTROL_FILE], contents.get(MD5_FILE),
+                        scripts)
+
+
+def _skip(fileobj, size):
+    while size > 0:
+        buf = fileobj.read(min(size, BLOCKSIZE))
+        if not buf:
+            raise ArchiveError("Unexpected end of archive")
+        size -= len(buf)
+
+
+def _read_exact(fileobj, size):
+    # Pipes, sockets and HTTP responses may return less than asked for
+    # well before the end of the stream
+    chunks = []
+    while size > 0:
+        buf = fileobj.read(size)
+        if not buf:
+            break
+        chunks.append(buf)
+        size -= len(buf)
+    return b''.join(chunks)
+
+
+def read_stream(fileobj):
+    """
+    Read a .deb from a forward-only stream and return its ControlParts.
+
+    The stream is always consumed to the end, so a hashing wrapper around
+    fileobj sees every byte of the archive exactly once.
+    """
+    if _read_exact(fileobj, len(AR_MAGIC)) != AR_MAGIC:
+        raise ArchiveError("Not an ar archive")
+    offset = len(AR_MAGIC)
+    parts = None
+    while True:
+        header = _read_exact(fileobj, AR_HEADER_SIZE)
+        if not header:
+            break
+        member = parse_header(header, offset)
+        if parts is None and is_control_part(member.name):
+            data = _read_exact(fileobj, member.size)
+            if len(data) != member.size:
+                raise ArchiveError("Unexpected end of archive")
+            parts = read_control_tar(member.name, data)
+        else:
+            _skip(fileobj, member.size)
+        # Members are aligned on even offsets; the last pad byte may be
+        # missing in archives produced by some tools
+        pad = member.size % 2
+        if pad:
+            _read_exact(fileobj, pad)
+        offset = member.offset + member.size + pad
+    if parts is None:
+        raise ArchiveError("Missing %s member" % CONTROL_PART)
+    return parts
+
+
+class DebArchive(object):
+    """
+    Random access to the members of a .deb through a read-only mmap.
+
+    Only the member headers and the control.tar member are ever touched,
+    so pages belonging to data.tar are never read from disk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fh = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._fh.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except ValueError:
+            self._fh.close()
+            raise ArchiveError("Not an ar archive")
+        self.size = len(self._map)
+        try:
+            self.members = self._scan()
+        except ArchiveError:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def close(self):
+        self._map.close()
+        self._fh.close()
+
+    def _scan(self):
+        if self._map[:len(AR_MAGIC)] != AR_MAGIC:
+            raise ArchiveError("Not an ar archive")
+        members = []
+        offset = len(AR_MAGIC)
+        while offset < self.size:
+            header = self._map[offset:offset + AR_HEADER_SIZE]
+            member = parse_header(header, offset)
+            if member.offset + member.size > self.size:
+                raise ArchiveError("Unexpected end of archive")
+            members.append(member)
+            offset = member.offset + member.size + member.size % 2
+        return members
+
+    def control_member(self):
+        for member in self.members:
+            if is_control_part(member.name):
+                return member
+        raise ArchiveError("Missing %s member" % CONTROL_PART)
+
+    def control_parts(self):
+        member = self.control_member()
+        # Only the control.tar member is copied out of the mapping; a
+        # memoryview would avoid even that, but Python 2 cannot make one
+        # from an mmap
+        data = self._map[member.offset:member.offset + member.size]
+        return read_control_tar(member.name, data)
+
+
+def read_control(path):
+    """
+    Return the ControlParts of the .deb at path without reading data.tar
+    """
+    with DebArchive(path) as deb:
+        return deb.control_parts()
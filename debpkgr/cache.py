@@ -0,0 +1,160 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Persistent cache of .deb metadata
+
+Entries are keyed on the file identity (path, size, mtime, inode and
+device), so an unchanged package never has to be opened again to recover
+its control stanza, hashes, md5sums and maintainer scripts.
+'''
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import base64
+import json
+import logging
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from collections import namedtuple
+
+from . import utils
+from .debpkg import DebPkg
+
+log = logging.getLogger(__name__)
+
+FileIdentity = namedtuple("FileIdentity", "size mtime inode device")
+
+
+def file_identity(path):
+    st = os.stat(path)
+    mtime = getattr(st, 'st_mtime_ns', None)
+    if mtime is None:
+        mtime = int(st.st_mtime * 1e9)
+    return FileIdentity(st.st_size, mtime, st.st_ino, st.st_dev)
+
+
+class IngestCache(object):
+    """
+    SQLite-backed cache of DebPkg metadata.
+
+    Changes are only made durable by commit() (or by using the cache as a
+    context manager); an interrupted run simply loses its new entries.
+    The cache can be shared between threads.
+    """
+    DEFAULT_PATH = os.path.join('.debpkgr', 'ingest-cache.sqlite')
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS packages (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            device INTEGER NOT NULL,
+            data TEXT NOT NULL
+        )'''
+
+    def __init__(self, path):
+        self.path = path
+        utils.makedirs(os.path.dirname(os.path.abspath(path)))
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(self.SCHEMA)
+        self.hits = self.misses = 0
+
+    @classmethod
+    def for_repo(cls, base_path):
+        """Open the cache stored in the repository at base_path"""
+        return cls(os.path.join(base_path, cls.DEFAULT_PATH))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.commit()
+        self.close()
+
+    def get(self, filename):
+        """
+        Return a DebPkg for filename, or None if the file is not cached or
+        has changed since it was cached.
+        """
+        path = os.path.abspath(filename)
+        with self._lock:
+            row = self._db.execute(
+                'SELECT size, mtime, inode, device, data FROM packages '
+                'WHERE path = ?', (path, )).fetchone()
+            if row is None or FileIdentity(*row[:4]) != file_identity(path):
+                self.misses += 1
+                return None
+            self.hits += 1
+        return DebPkg.from_primitive(self._decode(row[4]))
+
+    def contains(self, filename):
+        """
+        Return True if filename is cached and unchanged, without decoding
+        its entry (or counting a hit or a miss)
+        """
+        path = os.path.abspath(filename)
+        with self._lock:
+            row = self._db.execute(
+                'SELECT size, mtime, inode, device FROM packages '
+                'WHERE path = ?', (path, )).fetchone()
+        return row is not None and FileIdentity(*row) == file_identity(path)
+
+    def put(self, filename, pkg):
+        path = os.path.abspath(filename)
+        row = (path, ) + tuple(file_identity(path)) + (self._encode(pkg), )
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO packages '
+                '(path, size, mtime, inode, device, data) '
+                'VALUES (?, ?, ?, ?, ?, ?)', row)
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+
+    def close(self):
+        log.debug("Ingest cache %s: %d hits, %d misses",
+                  self.path, self.hits, self.misses)
+        self._db.close()
+
+    @staticmethod
+    def _encode(pkg):
+        data = pkg.to_primitive()
+        data['control'] = list(data['control'].items())
+        data['scripts'] = dict(
+            (k, base64.b64encode(v).decode('ascii'))
+            for k, v in data['scripts'].items())
+        if isinstance(data['md5sums'], bytes):
+            # Not parsed yet; keep it that way
+            data['md5sums_raw'] = base64.b64encode(
+                data.pop('md5sums')).decode('ascii')
+        return json.dumps(data)
+
+    @staticmethod
+    def _decode(blob):
+        data = json.loads(blob, object_pairs_hook=OrderedDict)
+        data['control'] = OrderedDict(data['control'])
+        data['scripts'] = dict(
+            (k, base64.b64decode(v)) for k, v in data['scripts'].items())
+        if 'md5sums_raw' in data:
+            data['md5sums'] = base64.b64decode(data.pop('md5sums_raw'))
+        return data
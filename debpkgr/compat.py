@@ -22,10 +22,12 @@ from six import (
 )
 
 from six.moves import configparser
+from six.moves import http_client
 from six.moves.reprlib import Repr
 from six.moves.urllib.parse import parse_qs, urlsplit, urlunsplit
-from six.moves.urllib.parse import urlparse, urlencode
+from six.moves.urllib.parse import urlparse, urlencode, urljoin
 from six.moves.urllib.request import urlopen, urlretrieve
+from six.moves.urllib.request import getproxies, proxy_bypass
 from six.moves.urllib.error import HTTPError
 
 try:
@@ -14,29 +14,88 @@
 # limitations under the License.
 #
 
+from __future__ import absolute_import
+
 import bz2
 import gzip
+import io
 import os
+import threading
 from collections import namedtuple
 
+import six
+from six.moves import queue
+
 try:
     import lzma
 except ImportError:
     from backports import lzma
 
+from .hasher import HashWriter
+
 
 Filename = namedtuple("Filename", "path base_name extension")
-_Opener = namedtuple("_Opener", "factory extensions args_read args_write")
+_Opener = namedtuple("_Opener",
+                     "factory fileobj_factory extensions args_read "
+                     "args_write level_arg")
+
+
+class _BZ2Writer(object):
+    """
+    Compress into a file object with bz2. On Python 2, BZ2File only
+    accepts a file name.
+    """
+
+    def __init__(self, fileobj, compresslevel=9):
+        self.fileobj = fileobj
+        self._compressor = bz2.BZ2Compressor(compresslevel)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    @property
+    def closed(self):
+        return self._compressor is None
+
+    def write(self, data):
+        self.fileobj.write(self._compressor.compress(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._compressor is None:
+            return
+        self.fileobj.write(self._compressor.flush())
+        self._compressor = None
+
+
+def _gzip_fileobj(fileobj, mode, **kwargs):
+    return gzip.GzipFile(fileobj=fileobj, mode=mode, **kwargs)
+
+
+def _bz2_fileobj(fileobj, mode, **kwargs):
+    if not mode.startswith('r'):
+        return _BZ2Writer(fileobj, **kwargs)
+    if six.PY3:
+        return bz2.BZ2File(fileobj, mode, **kwargs)
+    return io.BytesIO(bz2.decompress(fileobj.read()))
 
 
 class Opener(object):
     _Decompressor_Factories = dict(
-        gz=_Opener(gzip.open, extensions=['gz'], args_read=dict(),
-                   args_write=dict(compresslevel=9)),
-        xz=_Opener(lzma.LZMAFile, extensions=['xz'],
-                   args_read=dict(), args_write=dict()),
-        bz2=_Opener(bz2.BZ2File, extensions=['bz2', 'bzip2'],
-                    args_read=dict(), args_write=dict()),
+        gz=_Opener(gzip.open, _gzip_fileobj, extensions=['gz'],
+                   args_read=dict(), args_write=dict(compresslevel=9),
+                   level_arg='compresslevel'),
+        xz=_Opener(lzma.LZMAFile, lzma.LZMAFile, extensions=['xz'],
+                   args_read=dict(), args_write=dict(), level_arg='preset'),
+        bz2=_Opener(bz2.BZ2File, _bz2_fileobj, extensions=['bz2', 'bzip2'],
+                    args_read=dict(), args_write=dict(),
+                    level_arg='compresslevel'),
     )
 
     # Reverse lookup of decompressor by extension
@@ -79,16 +138,26 @@ class Opener(object):
             ret.append(obj.path)
         return ret
 
-    def open(self, file_name, mode="rb", uncompressed=False):
+    def open(self, file_name, mode="rb", uncompressed=False, fileobj=None,
+             level=None):
         """
         If uncompressed is True, the file is opened in uncompressed mode,
         regardless of its extension.
 
         This is useful if the file has an extension already (like foo.xml) and
         we don't want to treat the extension as a compression indicator.
+
+        If fileobj is specified, the (de)compressor is layered on top of it
+        instead of opening file_name, which then only selects the codec.
+        Closing the returned object does not close fileobj.
+
+        level overrides the codec's default compression level (the preset
+        for xz) when writing.
         """
         f = self._File(file_name)
         if uncompressed or f.extension is None:
+            if fileobj is not None:
+                return fileobj
             return open(file_name, mode)
         dname = self._Extension_to_decompressor.get(
             f.extension, f.extension)
@@ -99,6 +168,11 @@ class Opener(object):
             opts = d.args_read
         else:
             opts = d.args_write
+            if level is not None:
+                opts = dict(opts)
+                opts[d.level_arg] = level
+        if fileobj is not None:
+            return d.fileobj_factory(fileobj, mode, **opts)
         return d.factory(file_name, mode, **opts)
 
     @classmethod
@@ -115,9 +189,68 @@ class Opener(object):
         return Filename(fpath, bname, ext)
 
 
+class _WriterThread(threading.Thread):
+    """
+    Write the blocks put on a bounded queue to fobj, then close it.
+
+    zlib, bz2 and lzma release the GIL while compressing, so one thread per
+    output lets the codecs run in parallel.
+    """
+
+    def __init__(self, fobj, queue_size):
+        super(_WriterThread, self).__init__()
+        self.daemon = True
+        self.fobj = fobj
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+
+    def run(self):
+        while True:
+            block = self.queue.get()
+            if block is None:
+                break
+            if self.error is not None:
+                # Keep draining, so the producer never blocks on us
+                continue
+            try:
+                self.fobj.write(block)
+            except Exception as e:
+                self.error = e
+        try:
+            self.fobj.close()
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+
+
 class MultiWriter(object):
-    def __init__(self, fpath, extensions, opener=None):
+    """
+    Write the same data to fpath compressed with each of extensions (None
+    stands for the uncompressed file).
+
+    If algorithms is specified, the bytes that end up in each file are
+    hashed and counted as they are written; after close(), hashers maps
+    every file name to a hasher.HashWriter with its digests and size.
+
+    levels optionally maps extensions to compression levels.
+
+    If threads is True, every output is compressed on its own thread, fed
+    through a queue of at most queue_size blocks; errors are raised by
+    write() or close(). Blocks must not be modified after being written.
+    """
+    Queue_Size = 16
+
+    def __init__(self, fpath, extensions, opener=None, algorithms=None,
+                 threads=False, queue_size=None, levels=None):
         self.fpath = fpath
+        self.levels = levels or dict()
+        self.algorithms = algorithms
+        self.threads = threads
+        if queue_size is None:
+            queue_size = self.Queue_Size
+        self.queue_size = queue_size
+        self.hashers = dict()
+        self.workers = []
         if opener is None:
             opener = Opener()
         self.opener = opener
@@ -126,22 +259,67 @@ class MultiWriter(object):
             if x in opener._Extension_to_decompressor]
         self.file_names = ["{}.{}".format(fpath, ext)
                            for ext in supported_extensions]
+        self._levels = dict(
+            ("{}.{}".format(fpath, ext), self.levels.get(ext))
+            for ext in supported_extensions)
         if None in extensions or '' in extensions:
             self.file_names.append(fpath)
         self.reset()
 
     def reset(self):
         self.file_objs = []
+        self.raw_objs = []
+        self.hashers = dict()
         for fname in self.file_names:
             uncompressed = (fname == self.fpath)
+            if self.algorithms is None:
+                self.file_objs.append(
+                    self.opener.open(fname, "wb", uncompressed=uncompressed,
+                                     level=self._levels.get(fname)))
+                continue
+            raw = HashWriter(open(fname, "wb"), algorithms=self.algorithms)
+            self.hashers[fname] = raw
+            self.raw_objs.append(raw)
             self.file_objs.append(
-                self.opener.open(fname, "wb", uncompressed=uncompressed))
+                self.opener.open(fname, "wb", uncompressed=uncompressed,
+                                 fileobj=raw, level=self._levels.get(fname)))
+        self.workers = []
+        if self.threads:
+            for fobj in self.file_objs:
+                worker = _WriterThread(fobj, self.queue_size)
+                worker.start()
+                self.workers.append(worker)
+
+    def _check_workers(self):
+        for worker in self.workers:
+            if worker.error is not None:
+                raise worker.error
 
     def write(self, block):
+        if self.workers:
+            self._check_workers()
+            for worker in self.workers:
+                worker.queue.put(block)
+            return
         for fobj in self.file_objs:
             fobj.write(block)
 
     def close(self):
-        for fobj in self.file_objs:
-            fobj.close()
+        # Compressors flush their trailers into the raw files on close
+        if self.workers:
+            for worker in self.workers:
+                worker.queue.put(None)
+            for worker in self.workers:
+                worker.join()
+        else:
+            for fobj in self.file_objs:
+                fobj.close()
+        for fobj in self.raw_objs:
+            if not fobj.closed:
+                fobj.close()
         self.file_objs = []
+        self.raw_objs = []
+        try:
+            self._check_workers()
+        finally:
+            self.workers = []
@@ -32,6 +32,8 @@ import logging
 import six
 import sys
 import inspect
+from collections import OrderedDict
+from io import BytesIO
 from io import StringIO
 
 from functools import total_ordering
@@ -59,7 +61,13 @@ except Exception:
     sys.exit()
 
 
+from . import arfile
+from . import utils
+from .errors import ArchiveError
+from .hasher import HashStream
+from .hasher import DEB_HASH_TRANSLATION
 from .hasher import deb_hash_file
+from .hasher import deb_hashes
 
 from six.moves import UserList
 
@@ -246,27 +254,80 @@ class DebPkgScripts(object):
         return self.prerm
 
 
+@total_ordering
+class PackageSortKey(object):
+    """
+    Canonical index order: by name, then version (as dpkg compares them),
+    then architecture
+    """
+    __slots__ = ("name", "version", "arch")
+
+    def __init__(self, name, version, arch):
+        self.name = name
+        self.version = version
+        self.arch = arch
+
+    def __repr__(self):
+        return 'PackageSortKey(%r, %r, %r)' % (
+            self.name, self.version, self.arch)
+
+    def __getstate__(self):
+        return (self.name, self.version, self.arch)
+
+    def __setstate__(self, state):
+        self.name, self.version, self.arch = state
+
+    def _cmp(self, other):
+        if self.name != other.name:
+            return -1 if self.name < other.name else 1
+        ret = version_compare(self.version, other.version)
+        if ret:
+            return ret
+        if self.arch != other.arch:
+            return -1 if self.arch < other.arch else 1
+        return 0
+
+    def __eq__(self, other):
+        return self._cmp(other) == 0
+
+    def __ne__(self, other):
+        return self._cmp(other) != 0
+
+    def __lt__(self, other):
+        return self._cmp(other) < 0
+
+
 @total_ordering
 class DebPkg(object):
-    """Represent a binary debian package"""
+    """
+    Represent a binary debian package
 
-    __slots__ = ("_c", "_h", "_md5", "_deps", "_version", "_scripts")
+    Only the control stanza and the hashes are needed to publish a package,
+    so relations, version, scripts and md5sums are kept in their raw form
+    and parsed on first access. md5sums may be passed as the raw contents
+    of the md5sums control file.
+
+    If hashes is None, they are computed from path on first access.
+    """
+
+    __slots__ = ("_c", "_h", "_md5", "_deps", "_version", "_scripts",
+                 "_path", "_stanza")
     ENCODINGS = ["utf-8", "iso-8859-1"]
 
-    def __init__(self, control, hashes, md5sums, scripts={}):
+    def __init__(self, control, hashes, md5sums, scripts={}, path=None):
         if isinstance(control, dict):
             control = deb822.Deb822(control)
         self._c = control
-        self._deps = DebPkgRequires(**self._c)
-        self._version = Version(self._c.get('Version'))
-        self._scripts = DebPkgScripts(**scripts)
+        self._deps = None
+        self._version = None
+        self._scripts = scripts
         if isinstance(hashes, dict):
             hashes = deb822.Deb822(hashes)
         self._h = hashes
-        if isinstance(md5sums, DebPkgMD5sums):
-            self._md5 = md5sums
-        else:
-            self._md5 = DebPkgMD5sums(md5sums)
+        self._md5 = md5sums
+        self._path = path
+        # Encoded Packages stanza, see dump()
+        self._stanza = None
 
     def __repr__(self):
         return 'DebPkg(%s)' % self.nevra
@@ -277,6 +338,35 @@ class DebPkg(object):
     def __hash__(self):
         return hash((self.name, self.version.full_version, self.arch))
 
+    def __reduce__(self):
+        # Deb822 objects can't be pickled; rebuild from plain mappings so
+        # packages can be handed across process boundaries
+        state = self.to_primitive()
+        return (self.__class__, (state['control'], state['hashes'],
+                                 state['md5sums'], state['scripts']))
+
+    def to_primitive(self):
+        """
+        Return the package as plain mappings, suitable for serialization.
+        DebPkg.from_primitive() reverses the operation.
+        """
+        if isinstance(self._scripts, DebPkgScripts):
+            scripts = dict((k, getattr(self._scripts, k))
+                           for k in DebPkgScripts.__slots__
+                           if getattr(self._scripts, k) is not None)
+        else:
+            scripts = dict(self._scripts)
+        md5sums = self._md5
+        if not isinstance(md5sums, (six.binary_type, type(None))):
+            md5sums = dict(md5sums)
+        return dict(control=OrderedDict(self._c), hashes=dict(self._hashes()),
+                    md5sums=md5sums, scripts=scripts)
+
+    @classmethod
+    def from_primitive(cls, data):
+        return cls(data['control'], data['hashes'], data['md5sums'],
+                   scripts=data['scripts'])
+
     def __eq__(self, other):
         try:
             return self.__cmp__(other) == 0
@@ -299,40 +389,82 @@ class DebPkg(object):
         if self is other:
             return 0
         if self.version == other.version:
-            if (self._c, self._h, self._md5) == (
-                    other._c, other._h, other._md5):
+            if (self._c, self._hashes()) == (other._c, other._hashes()) \
+                    and self._same_md5sums(other):
                 return 0
             return -1
         else:
             return version_compare(
                 self.version.full_version, other.full_version)
 
+    def _same_md5sums(self, other):
+        # Compare the raw md5sums if neither side has parsed them yet
+        if isinstance(self._md5, six.binary_type) and \
+                isinstance(other._md5, six.binary_type):
+            return self._md5 == other._md5
+        return self.md5sums == other.md5sums
+
     @property
     def package(self):
         package = self._c.copy()
-        package.update(self._h)
+        package.update(self._hashes())
         return package
 
     @property
     def files(self):
-        return DebPkgFiles([x for x in self._md5.keys()])
+        return DebPkgFiles([x for x in self.md5sums.keys()])
 
     @property
     def scripts(self):
+        if not isinstance(self._scripts, DebPkgScripts):
+            self._scripts = DebPkgScripts(**self._scripts)
         return self._scripts
 
     @property
     def md5sums(self):
+        if not isinstance(self._md5, DebPkgMD5sums):
+            if isinstance(self._md5, six.binary_type):
+                self._md5 = self.parse_md5sums(self._md5)
+            else:
+                self._md5 = DebPkgMD5sums(self._md5)
         return self._md5
 
+    def _hashes(self):
+        if self._h is None:
+            self._h = deb822.Deb822(self.make_hashes(self._path))
+        return self._h
+
     @property
     def hashes(self):
-        return self._h
+        """
+        The package's checksums. Reading the property drops the cached
+        stanza, so ``pkg.hashes[key] = value`` is safe; a reference kept
+        across a read of stanza must not be modified, use update() instead.
+        """
+        self._stanza = None
+        return self._hashes()
 
     @property
     def control(self):
+        """
+        The package's control fields. Reading the property drops the cached
+        stanza, so ``pkg.control[key] = value`` is safe; a reference kept
+        across a read of stanza must not be modified, use update() instead.
+        """
+        self._stanza = None
         return self._c
 
+    def update(self, control=None, hashes=None):
+        """
+        Update control fields and checksums from the given mappings and
+        drop the cached stanza
+        """
+        if control:
+            self._c.update(control)
+        if hashes:
+            self._hashes().update(hashes)
+        self._stanza = None
+
     @property
     def filename(self):
         return self.nevra + '.deb'
@@ -343,63 +475,88 @@ class DebPkg(object):
 
     @relative_path.setter
     def relative_path(self, value):
+        self._stanza = None
         self._c['Filename'] = value
 
+    @property
+    def size(self):
+        return self._c.get('Size')
+
     @property
     def name(self):
         return self._c['Package']
 
+    @property
+    def source(self):
+        """Name of the source package; Source may carry a version"""
+        source = self._c.get('Source')
+        if not source:
+            return self.name
+        return source.split()[0]
+
     @property
     def epoch(self):
-        return self._version.epoch or '0'
+        return self.version.epoch or '0'
 
     @property
     def full_version(self):
-        return self._version.full_version
+        return self.version.full_version
 
     @property
     def upstream_version(self):
-        return self._version.upstream_version
+        return self.version.upstream_version
 
     @property
     def debian_version(self):
-        return self._version.debian_version
+        return self.version.debian_version
 
     @property
     def debian_revision(self):
-        return self._version.debian_revision
+        return self.version.debian_revision
 
     @property
     def version(self):
+        if self._version is None:
+            self._version = Version(self._c.get('Version'))
         return self._version
 
     @property
     def arch(self):
         return self._c['Architecture']
 
+    @property
+    def sort_key(self):
+        return PackageSortKey(self.name, self._c['Version'], self.arch)
+
     @property
     def nevra(self):
-        return '_'.join([self.name, self._version.full_version, self.arch])
+        return '_'.join([self.name, self.version.full_version, self.arch])
+
+    @property
+    def requires(self):
+        if self._deps is None:
+            self._deps = DebPkgRequires(**self._c)
+        return self._deps
 
     @property
     def depends(self):
-        return self._deps.depends
+        return self.requires.depends
 
     @property
     def dependencies(self):
-        return self._deps.relations
+        return self.requires.relations
 
     @property
     def md5sum(self):
-        return self._h['MD5sum']
+        return self._hashes()['MD5sum']
 
     @property
     def sha1(self):
-        return self._h['SHA1']
+        return self._hashes()['SHA1']
 
     @property
     def sha256(self):
-        return self._h['SHA256']
+        return self._hashes()['SHA256']
 
     @staticmethod
     def make_hashes(path):
@@ -419,6 +576,92 @@ class DebPkg(object):
         control.update(kwargs)
         return cls(control, hashes, md5sums, scripts=scripts)
 
+    @classmethod
+    def ingest(cls, path, **kwargs):
+        """
+        Single pass alternative to from_file: the .deb is streamed once,
+        every block is hashed while the ar members are walked, and Size is
+        filled in from the number of bytes read.
+        Fields can be added or replaced using keyword arguments.
+        """
+        with open(path, 'rb') as fh:
+            return cls.from_stream(fh, name=path, **kwargs)
+
+    @classmethod
+    def from_stream(cls, fileobj, size=None, destination=None, name=None,
+                    **kwargs):
+        """
+        Build a package from a forward-only stream (an HTTP request body,
+        a socket file, ...). The stream is parsed and hashed in one pass.
+
+        If size is specified, the stream must contain exactly that many
+        bytes. If destination is specified (a path or a writable file
+        object), the bytes read are written to it as they go by; a path is
+        only created once the whole package was read successfully.
+        name is only used for log messages.
+        Fields can be added or replaced using keyword arguments.
+        """
+        if name is None:
+            name = getattr(fileobj, 'name', repr(fileobj))
+        if isinstance(destination, six.string_types):
+            with utils.AtomicFile(destination) as fobj:
+                return cls.from_stream(fileobj, size=size, destination=fobj,
+                                       name=name, **kwargs)
+        stream = HashStream(fileobj, algorithms=DEB_HASH_TRANSLATION.keys(),
+                            tee=destination)
+        parts = arfile.read_stream(stream)
+        stream.drain()
+        if size is not None and int(size) != stream.size:
+            raise ArchiveError("%s: expected %s bytes, read %d" % (
+                name, size, stream.size))
+        control = deb822.Deb822(parts.control)
+        control['Size'] = str(stream.size)
+        control.update(kwargs)
+        if parts.md5sums is None:
+            log.warn("While processing %s: 'md5sums' file not found, "
+                     "can't list MD5 sums", name)
+        hashes = deb_hashes(stream.digests)
+        # md5sums are parsed on first access
+        return cls(control, hashes, parts.md5sums, scripts=parts.scripts)
+
+    @classmethod
+    def inspect(cls, path, **kwargs):
+        """
+        Read only the control data of the .deb at path, through a memory
+        map of the archive; data.tar is never read. Size comes from the
+        file size, and hashes are only computed if they are accessed.
+        Fields can be added or replaced using keyword arguments.
+        """
+        with arfile.DebArchive(path) as deb:
+            parts = deb.control_parts()
+            size = deb.size
+        control = deb822.Deb822(parts.control)
+        control['Size'] = str(size)
+        control.update(kwargs)
+        return cls(control, None, parts.md5sums, scripts=parts.scripts,
+                   path=path)
+
+    @classmethod
+    def parse_md5sums(cls, data):
+        """
+        Parse the raw contents of the md5sums control file
+        """
+        for encoding in cls.ENCODINGS:
+            try:
+                text = data.decode(encoding)
+            except UnicodeDecodeError:
+                continue
+            sums = dict()
+            for line in text.splitlines():
+                if not line.strip():
+                    continue
+                # Spaces are allowed in file names
+                md5, fname = line.split(None, 1)
+                sums[fname] = md5
+            return DebPkgMD5sums(sums, encoding=encoding)
+        # Re-raise last exception if we ran out of encodings to try
+        raise
+
     @classmethod
     def read_md5sums(cls, pkg, path):
         for encoding in cls.ENCODINGS:
@@ -433,5 +676,19 @@ class DebPkg(object):
         # Re-raise last exception if we ran out of encodings to try
         raise
 
-    def dump(self, path):
-        return self.package.dump(path)
+    @property
+    def stanza(self):
+        """
+        The package's Packages stanza, encoded; rendered once and reused
+        until control, hashes, relative_path or update() is used again
+        """
+        if self._stanza is None:
+            buf = BytesIO()
+            self.package.dump(buf)
+            self._stanza = buf.getvalue()
+        return self._stanza
+
+    def dump(self, path=None):
+        if path is None:
+            return self.package.dump()
+        path.write(self.stanza)
@@ -53,6 +53,16 @@ class FileNotFoundError(DebPkgError):
     """The specified file was not found"""
 
 
+class ArchiveError(DebPkgError):
+
+    """The .deb archive is malformed or truncated"""
+
+
+class VerificationError(DebPkgError):
+
+    """A download does not have the expected size or checksum"""
+
+
 def debug_except_hook(type, value, tb):
     print("T-Rex Hates {0}".format(type.__name__))
     print(str(type))
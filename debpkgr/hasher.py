@@ -92,6 +92,69 @@ class HashString(Hasher):
         self.update(data)
 
 
+class HashStream(Hasher):
+    """
+    Wrap a readable file object, hashing every block read through it.
+
+    The number of bytes read so far is available as size, so a single
+    forward pass over a stream yields both its digests and its length.
+    If tee is a writable file object, every block read is also written
+    to it.
+    """
+
+    def __init__(self, fileobj, algorithms=None, tee=None):
+        super(HashStream, self).__init__(algorithms=algorithms)
+        self.fileobj = fileobj
+        self.tee = tee
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.update(data)
+        self.size += len(data)
+        if self.tee is not None and data:
+            self.tee.write(data)
+        return data
+
+    def drain(self, blocksize=65536):
+        """Read (and hash) whatever is left in the stream"""
+        while self.read(blocksize):
+            pass
+        return self.size
+
+
+class HashWriter(Hasher):
+    """
+    Wrap a writable file object, hashing and counting every block written
+    through it, so the digests and size of a file are known as soon as it
+    is written.
+    """
+
+    def __init__(self, fileobj, algorithms=None):
+        super(HashWriter, self).__init__(algorithms=algorithms)
+        self.fileobj = fileobj
+        self.size = 0
+
+    @property
+    def name(self):
+        return getattr(self.fileobj, 'name', None)
+
+    @property
+    def closed(self):
+        return self.fileobj.closed
+
+    def write(self, data):
+        self.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.close()
+
+
 class HashFile(object):
     BLOCKSIZE = 65536
 
@@ -141,15 +204,25 @@ def hash_file(path, algs=['md5', 'sha1', 'sha256']):
     return hasher.digests
 
 
+DEB_HASH_TRANSLATION = dict(md5="MD5sum", sha1="SHA1", sha256="SHA256")
+
+
+def deb_hashes(digests):
+    '''
+    Convert hashlib-style digest names to the Apt Package File syntax
+    '''
+    translation = DEB_HASH_TRANSLATION
+    return dict((translation[x], y) for (x, y) in digests.items()
+                if x in translation)
+
+
 def deb_hash_file(path):
     '''
     Apt Package File uses different syntax
     '''
-    translation = dict(md5="MD5sum", sha1="SHA1", sha256="SHA256")
-    digests = hash_file(path, algs=translation.keys())
+    digests = hash_file(path, algs=DEB_HASH_TRANSLATION.keys())
     # Use the "translated" strings for keys
-    hashes = dict((translation[x], y) for (x, y) in digests.items())
-    return hashes
+    return deb_hashes(digests)
 
 
 def hash_string(data, algs=['md5', 'sha1', 'sha256']):
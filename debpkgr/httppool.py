@@ -0,0 +1,223 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Pooled HTTP/1.1 keep-alive connections
+
+Opening a connection per request makes fetching many small files from a
+mirror mostly a matter of TCP (and TLS) handshakes. ConnectionPool keeps
+the connection of every fully read response open, and hands it to the
+next request for the same scheme, host and port.
+'''
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import logging
+import socket
+import threading
+
+from .compat import HTTPError
+from .compat import getproxies
+from .compat import http_client
+from .compat import proxy_bypass
+from .compat import urljoin
+from .compat import urlopen
+from .compat import urlsplit
+
+log = logging.getLogger(__name__)
+
+MAX_REDIRECTS = 5
+_Redirects = (301, 302, 303, 307, 308)
+_Default_Ports = dict(http=80, https=443)
+
+
+class PooledResponse(object):
+    """
+    A file-like response body. Its connection goes back to the pool as
+    soon as the body was read to the end; closing the response before
+    that discards the connection.
+    """
+
+    def __init__(self, pool, key, conn, response, url):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.url = url
+        self.status = response.status
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def info(self):
+        return self._response.msg
+
+    def getcode(self):
+        return self.status
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._response.read()
+        else:
+            data = self._response.read(size)
+        if self._response.isclosed():
+            self._release()
+        return data
+
+    def _release(self):
+        if self._conn is None:
+            return
+        if self._response.will_close:
+            self._conn.close()
+        else:
+            self._pool._put(self._key, self._conn)
+        self._conn = None
+
+    def close(self):
+        if self._conn is not None:
+            # The rest of the body is still on the wire
+            self._conn.close()
+            self._conn = None
+        self._response.close()
+
+
+class ConnectionPool(object):
+    """
+    Keeps up to maxsize idle connections per scheme, host and port.
+    The pool can be shared between threads; a connection is only used by
+    one request at a time.
+
+    URLs that are not http or https, and URLs the environment sets a
+    proxy for (http_proxy, https_proxy and no_proxy), are opened with
+    urllib instead.
+    """
+    MAXSIZE = 4
+
+    def __init__(self, maxsize=None, timeout=None):
+        self.maxsize = maxsize or self.MAXSIZE
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = dict()
+        # Number of connections opened so far
+        self.connections = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def urlopen(self, url):
+        """
+        GET url, following redirects. Returns a PooledResponse, or raises
+        HTTPError for error statuses.
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            if parts.scheme not in _Default_Ports or _proxied(parts):
+                return urlopen(url)
+            response = self._request(url, parts)
+            if response.status in _Redirects and \
+                    response.info().get('Location'):
+                # Read the (small) body so the connection can be reused
+                response.read()
+                url = urljoin(url, response.info().get('Location'))
+                continue
+            if response.status >= 400:
+                response.read()
+                raise HTTPError(url, response.status,
+                                response._response.reason,
+                                response.info(), None)
+            return response
+        raise HTTPError(url, response.status, "Too many redirects",
+                        response.info(), None)
+
+    def _request(self, url, parts):
+        key = (parts.scheme, parts.hostname,
+               parts.port or _Default_Ports[parts.scheme])
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        while True:
+            conn, reused = self._get(key)
+            try:
+                conn.request('GET', path,
+                             headers={'Accept-Encoding': 'identity'})
+                response = conn.getresponse()
+            except (http_client.HTTPException, socket.error):
+                conn.close()
+                if reused:
+                    # The server closed the idle connection; try another
+                    log.debug("Stale connection to %s:%s", key[1], key[2])
+                    continue
+                raise
+            return PooledResponse(self, key, conn, response, url)
+
+    def _get(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+            self.connections += 1
+        scheme, host, port = key
+        if scheme == 'https':
+            factory = http_client.HTTPSConnection
+        else:
+            factory = http_client.HTTPConnection
+        kwargs = dict()
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        return factory(host, port, **kwargs), False
+
+    def _put(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, dict()
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+def _proxied(parts):
+    if parts.scheme not in getproxies():
+        return False
+    # Host and port, as urllib checks them
+    return not proxy_bypass(parts.netloc.rpartition('@')[2])
+
+
+_Default_Pool = None
+_Default_Pool_Lock = threading.Lock()
+
+
+def default_pool():
+    """Return the pool shared by all downloads of this process"""
+    global _Default_Pool
+    with _Default_Pool_Lock:
+        if _Default_Pool is None:
+            _Default_Pool = ConnectionPool()
+        return _Default_Pool
@@ -0,0 +1,358 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Fast parser for Packages (and Release) paragraphs
+
+Paragraphs are located with a single regular expression over the raw
+bytes, and a paragraph's fields are only split out, and its values only
+decoded, when they are first accessed. Values are the same strings
+deb822 would produce, and dump() writes the same bytes as deb822 dump()
+for UTF-8 input.
+
+If fields is specified, only those fields (matched case-sensitively, as
+with deb822) are extracted, by searching for them in the raw paragraph
+instead of splitting every line.
+'''
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import io
+import mmap
+import re
+from collections import OrderedDict
+
+from six.moves import collections_abc
+
+from debian import deb822
+
+# A blank (or whitespace-only) line ends a paragraph
+_Separator = re.compile(br'\n(?:[ \t\r\f\v]*\n)+')
+_Blank_Lines = re.compile(br'(?:[ \t\r\f\v]*\n)*')
+_Continuation = (b' ', b'\t')
+# Streams that cannot be mapped are read in blocks of this size
+BLOCKSIZE = 1 << 20
+_Comment = b'#'
+
+
+def _decode(value, encoding):
+    try:
+        return value.decode(encoding)
+    except UnicodeDecodeError:
+        return value.decode('latin-1')
+
+
+def iter_spans(data, start=0):
+    """
+    Yield the (start, end) offsets of the paragraphs in data, a bytes-like
+    object supporting the buffer protocol (e.g. an mmap). end includes the
+    newline that terminates the last line of the paragraph.
+    """
+    pos = _Blank_Lines.match(data, start).end()
+    for m in _Separator.finditer(data, pos):
+        yield pos, m.start() + 1
+        pos = m.end()
+    end = len(data)
+    if pos < end and data[pos:end].strip():
+        yield pos, end
+
+
+def iter_paragraphs(source, fields=None, encoding='utf-8'):
+    """
+    Yield a Paragraph for every paragraph in source, which is either
+    bytes or a file object. Regular files are memory-mapped rather than
+    read; other file objects (e.g. decompressing ones) are read from their
+    current position, a block at a time.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        for start, end in iter_spans(source):
+            yield Paragraph(source[start:end], fields=fields,
+                            encoding=encoding)
+        return
+    data = _map(source)
+    if data is None:
+        for para in _iter_stream(source, fields, encoding):
+            yield para
+        return
+    try:
+        for start, end in iter_spans(data):
+            yield Paragraph(data[start:end], fields=fields,
+                            encoding=encoding)
+    finally:
+        data.close()
+
+
+def _iter_stream(fileobj, fields, encoding):
+    tail = b''
+    while True:
+        block = fileobj.read(BLOCKSIZE)
+        if not block:
+            break
+        if not isinstance(block, bytes):
+            block = block.encode(encoding)
+        data = tail + block
+        pos = _Blank_Lines.match(data).end()
+        for m in _Separator.finditer(data, pos):
+            yield Paragraph(data[pos:m.start() + 1], fields=fields,
+                            encoding=encoding)
+            pos = m.end()
+        # The paragraph at the end may continue in the next block
+        tail = data[pos:]
+    for start, end in iter_spans(tail):
+        yield Paragraph(tail[start:end], fields=fields, encoding=encoding)
+
+
+def _map(fileobj):
+    # Only plain files: compressed streams have a fileno() too
+    raw = getattr(fileobj, 'buffer', fileobj)
+    raw = getattr(raw, 'raw', raw)
+    if not isinstance(raw, io.FileIO):
+        return None
+    try:
+        return mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, mmap.error):
+        # Empty file, or not something that can be mapped
+        return None
+
+
+# Field name -> (name, lower-cased name); field names repeat a lot
+_Names = dict()
+_Max_Names = 1024
+
+
+def _add(fields, name, value):
+    try:
+        text, key = _Names[name]
+    except KeyError:
+        text = name.rstrip().decode('latin-1')
+        key = text.lower()
+        if len(_Names) < _Max_Names:
+            _Names[name] = (text, key)
+    # The last occurrence wins, but keeps the first one's position
+    fields[key] = (text, value)
+
+
+class Paragraph(collections_abc.Mapping):
+    """
+    One paragraph, as a read-only mapping with case-insensitive keys.
+    raw holds the bytes of the paragraph as found in the file.
+    """
+    __slots__ = ['raw', 'encoding', '_wanted', '_fields', '_values']
+
+    def __init__(self, raw, fields=None, encoding='utf-8'):
+        self.raw = raw
+        self.encoding = encoding
+        self._wanted = fields
+        # Lower-cased name -> (name, value bytes), in file order
+        self._fields = None
+        self._values = dict()
+
+    def __repr__(self):
+        return 'Paragraph(%r)' % (self.raw, )
+
+    def _parsed(self):
+        if self._fields is None:
+            if self._wanted is None:
+                self._fields = self._split()
+            else:
+                self._fields = self._project(self._wanted)
+        return self._fields
+
+    def _split(self):
+        fields = OrderedDict()
+        raw = self.raw
+        lines = raw.split(b'\n')
+        if b'\r' in raw:
+            lines = [x.rstrip(b'\r') for x in lines]
+        name = value = None
+        for line in lines:
+            first = line[:1]
+            if not first or first == _Comment:
+                continue
+            if first in _Continuation:
+                if name is not None and line.strip():
+                    value += b'\n' + line
+                continue
+            colon = line.find(b':')
+            if colon <= 0:
+                continue
+            if name is not None:
+                _add(fields, name, value)
+            name = line[:colon]
+            value = line[colon + 1:].strip()
+        if name is not None:
+            _add(fields, name, value)
+        return fields
+
+    def _project(self, wanted):
+        raw = self.raw
+        found = []
+        for name in wanted:
+            key = name.encode('latin-1') + b':'
+            pos = raw.rfind(b'\n' + key)
+            if pos >= 0:
+                pos += 1
+            elif raw.startswith(key):
+                pos = 0
+            else:
+                continue
+            end = raw.find(b'\n', pos)
+            if end < 0:
+                end = len(raw)
+            value = raw[pos + len(key):end].strip()
+            # Continuation lines
+            while raw[end + 1:end + 2] in _Continuation + (_Comment, ):
+                start = end + 1
+                end = raw.find(b'\n', start)
+                if end < 0:
+                    end = len(raw)
+                line = raw[start:end].rstrip(b'\r')
+                if line[:1] != _Comment and line.strip():
+                    value += b'\n' + line
+            found.append((pos, name, value))
+        fields = OrderedDict()
+        for _, name, value in sorted(found):
+            _add(fields, name.encode('latin-1'), value)
+        return fields
+
+    def __getitem__(self, key):
+        key = key.lower()
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        value = _decode(self._parsed()[key][1], self.encoding)
+        self._values[key] = value
+        return value
+
+    def __contains__(self, key):
+        return key.lower() in self._parsed()
+
+    def __iter__(self):
+        return (name for name, _ in self._parsed().values())
+
+    def __len__(self):
+        return len(self._parsed())
+
+    def __eq__(self, other):
+        if not isinstance(other, collections_abc.Mapping):
+            return NotImplemented
+        if sorted(x.lower() for x in self) != sorted(x.lower() for x in other):
+            return False
+        return all(self[x] == other[x] for x in other)
+
+    def __ne__(self, other):
+        ret = self.__eq__(other)
+        if ret is NotImplemented:
+            return ret
+        return not ret
+
+    __hash__ = None
+
+    def get_raw(self, key):
+        """Return the undecoded value of key"""
+        return self._parsed()[key.lower()][1]
+
+    def to_deb822(self, cls=deb822.Packages):
+        """Return the paragraph as a deb822 object of class cls"""
+        return cls(OrderedDict(self.items()))
+
+    def dump(self, fd=None, text_mode=False):
+        """
+        Write the paragraph to fd, in the format deb822 uses. If fd is
+        None, return it as a string instead.
+        """
+        out = []
+        for name, value in self._parsed().values():
+            name = name.encode('latin-1')
+            if not value or value[:1] == b'\n':
+                out.append(name + b':' + value + b'\n')
+            else:
+                out.append(name + b': ' + value + b'\n')
+        data = b''.join(out)
+        if fd is None:
+            return _decode(data, self.encoding)
+        if text_mode:
+            fd.write(_decode(data, self.encoding))
+        else:
+            fd.write(data)
+
+
+class ParagraphIndex(object):
+    """
+    Offsets of the paragraphs of a file, by the value of one field (the
+    package name by default), so single paragraphs can be looked up
+    without parsing the rest of the file.
+
+    Regular files stay memory-mapped until close(); other file objects,
+    such as decompressing streams, are read into memory.
+    """
+
+    def __init__(self, fileobj, field='Package', encoding='utf-8'):
+        self.field = field
+        self.encoding = encoding
+        self._data = _map(fileobj)
+        if self._data is None:
+            fileobj.seek(0)
+            data = fileobj.read()
+            if not isinstance(data, bytes):
+                data = data.encode(encoding)
+            self._data = data
+        # value -> [(offset, length)]
+        self._offsets = dict()
+        self._build()
+
+    def _build(self):
+        field = re.escape(self.field.encode('latin-1'))
+        regex = re.compile(br'^' + field + br'[ \t]*:[ \t]*(\S+)',
+                           re.MULTILINE)
+        data = self._data
+        offsets = self._offsets
+        for start, end in iter_spans(data):
+            m = regex.search(data, start, end)
+            if m is None:
+                continue
+            value = _decode(m.group(1), self.encoding)
+            offsets.setdefault(value, []).append((start, end - start))
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, value):
+        return value in self._offsets
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def offsets(self, value):
+        """Return the (offset, length) of the paragraphs for value"""
+        return list(self._offsets.get(value, []))
+
+    def lookup(self, value, fields=None):
+        """Return the paragraphs for value, in file order"""
+        ret = []
+        for offset, length in self._offsets.get(value, []):
+            para = Paragraph(self._data[offset:offset + length],
+                             fields=fields, encoding=self.encoding)
+            ret.append(para)
+        return ret
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._data = b''
+        self._offsets = dict()
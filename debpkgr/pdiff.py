@@ -0,0 +1,336 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Apt PDiff generation
+
+Every time a Packages file changes, an ed script turning the previous
+version into the new one is stored (gzipped) in Packages.diff/, and listed
+in Packages.diff/Index, so apt clients only download the patches they are
+missing instead of the whole index.
+
+Files are compared a stanza at a time, which keeps difflib fast on large
+indices; the resulting scripts still address individual lines. Only a
+digest of every stanza is kept in memory: the files themselves are
+memory-mapped, and patches are compressed as they are generated.
+'''
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import contextlib
+import difflib
+import gzip
+import hashlib
+import io
+import mmap
+import os
+import re
+import time
+from collections import namedtuple
+
+from . import utils
+from .hasher import HashWriter
+from .hasher import hash_file
+from .hasher import hash_string
+
+INDEX = 'Index'
+DIFF_DIR_SUFFIX = '.diff'
+PATCH_NAME_FORMAT = '%Y-%m-%d-%H%M.%S'
+
+# hashlib name, Index field prefix
+_Hash_Algorithms = (('sha1', 'SHA1'), ('sha256', 'SHA256'))
+_Algorithms = [x for x, _ in _Hash_Algorithms]
+
+# digests maps hashlib names to hex digests
+FileInfo = namedtuple("FileInfo", "digests size")
+# history describes the Packages file the patch applies to, patch the
+# uncompressed ed script and download the gzipped one
+PatchEntry = namedtuple("PatchEntry", "name history patch download")
+
+
+def file_info(data):
+    return FileInfo(hash_string(data, algs=_Algorithms), len(data))
+
+
+def path_info(path):
+    return FileInfo(hash_file(path, algs=_Algorithms),
+                    os.stat(path).st_size)
+
+
+# A blank line ends a stanza, and belongs to it
+_Blank_Line = re.compile(br'^\r?\n', re.MULTILINE)
+# Bodies are copied out of the new file this much at a time
+_Block_Size = 1 << 20
+
+
+def stanza_spans(data):
+    """
+    Return the (start, end) offsets of the stanzas in data (bytes or an
+    mmap), and the number of lines in each.
+    """
+    spans = []
+    lines = []
+    ends = [m.end() for m in _Blank_Line.finditer(data)]
+    if (ends[-1] if ends else 0) < len(data):
+        ends.append(len(data))
+    pos = 0
+    for end in ends:
+        stanza = data[pos:end]
+        spans.append((pos, end))
+        lines.append(stanza.count(b'\n') + (not stanza.endswith(b'\n')))
+        pos = end
+    return spans, lines
+
+
+def _stanza_keys(data, spans):
+    return [hashlib.sha1(data[x:y]).digest() for x, y in spans]
+
+
+def write_diff(old, new, fileobj):
+    """
+    Write an ed script turning old into new (bytes or mmaps) to fileobj.
+    Commands are emitted from the end of the file backwards, so line
+    numbers always refer to the original file, as apt expects.
+    """
+    old_spans, old_lines = stanza_spans(old)
+    new_spans, _ = stanza_spans(new)
+    # Line number (0-based) at which each old stanza starts
+    offsets = [0]
+    for count in old_lines:
+        offsets.append(offsets[-1] + count)
+
+    matcher = difflib.SequenceMatcher(None, _stanza_keys(old, old_spans),
+                                      _stanza_keys(new, new_spans),
+                                      autojunk=False)
+    for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+        if tag == 'equal':
+            continue
+        first, last = offsets[i1] + 1, offsets[i2]
+        if first == last:
+            lines = '%d' % first
+        else:
+            lines = '%d,%d' % (first, last)
+        if tag == 'delete':
+            fileobj.write((lines + 'd\n').encode('ascii'))
+            continue
+        if tag == 'insert':
+            fileobj.write(('%da\n' % offsets[i1]).encode('ascii'))
+        else:
+            fileobj.write((lines + 'c\n').encode('ascii'))
+        start, end = new_spans[j1][0], new_spans[j2 - 1][1]
+        for pos in range(start, end, _Block_Size):
+            fileobj.write(new[pos:min(pos + _Block_Size, end)])
+        if new[end - 1:end] != b'\n':
+            fileobj.write(b'\n')
+        fileobj.write(b'.\n')
+
+
+def diff(old, new):
+    """Return an ed script (as bytes) turning old into new"""
+    buf = io.BytesIO()
+    write_diff(old, new, buf)
+    return buf.getvalue()
+
+
+def _split_lines(data):
+    # Lines end with \n only, as for ed and apt
+    lines = data.split(b'\n')
+    last = lines.pop()
+    ret = [x + b'\n' for x in lines]
+    if last:
+        ret.append(last)
+    return ret
+
+
+_Ed_Command = re.compile(br'^(\d+)(?:,(\d+))?([acd])$')
+
+
+def apply_patch(old, script):
+    """Apply an ed script as produced by diff() to old"""
+    lines = _split_lines(old)
+    script = _split_lines(script)
+    pos = 0
+    while pos < len(script):
+        m = _Ed_Command.match(script[pos].rstrip(b'\n'))
+        if m is None:
+            raise ValueError("Invalid ed command: %r" % script[pos])
+        pos += 1
+        first = int(m.group(1))
+        last = int(m.group(2) or first)
+        cmd = m.group(3)
+        body = []
+        if cmd in (b'a', b'c'):
+            while script[pos] != b'.\n':
+                body.append(script[pos])
+                pos += 1
+            pos += 1
+        if cmd == b'a':
+            lines[first:first] = body
+        else:
+            lines[first - 1:last] = body
+    return b''.join(lines)
+
+
+class PDiffIndex(object):
+    """
+    Contents of a Packages.diff/Index file; history holds PatchEntry
+    objects, oldest first.
+    """
+
+    def __init__(self, current=None, history=None):
+        self.current = current
+        self.history = history or []
+
+    @classmethod
+    def load(cls, path):
+        """Parse the Index at path; a missing file yields an empty index"""
+        try:
+            with open(path, 'rb') as fh:
+                data = fh.read().decode('utf-8')
+        except (IOError, OSError):
+            return cls()
+        fields = dict()
+        key = None
+        for line in data.splitlines():
+            if line.startswith(' ') and key is not None:
+                fields[key].append(line.split())
+            elif ':' in line:
+                key, _, value = line.partition(':')
+                value = value.split()
+                fields[key] = [value] if value else []
+        sizes = dict()
+        current = dict()
+        entries = dict()
+        for alg, prefix in _Hash_Algorithms:
+            for digest, size in fields.get(prefix + '-Current', []):
+                current[alg] = digest
+                sizes['current'] = int(size)
+            for kind in ['History', 'Patches', 'Download']:
+                for digest, size, name in fields.get(
+                        prefix + '-' + kind, []):
+                    if kind == 'Download' and name.endswith('.gz'):
+                        name = name[:-3]
+                    info = entries.setdefault(name, dict()).setdefault(
+                        kind, FileInfo(dict(), int(size)))
+                    info.digests[alg] = digest
+        if 'current' not in sizes:
+            return cls()
+        history = []
+        # History is kept in order; the other lists have the same names
+        for digest, size, name in fields.get('SHA256-History',
+                                             fields.get('SHA1-History', [])):
+            kinds = entries[name]
+            if 'Patches' not in kinds or 'Download' not in kinds:
+                # Incomplete; start the history over
+                history = []
+                break
+            history.append(PatchEntry(name, kinds['History'],
+                                      kinds['Patches'], kinds['Download']))
+        return cls(FileInfo(current, sizes['current']), history)
+
+    def dumps(self):
+        out = []
+        for alg, prefix in _Hash_Algorithms:
+            out.append('%s-Current: %s %d\n' % (
+                prefix, self.current.digests[alg], self.current.size))
+        for kind, attr, suffix in [('History', 'history', ''),
+                                   ('Patches', 'patch', ''),
+                                   ('Download', 'download', '.gz')]:
+            for alg, prefix in _Hash_Algorithms:
+                out.append('%s-%s:\n' % (prefix, kind))
+                for entry in self.history:
+                    info = getattr(entry, attr)
+                    out.append(' %s %d %s%s\n' % (
+                        info.digests[alg], info.size, entry.name, suffix))
+        return ''.join(out).encode('utf-8')
+
+
+def update(packages_path, old_path, new_path, max_history, now=None):
+    """
+    Record the change of the Packages file at packages_path from the file
+    at old_path to the one at new_path (old_path is None if there was no
+    previous version), keeping at most max_history patches.
+
+    Returns the path of the Index file.
+    """
+    diff_dir = utils.makedirs(packages_path + DIFF_DIR_SUFFIX)
+    index_path = os.path.join(diff_dir, INDEX)
+    index = PDiffIndex.load(index_path)
+    new_info = path_info(new_path)
+
+    if old_path is not None:
+        old_info = path_info(old_path)
+        if index.current is not None and \
+                index.current.digests != old_info.digests:
+            # The chain was broken, e.g. by an edit outside of debpkgr;
+            # the old patches do not lead to the new file
+            index.history = []
+        if old_info.digests != new_info.digests:
+            with _mapped(old_path) as old, _mapped(new_path) as new:
+                index.history.append(
+                    _write_patch(diff_dir, old, new, old_info, index, now))
+    else:
+        index.history = []
+
+    index.history = index.history[-max_history:] if max_history else []
+    index.current = new_info
+    keep = set(x.name + '.gz' for x in index.history)
+    keep.add(INDEX)
+    for fname in os.listdir(diff_dir):
+        path = os.path.join(diff_dir, fname)
+        # Directories, such as by-hash/, are not ours to clean up
+        if fname not in keep and not os.path.isdir(path):
+            os.unlink(path)
+
+    with utils.AtomicFile(index_path) as fh:
+        fh.write(index.dumps())
+    return index_path
+
+
+@contextlib.contextmanager
+def _mapped(path):
+    with open(path, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            # Empty files cannot be mapped
+            yield b''
+            return
+        data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield data
+        finally:
+            data.close()
+
+
+def _write_patch(diff_dir, old, new, old_info, index, now):
+    if now is None:
+        now = time.time()
+    name = base = time.strftime(PATCH_NAME_FORMAT, time.gmtime(now))
+    names = set(x.name for x in index.history)
+    serial = 0
+    while name in names:
+        serial += 1
+        name = '%s-%d' % (base, serial)
+    with utils.AtomicFile(os.path.join(diff_dir, name + '.gz')) as fh:
+        download = HashWriter(fh, algorithms=_Algorithms)
+        # A fixed mtime keeps the download reproducible
+        with gzip.GzipFile(filename='', mode='wb', fileobj=download,
+                           mtime=0) as gz:
+            patch = HashWriter(gz, algorithms=_Algorithms)
+            write_diff(old, new, patch)
+    return PatchEntry(name, old_info,
+                      FileInfo(patch.digests, patch.size),
+                      FileInfo(download.digests, download.size))
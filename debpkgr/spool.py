@@ -0,0 +1,160 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+On-disk spool of encoded Packages stanzas
+
+Stanzas are appended to run files instead of being kept in memory. If a
+sort key is given, runs of up to run_size stanzas are sorted before being
+written, and iterating merges the runs; memory use is bounded by run_size
+either way.
+'''
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import heapq
+import logging
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+
+log = logging.getLogger(__name__)
+
+# Lengths of the sort key and of the stanza
+_Record_Header = struct.Struct('>II')
+
+
+class SpooledStanza(object):
+    """A stanza read back from a spool; dump() writes it to a file"""
+    __slots__ = ['stanza']
+
+    def __init__(self, stanza):
+        self.stanza = stanza
+
+    def dump(self, fd):
+        fd.write(self.stanza)
+
+
+class StanzaSpool(object):
+    """
+    Iterating yields SpooledStanza objects, in the order the stanzas were
+    added or in key order; the spool can be iterated several times.
+    The run files live in a private directory under directory (the system
+    default if not specified), removed by close().
+    """
+    RUN_SIZE = 10000
+    BUFSIZE = 1 << 20
+
+    def __init__(self, directory=None, run_size=None):
+        if run_size is None:
+            run_size = self.RUN_SIZE
+        self.run_size = run_size
+        self.runs = []
+        self._pending = []
+        self._count = 0
+        self._fobj = None
+        # Set first, so close() works even if mkdtemp fails
+        self.directory = None
+        self.directory = tempfile.mkdtemp(prefix='debpkgr-spool-',
+                                          dir=directory)
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        self._flush()
+        if self._fobj is not None:
+            self._fobj.flush()
+        readers = [self._read_run(x, i) for i, x in enumerate(self.runs)]
+        if len(readers) == 1:
+            merged = readers[0]
+        else:
+            # Ties are broken by run, then by position in the run, which
+            # keeps the sort stable
+            merged = heapq.merge(*readers)
+        for _, _, _, stanza in merged:
+            yield SpooledStanza(stanza)
+
+    def add(self, stanza, key=None):
+        """
+        Append an encoded stanza. If key is specified, iteration yields
+        stanzas in key order; keys must be comparable and picklable, and
+        either all or none of the stanzas must have one.
+        """
+        self._count += 1
+        if key is None:
+            self._write(self._current_run(), b'', stanza)
+            return
+        self._pending.append((key, len(self._pending), stanza))
+        if len(self._pending) >= self.run_size:
+            self._flush()
+
+    def close(self):
+        if self._fobj is not None:
+            self._fobj.close()
+            self._fobj = None
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+        self.runs = []
+
+    def __del__(self):
+        self.close()
+
+    def _current_run(self):
+        if self._fobj is None:
+            path = os.path.join(self.directory, 'run-%d' % len(self.runs))
+            self.runs.append(path)
+            self._fobj = open(path, 'wb', self.BUFSIZE)
+        return self._fobj
+
+    def _flush(self):
+        # Write out the pending stanzas as a sorted run of their own
+        if not self._pending:
+            return
+        self._pending.sort(key=lambda x: (x[0], x[1]))
+        if self._fobj is not None:
+            self._fobj.close()
+            self._fobj = None
+        fobj = self._current_run()
+        for key, _, stanza in self._pending:
+            self._write(fobj, pickle.dumps(key, protocol=2), stanza)
+        fobj.close()
+        self._fobj = None
+        log.debug("Spooled a run of %d stanzas", len(self._pending))
+        self._pending = []
+
+    @staticmethod
+    def _write(fobj, key, stanza):
+        fobj.write(_Record_Header.pack(len(key), len(stanza)))
+        fobj.write(key)
+        fobj.write(stanza)
+
+    def _read_run(self, path, index):
+        with open(path, 'rb', self.BUFSIZE) as fobj:
+            position = 0
+            while True:
+                header = fobj.read(_Record_Header.size)
+                if not header:
+                    break
+                key_len, stanza_len = _Record_Header.unpack(header)
+                key = fobj.read(key_len)
+                key = pickle.loads(key) if key else None
+                yield key, index, position, fobj.read(stanza_len)
+                position += 1
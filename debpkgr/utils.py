@@ -15,22 +15,51 @@
 #
 
 from __future__ import unicode_literals
+import binascii
 import codecs
+import errno
+import logging
 import os
 import re
+import shutil
+import stat
 import string
+import tempfile
+import threading
 from collections import namedtuple
 
+from concurrent import futures
+
 from .compat import urlsplit
+from .compat import urlopen
 from .compat import urlretrieve
 from .compat import HTTPError
+from . import httppool
 from .errors import FileNotFoundError
+from .errors import VerificationError
+from .hasher import Hasher
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging.getLogger(__name__)
 
 ENV_NAME_RE = re.compile(r'_{2,}')
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
 utf8writer = codecs.getwriter('utf-8')
 
 
 DownloadRequest = namedtuple("DownloadRequest", "url destination data")
+# error is None if the download succeeded
+DownloadResult = namedtuple("DownloadResult", "request error")
+
+DOWNLOAD_BLOCKSIZE = 65536
+# hashlib name and DownloadRequest.data key, strongest first
+_Download_Checksums = (('sha256', 'sha256'), ('sha1', 'sha1'),
+                       ('md5', 'md5sum'))
 
 
 def local_path_from_url(url):
@@ -46,7 +75,7 @@ def local_path_from_url(url):
 
 def _to_url(uri):
     res = urlsplit(uri)
-    if not res.netloc:
+    if not res.scheme and not res.netloc:
         return 'file://' + os.path.abspath(uri)
     return uri
 
@@ -63,7 +92,161 @@ def opener(path, destination=None):
     return fh
 
 
-def download(requests):
+def expected_checksum(data):
+    """
+    Return the expected size (or None) and the (hashlib name, digest) of
+    the strongest checksum (or None) found in DownloadRequest data, as
+    taken from a Release file
+    """
+    if not data:
+        return None, None
+    size = data.get('size')
+    if size is not None:
+        size = int(size)
+    for alg, key in _Download_Checksums:
+        if data.get(key):
+            return size, (alg, data[key])
+    return size, None
+
+
+def fetch(path, destination, size=None, checksum=None, pool=None):
+    """
+    Copy path (a URL or a local path) to destination, a file name or a
+    writable file object, hashing the bytes as they arrive. If pool (an
+    httppool.ConnectionPool) is specified, HTTP URLs are fetched over its
+    persistent connections.
+
+    If size is specified, the transfer is aborted with a VerificationError
+    as soon as more bytes arrive, and fails if fewer did. If checksum, a
+    (hashlib name, hex digest) tuple, is specified, the digest is checked
+    once the transfer completes. A destination file name is only created
+    if the download succeeds.
+
+    Returns the number of bytes copied.
+    """
+    url = _to_url(path)
+    try:
+        if pool is None:
+            src = urlopen(url)
+        else:
+            src = pool.urlopen(url)
+    except HTTPError as e:
+        raise FileNotFoundError('Failed to open %s with %s %s' % (
+            path, e.code, e.reason))
+    try:
+        announced = src.info().get('Content-Length')
+        if size is not None and announced is not None and \
+                int(announced) != size:
+            raise VerificationError(
+                "%s: size is %s, expected %d" % (path, announced, size))
+        if hasattr(destination, 'write'):
+            return _copy(path, src, destination, size, checksum)
+        with AtomicFile(destination) as fobj:
+            return _copy(path, src, fobj, size, checksum)
+    finally:
+        src.close()
+
+
+def _copy(path, src, dst, size, checksum):
+    hasher = Hasher(algorithms=[checksum[0]]) if checksum else None
+    received = 0
+    while True:
+        buf = src.read(DOWNLOAD_BLOCKSIZE)
+        if not buf:
+            break
+        received += len(buf)
+        if size is not None and received > size:
+            raise VerificationError(
+                "%s: more than the expected %d bytes" % (path, size))
+        if hasher is not None:
+            hasher.update(buf)
+        dst.write(buf)
+    if size is not None and received != size:
+        raise VerificationError(
+            "%s: got %d bytes, expected %d" % (path, received, size))
+    if hasher is not None and hasher.digests[checksum[0]] != checksum[1]:
+        raise VerificationError("%s: %s checksum did not match" % (
+            path, checksum[0]))
+    return received
+
+
+def download_one(req, pool=None):
+    """
+    Download a single DownloadRequest, through pool if specified.
+
+    If its data holds the size or a checksum of the file (as with
+    requests built from a Release file), they are verified while
+    downloading (see fetch) and data['verified'] is set to True.
+    """
+    size, checksum = expected_checksum(req.data)
+    fetch(req.url, req.destination, size=size, checksum=checksum,
+          pool=pool)
+    if size is not None or checksum is not None:
+        req.data['verified'] = True
+    return req
+
+
+class Downloader(object):
+    """
+    Run DownloadRequests concurrently: at most workers at a time, and at
+    most per_host at a time from any single host (local files count as
+    one host).
+
+    download() never raises for a failed request; it returns a
+    DownloadResult for every request, in order.
+
+    HTTP requests reuse the keep-alive connections of pool, which
+    defaults to the one shared by the whole process
+    (httppool.default_pool()).
+    """
+    WORKERS = 4
+    PER_HOST = 2
+
+    def __init__(self, workers=None, per_host=None, pool=None):
+        self.workers = workers or self.WORKERS
+        self.per_host = per_host or self.PER_HOST
+        if pool is None:
+            pool = httppool.default_pool()
+        self.pool = pool
+        self._lock = threading.Lock()
+        self._hosts = dict()
+
+    def _host_slots(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            slots = self._hosts.get(host)
+            if slots is None:
+                slots = threading.BoundedSemaphore(self.per_host)
+                self._hosts[host] = slots
+        return slots
+
+    def fetch(self, req):
+        with self._host_slots(req.url):
+            try:
+                download_one(req, pool=self.pool)
+            except Exception as e:
+                log.warning("Failed to download %s: %s", req.url, e)
+                return DownloadResult(req, e)
+        return DownloadResult(req, None)
+
+    def download(self, requests):
+        requests = list(requests)
+        if self.workers <= 1 or len(requests) <= 1:
+            return [self.fetch(x) for x in requests]
+        workers = min(self.workers, len(requests))
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(self.fetch, requests))
+
+
+def check_downloads(results):
+    """Raise the error of the first failed DownloadResult in results"""
+    for result in results:
+        if result.error is not None:
+            raise result.error
+    return results
+
+
+def download(requests, workers=1, per_host=None):
     """
     Initiate multiple downloads.
     requests is a list of DownloadRequest objects.
@@ -72,13 +255,216 @@ def download(requests):
     * destination: a destination file or file descriptor
     * data: additional information passed back to the caller at the end of the
     download.
+
+    Up to workers requests are run at a time (see Downloader). All of them
+    are attempted; the first error, if any, is raised afterwards.
     """
-    for req in requests:
-        dest = req.destination
-        opener(req.url, dest)
+    requests = list(requests)
+    check_downloads(Downloader(workers=workers,
+                               per_host=per_host).download(requests))
     return requests
 
 
+class AtomicFile(object):
+    """
+    A file written under a temporary name next to path, and renamed over
+    path (or another name in the same directory) on commit().
+    Readers never see a partially written file.
+
+    Used as a context manager, the file is committed if the block
+    completes and discarded if it raises.
+    """
+
+    def __init__(self, path, mode='wb', perms=0o644):
+        self.path = path
+        self.perms = perms
+        dirname, basename = os.path.split(os.path.abspath(path))
+        self._fobj = tempfile.NamedTemporaryFile(
+            mode=mode, dir=dirname, prefix='.' + basename + '.',
+            delete=False)
+        self.name = self._fobj.name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+    def write(self, data):
+        return self._fobj.write(data)
+
+    def flush(self):
+        return self._fobj.flush()
+
+    def fileno(self):
+        return self._fobj.fileno()
+
+    @property
+    def closed(self):
+        return self.name is None
+
+    def commit(self, path=None):
+        if self.name is None:
+            # Already committed or aborted
+            return None
+        if path is None:
+            path = self.path
+        self._fobj.close()
+        os.chmod(self.name, self.perms)
+        os.rename(self.name, path)
+        self.name = None
+        return path
+
+    def abort(self):
+        if self.name is None:
+            return
+        self._fobj.close()
+        os.unlink(self.name)
+        self.name = None
+
+
+def hardlink_file(src, dst):
+    """
+    Hard link src to dst, replacing dst atomically if it exists.
+    Fails with EXDEV if both are not on the same device.
+    """
+    dirname, basename = os.path.split(os.path.abspath(dst))
+    while True:
+        tmp = os.path.join(dirname, '.%s.%s' % (
+            basename, binascii.hexlify(os.urandom(6)).decode('ascii')))
+        try:
+            # os.link refuses to overwrite, so a name collision can't
+            # clobber anything
+            os.link(src, tmp)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                continue
+            raise
+        break
+    try:
+        os.rename(tmp, dst)
+    except OSError:
+        os.unlink(tmp)
+        raise
+
+
+def _new_file(src, dst):
+    # Copies are written to a new file renamed over dst: writing into dst
+    # would also change any file dst is a hard link to
+    perms = stat.S_IMODE(os.stat(src).st_mode)
+    return AtomicFile(dst, perms=perms)
+
+
+def reflink_file(src, dst):
+    """
+    Clone src into dst with the FICLONE ioctl (btrfs, XFS, ...): the new
+    file shares its extents with src until either one is modified.
+    """
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "FICLONE not supported")
+    with open(src, 'rb') as fsrc:
+        with _new_file(src, dst) as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def copy_file(src, dst):
+    """Copy src to dst in user space"""
+    with open(src, 'rb') as fsrc:
+        with _new_file(src, dst) as fdst:
+            shutil.copyfileobj(fsrc, fdst)
+
+
+def kernel_copy_file(src, dst):
+    """
+    Copy src to dst without moving the data through user space, using
+    copy_file_range(2) or, failing that, sendfile(2).
+    """
+    copiers = [getattr(os, x) for x in ('copy_file_range', 'sendfile')
+               if hasattr(os, x)]
+    if not copiers:
+        raise OSError(errno.ENOSYS, "No kernel-side copy available")
+    with open(src, 'rb') as fsrc:
+        size = os.fstat(fsrc.fileno()).st_size
+        for copier in copiers:
+            fdst = _new_file(src, dst)
+            try:
+                _kernel_copy(copier, fsrc.fileno(), fdst.fileno(), size)
+            except OSError as e:
+                fdst.abort()
+                if copier is copiers[-1]:
+                    raise
+                log.debug("%s failed: %s", copier.__name__, e)
+                continue
+            fdst.commit()
+            break
+
+
+def _kernel_copy(copier, infd, outfd, size):
+    offset = 0
+    while offset < size:
+        if copier.__name__ == 'sendfile':
+            sent = copier(outfd, infd, offset, size - offset)
+        else:
+            sent = copier(infd, outfd, size - offset, offset)
+        if sent == 0:
+            # The file shrank, or the copier gave up: never commit a
+            # truncated copy
+            raise OSError(errno.EIO, "%s stopped at %d of %d bytes" % (
+                copier.__name__, offset, size))
+        offset += sent
+
+
+PLACEMENT_SYMLINK = 'symlink'
+PLACEMENT_HARDLINK = 'hardlink'
+PLACEMENT_REFLINK = 'reflink'
+PLACEMENT_KERNEL = 'kernel'
+PLACEMENT_COPY = 'copy'
+PLACEMENT_AUTO = 'auto'
+
+# Cheapest first; each strategy falls back to the ones after it
+_Placement_Chain = [
+    (PLACEMENT_HARDLINK, hardlink_file),
+    (PLACEMENT_REFLINK, reflink_file),
+    (PLACEMENT_KERNEL, kernel_copy_file),
+    (PLACEMENT_COPY, copy_file),
+]
+
+
+def place_file(src, dst, strategy=PLACEMENT_COPY):
+    """
+    Make dst a copy of src using strategy, one of:
+    * copy: plain user-space copy
+    * kernel: copy_file_range/sendfile, falling back to copy
+    * reflink: FICLONE, falling back to kernel
+    * hardlink (or auto): hard link, falling back to reflink
+    * symlink: symbolic link to src (no fallback)
+    Returns the strategy that was actually used.
+    """
+    if strategy == PLACEMENT_SYMLINK:
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        os.symlink(src, dst)
+        return strategy
+    if strategy == PLACEMENT_AUTO:
+        strategy = PLACEMENT_HARDLINK
+    names = [x[0] for x in _Placement_Chain]
+    if strategy not in names:
+        raise ValueError("Unknown placement strategy %s (expected: %s)" % (
+            strategy, ', '.join(names + [PLACEMENT_AUTO, PLACEMENT_SYMLINK])))
+    for name, func in _Placement_Chain[names.index(strategy):]:
+        try:
+            func(src, dst)
+        except (OSError, IOError) as e:
+            if name == PLACEMENT_COPY:
+                raise
+            log.debug("Placing %s with %s failed: %s", dst, name, e)
+            continue
+        return name
+
+
 def makedirs(dirName):
     if os.path.isdir(dirName):
         return dirName
@@ -15,9 +15,11 @@
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
+import io
 import os
 import shutil
 import pkg_resources
+import tarfile
 import tempfile
 import unittest
 import pytest
@@ -36,6 +38,52 @@ try:
 except ImportError:
     import mock  # noqa
 
+AR_MAGIC = b'!<arch>\n'
+AR_FMAG = b'`\n'
+
+
+def make_tar(files, mode='w:gz'):
+    buf = io.BytesIO()
+    tar = tarfile.open(fileobj=buf, mode=mode)
+    for name, data in sorted(files.items()):
+        tinfo = tarfile.TarInfo(name)
+        tinfo.size = len(data)
+        tar.addfile(tinfo, io.BytesIO(data))
+    tar.close()
+    return buf.getvalue()
+
+
+def make_ar(members):
+    buf = io.BytesIO()
+    buf.write(AR_MAGIC)
+    for name, data in members:
+        header = '%-16s%-12s%-6s%-6s%-8s%-10s' % (
+            name, 0, 0, 0, 100644, len(data))
+        buf.write(header.encode('ascii') + AR_FMAG)
+        buf.write(data)
+        if len(data) % 2:
+            buf.write(b'\n')
+    return buf.getvalue()
+
+
+def make_deb(control_files, ext='gz', data=b'data' * 1000):
+    mode = 'w:' + ext if ext else 'w:'
+    name = 'control.tar.' + ext if ext else 'control.tar'
+    return make_ar([
+        ('debian-binary', b'2.0\n'),
+        (name, make_tar(control_files, mode=mode)),
+        ('data.tar.gz', data),
+    ])
+
+
+def make_package_deb(package, version='1.0-1', architecture='amd64'):
+    control = 'Package: %s\nVersion: %s\nArchitecture: %s\n' % (
+        package, version, architecture)
+    md5sums = ('0123456789abcdef0123456789abcdef  '
+               'usr/share/doc/%s/copyright\n' % package)
+    return make_deb({'./control': control.encode('utf-8'),
+                     './md5sums': md5sums.encode('utf-8')})
+
 
 class BaseTestCase(unittest.TestCase):
     test_dir_pre = 'debpkgr-test-'
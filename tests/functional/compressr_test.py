@@ -17,9 +17,11 @@
 from __future__ import absolute_import
 from __future__ import division
 
+import io
 import os
 
 from debpkgr import compressr
+from debpkgr.hasher import hash_file
 
 from tests import base
 
@@ -92,6 +94,83 @@ class DecompressorTest(base.BaseTestCase):
             obj.write(b"Test")
         obj.close()
 
+    def test_multi_writer_hashes(self):
+        fpath = os.path.join(self.test_dir, "foo")
+        obj = compressr.MultiWriter(
+            fpath, extensions=['xz', 'bz2', 'gz', None],
+            algorithms=['md5', 'sha256'])
+        for i in range(100):
+            obj.write(b"Test")
+        obj.close()
+        self.assertEqual(4, len(obj.hashers))
+        for fname, hobj in obj.hashers.items():
+            self.assertEqual(os.stat(fname).st_size, hobj.size)
+            self.assertEqual(hash_file(fname, algs=['md5', 'sha256']),
+                             hobj.digests)
+            with compressr.Opener().open(fname) as fobj:
+                self.assertEqual(b"Test" * 100, fobj.read())
+
+    def test_multi_writer_threads(self):
+        blocks = [("block %d\n" % i).encode('ascii') * 1000
+                  for i in range(50)]
+        results = []
+        for threads in [False, True]:
+            fpath = os.path.join(self.mkdir(str(threads)), "foo")
+            obj = compressr.MultiWriter(
+                fpath, extensions=['xz', 'bz2', 'gz', None],
+                algorithms=['sha256'], threads=threads, queue_size=2)
+            for block in blocks:
+                obj.write(block)
+            obj.close()
+            self.assertEqual([], obj.workers)
+            for fname in obj.file_names:
+                with compressr.Opener().open(fname) as fobj:
+                    self.assertEqual(b''.join(blocks), fobj.read())
+            results.append(sorted(
+                (os.path.basename(x), y.size)
+                for x, y in obj.hashers.items()))
+        # Same compressors, same compressed sizes
+        self.assertEqual(results[0], results[1])
+
+    def test_multi_writer_threads_error(self):
+        obj = compressr.MultiWriter(
+            os.path.join(self.test_dir, "foo"), extensions=['gz', None],
+            threads=True)
+        broken = base.mock.MagicMock()
+        broken.write.side_effect = IOError("No space left on device")
+        obj.workers[0].fobj = broken
+        obj.write(b"Test")
+        with self.assertRaises(IOError) as ctx:
+            obj.close()
+        self.assertEqual("No space left on device", str(ctx.exception))
+        self.assertEqual(1, broken.close.call_count)
+
+    def test_open_level(self):
+        data = b"Test" * 10000
+        sizes = []
+        for level in [1, 9]:
+            fname = os.path.join(self.test_dir, "foo.gz")
+            with compressr.Opener().open(fname, "wb", level=level) as fobj:
+                fobj.write(data)
+            sizes.append(os.stat(fname).st_size)
+            with compressr.Opener().open(fname) as fobj:
+                self.assertEqual(data, fobj.read())
+        self.assertGreater(sizes[0], sizes[1])
+
+    def test_open_fileobj(self):
+        data = b"Test" * 10000
+        for fname in ["foo.gz", "foo.bz2", "foo.xz"]:
+            buf = io.BytesIO()
+            fobj = compressr.Opener().open(fname, "wb", fileobj=buf, level=1)
+            fobj.write(data)
+            fobj.close()
+            # The file object stays open
+            self.assertFalse(buf.closed)
+            self.assertTrue(0 < len(buf.getvalue()) < len(data))
+            buf.seek(0)
+            fobj = compressr.Opener().open(fname, fileobj=buf)
+            self.assertEqual(data, fobj.read())
+
     def test_maps(self):
         # Make sure that all the maps are sane
         _Algs = compressr.Opener._Decompressor_Factories
@@ -0,0 +1,171 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import os
+import threading
+
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+
+from debpkgr import httppool
+from debpkgr import utils
+from debpkgr.compat import HTTPError
+from debpkgr.errors import FileNotFoundError
+
+from tests import base
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        if self.path.startswith('/old/'):
+            self.send_response(301)
+            self.send_header('Location', '/files/' + self.path[5:])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.server.files.get(self.path)
+        if body is None:
+            body = b'Not found'
+            self.send_response(404)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        if self.path == '/files/close':
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _body(i):
+    return ('%d' % i).encode('ascii') * 1000
+
+
+class _Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ConnectionPoolTest(base.BaseTestCase):
+
+    def setUp(self):
+        super(ConnectionPoolTest, self).setUp()
+        # Talk to the test server directly, whatever the environment says
+        environ = base.mock.patch.dict(os.environ)
+        environ.start()
+        self.addCleanup(environ.stop)
+        for name in list(os.environ):
+            if name.lower().endswith('_proxy'):
+                del os.environ[name]
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.lock = threading.Lock()
+        self.server.connections = 0
+        self.server.files = dict(
+            ('/files/%d' % i, _body(i)) for i in range(10))
+        self.server.files['/files/close'] = b'bye'
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.pool = httppool.ConnectionPool()
+        self.addCleanup(self.pool.close)
+
+    def test_keep_alive(self):
+        for i in range(10):
+            with self.pool.urlopen('%s/files/%d' % (self.url, i)) as resp:
+                self.assertEqual(200, resp.getcode())
+                self.assertEqual('1000', resp.info().get('Content-Length'))
+                self.assertEqual(_body(i), resp.read())
+        # Redirects and errors keep the connection too
+        with self.pool.urlopen(self.url + '/old/3') as resp:
+            self.assertEqual(self.url + '/files/3', resp.url)
+            self.assertEqual(b'3' * 1000, resp.read())
+        with self.assertRaises(HTTPError) as ctx:
+            self.pool.urlopen(self.url + '/missing')
+        self.assertEqual(404, ctx.exception.code)
+        self.assertEqual(1, self.pool.connections)
+        self.assertEqual(1, self.server.connections)
+
+    def test_discarded_connections(self):
+        # Not read to the end
+        resp = self.pool.urlopen(self.url + '/files/1')
+        resp.read(10)
+        resp.close()
+        # Closed by the server
+        self.assertEqual(b'bye', self.pool.urlopen(
+            self.url + '/files/close').read())
+        self.assertEqual(b'2' * 1000, self.pool.urlopen(
+            self.url + '/files/2').read())
+        self.assertEqual(3, self.server.connections)
+
+    def test_stale_connection(self):
+        self.assertEqual(b'1' * 1000, self.pool.urlopen(
+            self.url + '/files/1').read())
+        # The server drops the idle connection behind our back
+        for conn in self.pool._idle.values():
+            conn[0].sock.close()
+        self.assertEqual(b'2' * 1000, self.pool.urlopen(
+            self.url + '/files/2').read())
+        self.assertEqual(2, self.pool.connections)
+
+    @base.mock.patch("debpkgr.httppool.urlopen")
+    def test_proxy(self, _urlopen):
+        url = self.url + '/files/1'
+        env = dict(http_proxy='http://proxy.example.com:3128')
+        with base.mock.patch.dict(os.environ, env):
+            self.assertEqual(_urlopen.return_value, self.pool.urlopen(url))
+            _urlopen.assert_called_once_with(url)
+            # Hosts in no_proxy are still fetched directly
+            with base.mock.patch.dict(os.environ, dict(no_proxy='127.0.0.1')):
+                self.assertEqual(b'1' * 1000, self.pool.urlopen(url).read())
+        self.assertEqual(1, _urlopen.call_count)
+        self.assertEqual(1, self.server.connections)
+
+    def test_download(self):
+        reqs = [utils.DownloadRequest(
+            '%s/files/%d' % (self.url, i),
+            os.path.join(self.test_dir, 'dl-%d' % i),
+            dict(size='1000')) for i in range(10)]
+        results = utils.Downloader(workers=4, per_host=2,
+                                   pool=self.pool).download(reqs)
+        self.assertEqual([None] * 10, [x.error for x in results])
+        for i in range(10):
+            self.assertEqual(_body(i), open(reqs[i].destination, 'rb').read())
+        # No more connections than requests in flight to the host
+        self.assertTrue(self.server.connections <= 2)
+
+        with self.assertRaises(FileNotFoundError):
+            utils.fetch(self.url + '/missing', io.BytesIO(), pool=self.pool)
+        # Not HTTP
+        fobj = io.BytesIO()
+        utils.fetch(reqs[0].destination, fobj, pool=self.pool)
+        self.assertEqual(b'0' * 1000, fobj.getvalue())
@@ -18,12 +18,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
+import io
 import os
 
 from debian import deb822
 from debpkgr.debpkg import DebPkg
 from debpkgr.debpkg import DebPkgFiles
 from debpkgr.debpkg import DebPkgMD5sums
+from debpkgr.errors import ArchiveError
 from tests import base
 
 
@@ -98,3 +100,60 @@ class PkgTest(base.BaseTestCase):
                 self.assertEqual(package_files[name], pkg.files)
             if name in package_data:
                 self.assertEqual(package_objects[name], pkg.package)
+
+    def test_pkg_ingest(self):
+        fpath = os.path.join(self.pool_dir, 'f', 'foo',
+                             'foo_0.0.1-1_amd64.deb')
+        expected = DebPkg.from_file(
+            fpath, Size=str(os.stat(fpath).st_size))
+        pkg = DebPkg.ingest(fpath)
+        self.assertEqual(expected.package, pkg.package)
+        self.assertEqual(expected.md5sums, pkg.md5sums)
+        self.assertEqual(u'1464', pkg.control['Size'])
+
+        pkg = DebPkg.ingest(fpath, Filename=u'pool/main/foo.deb')
+        self.assertEqual(u'pool/main/foo.deb', pkg.relative_path)
+
+    def test_pkg_inspect(self):
+        fpath = os.path.join(self.pool_dir, 'f', 'foo',
+                             'foo_0.0.1-1_amd64.deb')
+        expected = DebPkg.ingest(fpath)
+        pkg = DebPkg.inspect(fpath)
+        self.assertEqual(expected.control, pkg.control)
+        self.assertEqual(expected.md5sums, pkg.md5sums)
+        # Hashes are only computed on demand
+        self.assertEqual(None, pkg._h)
+        self.assertEqual(expected.package, pkg.package)
+        self.assertEqual(expected.sha256, pkg.sha256)
+
+    def test_pkg_from_stream(self):
+        fpath = os.path.join(self.pool_dir, 'f', 'foo',
+                             'foo_0.0.1-1_amd64.deb')
+        expected = DebPkg.ingest(fpath)
+        data = open(fpath, 'rb').read()
+
+        tee = io.BytesIO()
+        pkg = DebPkg.from_stream(io.BytesIO(data), size=len(data),
+                                 destination=tee)
+        self.assertEqual(expected.package, pkg.package)
+        self.assertEqual(data, tee.getvalue())
+
+        dest = os.path.join(self.test_dir, 'foo.deb')
+        pkg = DebPkg.from_stream(io.BytesIO(data), destination=dest)
+        self.assertEqual(expected.package, pkg.package)
+        self.assertEqual(data, open(dest, 'rb').read())
+
+    def test_pkg_from_stream_bad_size(self):
+        fpath = os.path.join(self.pool_dir, 'f', 'foo',
+                             'foo_0.0.1-1_amd64.deb')
+        data = open(fpath, 'rb').read()
+        dest = os.path.join(self.test_dir, 'foo.deb')
+        with self.assertRaises(ArchiveError) as ctx:
+            DebPkg.from_stream(io.BytesIO(data), size=len(data) + 1,
+                               destination=dest, name='upload')
+        self.assertEqual('upload: expected 1465 bytes, read 1464',
+                         str(ctx.exception))
+        # Nothing lands at the destination
+        self.assertFalse(os.path.exists(dest))
+        self.assertEqual([], [x for x in os.listdir(self.test_dir)
+                              if x.startswith('.foo.deb')])
@@ -18,13 +18,20 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
+import io
 import os
 import subprocess
+import tempfile
 
 from debian import deb822
-from debpkgr.aptrepo import AptRepo, AptRepoMeta
+from debpkgr import compressr
+from debpkgr import paragraph
+from debpkgr import pdiff
+from debpkgr import utils
+from debpkgr.aptrepo import AptRepo, AptRepoMeta, ComponentArchBinary
 from debpkgr.aptrepo import create_repo
 from debpkgr.aptrepo import parse_repo
+from debpkgr.hasher import hash_file
 from debpkgr.signer import SignOptions
 from tests import base
 
@@ -160,6 +167,467 @@ class RepoTest(base.BaseTestCase):
         self.assertEqual(packagefile_paths_256, packagefile_paths)
         self.assertEqual(packagefile_paths_1, packagefile_paths)
 
+    def test_AptRepo_create_single_pass(self):
+        files = []
+        for root, _, fl in os.walk(self.pool_dir):
+            for f in fl:
+                if f.endswith('.deb'):
+                    files.append(os.path.join(root, f))
+        packages = []
+        for single_pass in [False, True]:
+            repometa = AptRepoMeta(codename='stable', components=['main'],
+                                   architectures=['amd64'])
+            repo = AptRepo(os.path.join(self.test_dir, str(single_pass)),
+                           metadata=repometa)
+            repo.create(files, single_pass=single_pass)
+            path = os.path.join(repo.base_path, 'dists', 'stable', 'main',
+                                'binary-amd64', 'Packages')
+            with open(path, 'rb') as fh:
+                packages.append(fh.read())
+        self.assertEqual(packages[0], packages[1])
+
+    def test_AptRepo_add_packages_workers(self):
+        names = ['zed', 'abc', 'foo', 'bar', 'mid', 'qux', 'baz']
+        files = [self.mkfile('%s.deb' % x,
+                             contents=base.make_package_deb(x))
+                 for x in names]
+        results = []
+        for workers in [None, 3]:
+            repometa = AptRepoMeta(codename='stable', components=['main'],
+                                   architectures=['amd64'])
+            repo = AptRepo(os.path.join(self.test_dir, str(workers)),
+                           metadata=repometa)
+            comp = repo.add_packages(files, 'main', 'amd64',
+                                     single_pass=True, workers=workers)
+            self.assertEqual(names, [x.name for x in comp.iter_packages()])
+            for name in names:
+                self.assertTrue(os.path.exists(os.path.join(
+                    repo.base_path, 'pool', 'main',
+                    '%s_1.0-1_amd64.deb' % name)))
+            results.append([x.package for x in comp.iter_packages()])
+        self.assertEqual(results[0], results[1])
+
+    def test_AptRepo_add_stream(self):
+        fpath = os.path.join(self.pool_dir, 'f', 'foo',
+                             'foo_0.0.1-1_amd64.deb')
+        repometa = AptRepoMeta(codename='stable', components=['main'],
+                               architectures=['amd64'])
+        repo = AptRepo(self.new_repo_dir, metadata=repometa)
+        with open(fpath, 'rb') as fh:
+            pkg = repo.add_stream(fh, 'main', 'amd64',
+                                  size=os.stat(fpath).st_size)
+        self.assertEqual('pool/main/foo_0.0.1-1_amd64.deb', pkg.relative_path)
+        pool_dir = os.path.join(self.new_repo_dir, 'pool', 'main')
+        self.assertEqual(['foo_0.0.1-1_amd64.deb'], os.listdir(pool_dir))
+        with open(fpath, 'rb') as fh:
+            self.assertEqual(fh.read(), open(os.path.join(
+                pool_dir, 'foo_0.0.1-1_amd64.deb'), 'rb').read())
+        comp = repometa.get_component_arch_binary('main', 'amd64')
+        self.assertEqual([pkg], list(comp.iter_packages()))
+
+    def test_AptRepo_add_packages_placement(self):
+        src = self.mkfile('foo.deb', contents=base.make_package_deb('foo'))
+        repometa = AptRepoMeta(codename='stable', components=['main'],
+                               architectures=['amd64'])
+        repo = AptRepo(self.new_repo_dir, metadata=repometa)
+        repo.add_packages([src], 'main', 'amd64', placement='auto')
+        dst = os.path.join(self.new_repo_dir, 'pool', 'main',
+                           'foo_1.0-1_amd64.deb')
+        self.assertTrue(os.path.samefile(src, dst))
+
+    def test_AptRepo_add_packages_skips_identical(self):
+        src = self.mkfile('foo.deb', contents=base.make_package_deb('foo'))
+        dst = os.path.join(self.new_repo_dir, 'pool', 'main',
+                           'foo_1.0-1_amd64.deb')
+        for with_symlinks in [False, True]:
+            repometa = AptRepoMeta(codename='stable', components=['main'],
+                                   architectures=['amd64'])
+            repo = AptRepo(self.new_repo_dir, metadata=repometa)
+            repo.add_packages([src], 'main', 'amd64',
+                              with_symlinks=with_symlinks)
+            inode = os.lstat(dst).st_ino
+            with base.mock.patch("debpkgr.utils.place_file") as _place:
+                with base.mock.patch("os.symlink") as _symlink:
+                    repo.add_packages([src], 'main', 'amd64',
+                                      with_symlinks=with_symlinks)
+            self.assertEqual(0, _place.call_count)
+            self.assertEqual(0, _symlink.call_count)
+            self.assertEqual(inode, os.lstat(dst).st_ino)
+
+        # A symlink is replaced by a copy, and a stale copy is rewritten
+        repo.add_packages([src], 'main', 'amd64')
+        self.assertFalse(os.path.islink(dst))
+        with open(dst, 'r+b') as fh:
+            fh.seek(-1, 2)
+            fh.write(b'X')
+        repo.add_packages([src], 'main', 'amd64')
+        with open(src, 'rb') as fsrc, open(dst, 'rb') as fdst:
+            self.assertEqual(fsrc.read(), fdst.read())
+
+    def test_AptRepo_pool_layout_content(self):
+        src = self.mkfile('foo.deb', contents=base.make_package_deb('foo'))
+        repometa = AptRepoMeta(codename='stable',
+                               components=['main', 'updates'],
+                               architectures=['amd64'])
+        repo = AptRepo(self.new_repo_dir, metadata=repometa,
+                       pool_layout='content')
+        pkgs = [next(repo.add_packages([src], comp, 'amd64').iter_packages())
+                for comp in ['main', 'updates']]
+        self.assertEqual(pkgs[0].relative_path, pkgs[1].relative_path)
+        self.assertEqual(
+            os.path.join('pool', 'sha256', pkgs[0].sha256[:2],
+                         pkgs[0].sha256, 'foo_1.0-1_amd64.deb'),
+            pkgs[0].relative_path)
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.new_repo_dir, pkgs[0].relative_path)))
+        self.assertEqual(['sha256'],
+                         os.listdir(os.path.join(self.new_repo_dir, 'pool')))
+
+    def test_AptRepo_pool_layout_sharded(self):
+        repometa = AptRepoMeta(codename='stable', components=['main'],
+                               architectures=['amd64'])
+        repo = AptRepo(self.new_repo_dir, metadata=repometa,
+                       pool_layout='sharded')
+        pkg = repo.add_stream(io.BytesIO(base.make_package_deb('libfoo1')),
+                              'main', 'amd64')
+        self.assertEqual('pool/main/libf/libfoo1/libfoo1_1.0-1_amd64.deb',
+                         pkg.relative_path)
+        self.assertEqual(
+            ['libfoo1_1.0-1_amd64.deb'],
+            os.listdir(os.path.join(self.new_repo_dir, 'pool', 'main',
+                                    'libf', 'libfoo1')))
+
+    def test_WritePackages_checksums(self):
+        files = [self.mkfile('foo.deb', base.make_package_deb('foo')),
+                 self.mkfile('bar.deb', base.make_package_deb('bar'))]
+        repo = create_repo(self.new_repo_dir, files,
+                           codename='stable', components=['main'],
+                           arches=['amd64'])
+        release_dir = repo.metadata.release_dir(self.new_repo_dir)
+        comp = repo.metadata.get_component_arch_binary('main', 'amd64')
+        with base.mock.patch("debpkgr.aptrepo.hash_file") as _hash_file:
+            checksums = comp.write_packages(self.new_repo_dir, release_dir)
+        self.assertEqual(0, _hash_file.call_count)
+        self.assertEqual(
+            ['main/binary-amd64/Packages', 'main/binary-amd64/Packages.gz',
+             'main/binary-amd64/Packages.bz2'],
+            [x['name'] for x in checksums['SHA256']])
+        for info in checksums['SHA256']:
+            path = os.path.join(release_dir, info['name'])
+            self.assertEqual(str(os.stat(path).st_size), info['size'])
+            self.assertEqual(hash_file(path, algs=['sha256'])['sha256'],
+                             info['sha256'])
+
+    def test_create_repo_compressions(self):
+        files = [self.mkfile('foo.deb', base.make_package_deb('foo'))]
+        bin_dir = os.path.join(self.new_repo_dir, 'dists', 'stable', 'main',
+                               'binary-amd64')
+        create_repo(self.new_repo_dir, files, codename='stable',
+                    components=['main'], arches=['amd64'])
+        self.assertEqual(['Packages', 'Packages.bz2', 'Packages.gz'],
+                         sorted(x for x in os.listdir(bin_dir)
+                                if x.startswith('Packages')))
+
+        repo = create_repo(self.new_repo_dir, files, codename='stable',
+                           components=['main'], arches=['amd64'],
+                           compressions=[('xz', 6), ('gz', 6)])
+        self.assertEqual((('xz', 6), ('gz', 6)), repo.metadata.compressions)
+        self.assertEqual(['Packages', 'Packages.gz', 'Packages.xz'],
+                         sorted(x for x in os.listdir(bin_dir)
+                                if x.startswith('Packages')))
+        self.assertEqual(
+            ['main/binary-amd64/Packages', 'main/binary-amd64/Packages.xz',
+             'main/binary-amd64/Packages.gz'],
+            [x['name'] for x in repo.metadata.release['SHA256']])
+        with open(os.path.join(bin_dir, 'Packages'), 'rb') as fh:
+            plain = fh.read()
+        with compressr.Opener().open(
+                os.path.join(bin_dir, 'Packages.xz')) as fh:
+            self.assertEqual(plain, fh.read())
+
+        with self.assertRaises(ValueError) as ctx:
+            AptRepoMeta(compressions={'zip': 1})
+        self.assertEqual(
+            "Compression zip not supported (expected: xz, bz2, gz)",
+            str(ctx.exception))
+
+    def test_AptRepo_create_incremental(self):
+        repometa = AptRepoMeta(codename='stable',
+                               components=['main', 'updates'],
+                               architectures=['amd64'])
+        repo = AptRepo(self.new_repo_dir, metadata=repometa)
+        repo.add_packages(
+            [self.mkfile('foo.deb', base.make_package_deb('foo'))],
+            'updates', 'amd64')
+        repo.create()
+        release_dir = repometa.release_dir(self.new_repo_dir)
+
+        # Rewritten files lose this timestamp
+        names = [x['name'] for x in repometa.release['SHA256']]
+        for name in names:
+            os.utime(os.path.join(release_dir, name), (1, 1))
+        repo.create(
+            [self.mkfile('bar.deb', base.make_package_deb('bar'))],
+            component='main', incremental=True)
+        self.assertEqual(names,
+                         [x['name'] for x in repometa.release['SHA256']])
+        for name in names:
+            mtime = os.stat(os.path.join(release_dir, name)).st_mtime
+            self.assertEqual(name.startswith('updates/'), mtime == 1)
+        for info in repometa.release['SHA256']:
+            path = os.path.join(release_dir, info['name'])
+            self.assertEqual(str(os.stat(path).st_size), info['size'])
+            self.assertEqual(hash_file(path, algs=['sha256'])['sha256'],
+                             info['sha256'])
+
+        # Changing the set of compressed variants forces a rewrite
+        repometa.compressions = (('xz', None), )
+        repo.create(incremental=True)
+        self.assertEqual(
+            ['main/binary-amd64/Packages', 'main/binary-amd64/Packages.xz',
+             'updates/binary-amd64/Packages',
+             'updates/binary-amd64/Packages.xz'],
+            [x['name'] for x in repometa.release['SHA256']])
+
+        # Which levels were used is not published
+        self.assertEqual([], [
+            os.path.join(x[0], y) for x in os.walk(release_dir)
+            for y in x[2] if y.startswith('.')])
+        self.assertTrue(os.path.exists(os.path.join(
+            self.new_repo_dir, '.debpkgr', 'levels', 'dists', 'stable',
+            'main', 'binary-amd64', 'Packages')))
+
+        # Changing a compression level forces a rewrite too
+        names = [x['name'] for x in repometa.release['SHA256']]
+        for name in names:
+            os.utime(os.path.join(release_dir, name), (1, 1))
+        repometa.compressions = (('xz', 1), )
+        repo.create(incremental=True)
+        for name in names:
+            self.assertNotEqual(
+                1, os.stat(os.path.join(release_dir, name)).st_mtime)
+        # and the same levels again don't
+        for name in names:
+            os.utime(os.path.join(release_dir, name), (1, 1))
+        repo.create(incremental=True)
+        for name in names:
+            self.assertEqual(
+                1, os.stat(os.path.join(release_dir, name)).st_mtime)
+
+    def test_AptRepo_create_pdiffs(self):
+        repometa = AptRepoMeta(codename='stable', components=['main'],
+                               architectures=['amd64'], pdiffs=1)
+        repo = AptRepo(self.new_repo_dir, metadata=repometa)
+        release_dir = repometa.release_dir(self.new_repo_dir)
+        diff_dir = os.path.join(release_dir, 'main', 'binary-amd64',
+                                'Packages.diff')
+        for name in ['foo', 'bar']:
+            repo.create([self.mkfile(name + '.deb',
+                                     base.make_package_deb(name))])
+        names = [x['name'] for x in repometa.release['SHA256']]
+        self.assertEqual('main/binary-amd64/Packages.diff/Index', names[-1])
+        self.assertEqual(2, len(os.listdir(diff_dir)))
+        index = pdiff.PDiffIndex.load(os.path.join(diff_dir, 'Index'))
+        self.assertEqual(1, len(index.history))
+        with open(os.path.join(release_dir, names[0]), 'rb') as fh:
+            self.assertEqual(pdiff.file_info(fh.read()), index.current)
+
+    def test_AptRepo_create_by_hash(self):
+        repometa = AptRepoMeta(codename='stable', components=['main'],
+                               architectures=['amd64'], by_hash=True,
+                               by_hash_retention=1)
+        repo = AptRepo(self.new_repo_dir, metadata=repometa)
+        release_dir = repometa.release_dir(self.new_repo_dir)
+        by_hash_dir = os.path.join(release_dir, 'main', 'binary-amd64',
+                                   'by-hash', 'SHA256')
+        generations = []
+        for i, name in enumerate(['foo', 'bar', 'baz']):
+            repo.create([self.mkfile(name + '.deb',
+                                     base.make_package_deb(name))])
+            generations.append(set(
+                x['sha256'] for x in repometa.release['SHA256']))
+            # Tell the generations apart regardless of the clock resolution
+            for fname in os.listdir(by_hash_dir):
+                if fname not in generations[-1]:
+                    os.utime(os.path.join(by_hash_dir, fname), (i, i))
+
+        release = deb822.Release(open(repometa.release_path(
+            self.new_repo_dir), 'rb'))
+        self.assertEqual('yes', release['Acquire-By-Hash'])
+        # The current publish and the one before it
+        self.assertEqual(generations[1] | generations[2],
+                         set(os.listdir(by_hash_dir)))
+        for info in release['SHA256']:
+            path = os.path.join(by_hash_dir, info['sha256'])
+            self.assertEqual(info['sha256'],
+                             hash_file(path, algs=['sha256'])['sha256'])
+        self.assertEqual([], [x for x in os.listdir(release_dir)
+                              if x.startswith('.')])
+
+    def test_AptRepo_create_pdiffs_by_hash(self):
+        repometa = AptRepoMeta(codename='stable', components=['main'],
+                               architectures=['amd64'], pdiffs=2,
+                               by_hash=True)
+        repo = AptRepo(self.new_repo_dir, metadata=repometa)
+        release_dir = repometa.release_dir(self.new_repo_dir)
+        diff_dir = os.path.join(release_dir, 'main', 'binary-amd64',
+                                'Packages.diff')
+        for name in ['foo', 'bar', 'baz']:
+            repo.create([self.mkfile(name + '.deb',
+                                     base.make_package_deb(name))])
+        index = pdiff.PDiffIndex.load(os.path.join(diff_dir, 'Index'))
+        self.assertEqual(2, len(index.history))
+        self.assertEqual(
+            sorted(['Index', 'by-hash'] + [
+                x.name + '.gz' for x in index.history]),
+            sorted(os.listdir(diff_dir)))
+        for info in repometa.release['SHA256']:
+            path = os.path.join(release_dir, os.path.dirname(info['name']),
+                                'by-hash', 'SHA256', info['sha256'])
+            self.assertTrue(os.path.exists(path))
+
+    def test_AptRepoMeta_create_workers(self):
+        releases = []
+        for workers in [None, 4]:
+            repometa = AptRepoMeta(codename='stable',
+                                   components=['main', 'updates'],
+                                   architectures=['amd64', 'i386'])
+            repo_dir = self.mkdir('repo-%s' % workers)
+            repo = AptRepo(repo_dir, metadata=repometa)
+            for comp in repometa.components:
+                for arch in repometa.architectures:
+                    name = '%s-%s' % (comp, arch)
+                    repo.add_packages(
+                        [self.mkfile(name + '.deb', base.make_package_deb(
+                            name, architecture=arch))], comp, arch)
+            repometa.create(repo_dir, workers=workers)
+            # gzip headers carry a timestamp; compare the plain files only
+            releases.append([
+                (x['name'], x['size'],
+                 None if x['name'].endswith('.gz') else x['sha256'])
+                for x in repometa.release['SHA256']])
+        self.assertEqual(releases[0], releases[1])
+        self.assertEqual(12, len(releases[1]))
+
+    def test_AptRepo_spill(self):
+        files = [self.mkfile(name + '.deb', base.make_package_deb(name))
+                 for name in ['foo', 'bar', 'baz']]
+        contents = []
+        for spill in [False, True]:
+            repometa = AptRepoMeta(codename='stable', components=['main'],
+                                   architectures=['amd64'], spill=spill)
+            repo_dir = self.mkdir('repo-%s' % spill)
+            repo = AptRepo(repo_dir, metadata=repometa)
+            repo.create(files[:2])
+            comp = repometa.get_component_arch_binary('main', 'amd64')
+            # The spool is gone once the index is written
+            self.assertEqual(None, comp._spool)
+            self.assertEqual(not spill, comp._packages is not None)
+            self.assertEqual(2, len(comp.lookup('bar') + comp.lookup('foo')))
+            # Packages added later go to the same index
+            spool_dir = self.mkdir('spool-%s' % spill)
+            with base.mock.patch.object(tempfile, 'tempdir', spool_dir):
+                repo.create(files[2:])
+            self.assertEqual(None, comp._spool)
+            self.assertEqual([], os.listdir(spool_dir))
+            with open(os.path.join(repometa.release_dir(repo_dir),
+                                   comp.packages_relative_path), 'rb') as fh:
+                contents.append(fh.read())
+        self.assertEqual(contents[0], contents[1])
+        self.assertEqual(3, contents[1].count(b'Package: '))
+
+    def test_AptRepo_create_sorted(self):
+        files = [self.mkfile(name + '.deb', base.make_package_deb(name))
+                 for name in ['foo', 'bar', 'baz']]
+        contents = []
+        for i, order in enumerate([files, list(reversed(files))]):
+            repometa = AptRepoMeta(codename='stable', components=['main'],
+                                   architectures=['amd64'])
+            repo_dir = self.mkdir('repo-%d' % i)
+            AptRepo(repo_dir, metadata=repometa).create(order)
+            comp = repometa.get_component_arch_binary('main', 'amd64')
+            self.assertEqual(['bar', 'baz', 'foo'],
+                             [x.name for x in comp.index_packages()])
+            with open(os.path.join(repometa.release_dir(repo_dir),
+                                   comp.packages_relative_path), 'rb') as fh:
+                contents.append(fh.read())
+        self.assertEqual(contents[0], contents[1])
+
+    def test_AptRepo_create_unchanged(self):
+        files = [self.mkfile(name + '.deb', base.make_package_deb(name))
+                 for name in ['foo', 'bar']]
+        defaults = dict(codename='stable', components=['main'],
+                        architectures=['amd64'])
+        repo = AptRepo(self.new_repo_dir, metadata=AptRepoMeta(**defaults))
+        repo.create(files)
+        release = repo.metadata.release_path(self.new_repo_dir)
+        packages = os.path.join(
+            repo.metadata.release_dir(self.new_repo_dir), 'main',
+            'binary-amd64', 'Packages')
+        for path in [release, packages]:
+            os.utime(path, (1, 1))
+
+        # Same packages, in a different order: nothing is rewritten, and
+        # the index is rendered only once
+        repo = AptRepo(self.new_repo_dir, metadata=AptRepoMeta(**defaults))
+        render = base.mock.MagicMock(side_effect=AptRepoMeta.RenderPackages)
+        write = base.mock.MagicMock(side_effect=AptRepoMeta._write_variants)
+        with base.mock.patch.object(AptRepo, 'sign') as sign, \
+                base.mock.patch.object(AptRepoMeta, 'RenderPackages',
+                                       render), \
+                base.mock.patch.object(AptRepoMeta, '_write_variants', write):
+            repo.create(list(reversed(files)))
+        self.assertEqual(0, sign.call_count)
+        self.assertEqual(1, render.call_count)
+        # Nothing was compressed
+        self.assertEqual([[None]], [x[0][1] for x in write.call_args_list])
+        for path in [release, packages]:
+            self.assertEqual(1, os.stat(path).st_mtime)
+        self.assertEqual([], [x for x in os.listdir(os.path.dirname(packages))
+                              if x.startswith('.')])
+
+        # A new package changes both
+        files.append(self.mkfile('baz.deb', base.make_package_deb('baz')))
+        repo = AptRepo(self.new_repo_dir, metadata=AptRepoMeta(**defaults))
+        with base.mock.patch.object(AptRepo, 'sign') as sign:
+            repo.create(files)
+        self.assertEqual(1, sign.call_count)
+        for path in [release, packages]:
+            self.assertNotEqual(1, os.stat(path).st_mtime)
+        release_dir = repo.metadata.release_dir(self.new_repo_dir)
+        for info in repo.metadata.release['SHA256']:
+            path = os.path.join(release_dir, info['name'])
+            self.assertEqual(str(os.stat(path).st_size), info['size'])
+            self.assertEqual(hash_file(path, algs=['sha256'])['sha256'],
+                             info['sha256'])
+        with compressr.Opener().open(packages + '.gz') as fh:
+            self.assertEqual(open(packages, 'rb').read(), fh.read())
+
+    def test_AptRepo_create_unchanged_signs(self):
+        files = [self.mkfile('foo.deb', base.make_package_deb('foo'))]
+        metadata = AptRepoMeta(codename='stable', components=['main'],
+                               architectures=['amd64'])
+        repo = AptRepo(self.new_repo_dir, metadata=metadata)
+        repo.create(files)
+        release = metadata.release_path(self.new_repo_dir)
+
+        # Signing enabled on a published repository
+        repo.gpg_sign_options = base.mock.MagicMock()
+        with base.mock.patch.object(AptRepo, 'sign') as sign:
+            repo.create()
+        sign.assert_called_once_with(release)
+        # Signed: nothing to do
+        self.mkfile(release + '.gpg', contents=b'sig')
+        os.utime(release, (1, 1))
+        with base.mock.patch.object(AptRepo, 'sign') as sign:
+            repo.create()
+        self.assertEqual(0, sign.call_count)
+        # The signature is older than Release
+        os.utime(release + '.gpg', (0, 0))
+        with base.mock.patch.object(AptRepo, 'sign') as sign:
+            repo.create()
+        self.assertEqual(1, sign.call_count)
+
     def test_parse_repo(self):
         repo = parse_repo(self.new_repo_dir,
                           self.current_repo_dir, codename='stable')
@@ -190,6 +658,94 @@ class RepoTest(base.BaseTestCase):
         self.assertEqual(sz - 1, os.stat(pkgs_file).st_size)
         self.assertNotEqual(inode, os.stat(pkgs_file).st_ino)
 
+    @base.mock.patch("debpkgr.aptrepo.hash_file")
+    def test_parse_repo_verified_while_downloading(self, _hash_file):
+        repo = parse_repo(self.new_repo_dir,
+                          self.current_repo_dir, codename='stable')
+        # Indices are not read again to check their checksums
+        self.assertEqual(0, _hash_file.call_count)
+        comp_arch_bin = repo.metadata.get_component_arch_binary(
+            'main', 'amd64')
+        self.assertEqual(1, len(list(comp_arch_bin.iter_packages())))
+
+    def test_AptRepo_download(self):
+        release = os.path.join(self.current_repo_dir, 'dists', 'stable',
+                               'Release')
+        dst = os.path.join(self.test_dir, 'Release')
+        reqs = [utils.DownloadRequest(release + x, dst + x, None)
+                for x in ['', '.missing', '.gpg']]
+        results = AptRepo.download(reqs, workers=2)
+        self.assertEqual(reqs, [x.request for x in results])
+        self.assertEqual([True, False, True],
+                         [x.error is None for x in results])
+        self.assertTrue(os.path.exists(dst))
+        self.assertTrue(os.path.exists(dst + '.gpg'))
+
+    def test_parse_repo_keep_compressed(self):
+        repo = parse_repo(self.new_repo_dir, self.current_repo_dir,
+                          codename='stable', keep_compressed=True)
+        expected = self.repo_packages['pool/main/f/foo/foo_0.0.1-1_amd64.deb']
+        comp_arch_bin = repo.metadata.get_component_arch_binary(
+            'main', 'amd64')
+        pkgs_file = os.path.join(self.new_repo_dir, 'dists', 'stable', 'main',
+                                 'binary-amd64', 'Packages')
+        self.assertFalse(os.path.exists(pkgs_file))
+        self.assertTrue(os.path.exists(pkgs_file + '.gz'))
+        # Can be read several times, and looked up
+        for _ in range(2):
+            self.assertEqual([expected], list(comp_arch_bin.iter_packages()))
+        self.assertEqual([expected], comp_arch_bin.lookup('foo'))
+
+        # Loading picks up the compressed file
+        comp_arch_bin = ComponentArchBinary(
+            meta=dict(component='main', architecture='amd64'), dist='stable')
+        comp_arch_bin.load_packages(self.new_repo_dir)
+        self.assertEqual([expected], list(comp_arch_bin.iter_packages()))
+        self.assertEqual([expected],
+                         list(comp_arch_bin.iter_packages(fast=True)))
+
+    def test_parse_repo_iter_packages(self):
+        repo = parse_repo(self.new_repo_dir,
+                          self.current_repo_dir, codename='stable')
+        comp_arch_bin = repo.metadata.get_component_arch_binary(
+            'main', 'amd64')
+        # deb822 objects by default
+        pkg, = comp_arch_bin.iter_packages()
+        self.assertTrue(isinstance(pkg, deb822.Packages))
+        self.assertEqual([], pkg.relations['depends'])
+        pkg['Priority'] = 'optional'
+        pkg, = comp_arch_bin.iter_packages(fields=['Package', 'Version'])
+        self.assertEqual(['Package', 'Version'], list(pkg.keys()))
+        pkg, = comp_arch_bin.iter_packages(fast=True)
+        self.assertTrue(isinstance(pkg, paragraph.Paragraph))
+        self.assertEqual('foo', pkg['Package'])
+
+    def test_parse_repo_lookup(self):
+        repo = parse_repo(self.new_repo_dir,
+                          self.current_repo_dir, codename='stable')
+        comp_arch_bin = repo.metadata.get_component_arch_binary(
+            'main', 'amd64')
+        expected = self.repo_packages['pool/main/f/foo/foo_0.0.1-1_amd64.deb']
+        self.assertEqual([expected], comp_arch_bin.lookup('foo'))
+        self.assertEqual([expected], comp_arch_bin.lookup('foo', '0.0.1-1'))
+        self.assertEqual([], comp_arch_bin.lookup('foo', '0.0.2-1'))
+        self.assertEqual([], comp_arch_bin.lookup('bar'))
+
+    def test_AptRepo_lookup(self):
+        files = [self.mkfile(name + '.deb', base.make_package_deb(name))
+                 for name in ['foo', 'bar']]
+        for spill in [False, True]:
+            repometa = AptRepoMeta(codename='stable', components=['main'],
+                                   architectures=['amd64'], spill=spill)
+            repo = AptRepo(self.mkdir('repo-%s' % spill), metadata=repometa)
+            repo.add_packages(files, 'main', 'amd64')
+            comp = repometa.get_component_arch_binary('main', 'amd64')
+            self.assertEqual(['bar'],
+                             [x['Package'] if spill else x.name
+                              for x in comp.lookup('bar', '1.0-1')])
+            self.assertEqual([], comp.lookup('bar', '1.0-2'))
+            self.assertEqual([], comp.lookup('baz'))
+
     # export REMOTE_TESTS=1 to activate
     @base.pytest.mark.skipif(os.environ.get('REMOTE_TESTS', '0') == '0',
                              reason='Remote Parse Test runs long')
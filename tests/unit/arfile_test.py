@@ -0,0 +1,126 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+
+from debpkgr import arfile
+from debpkgr.errors import ArchiveError
+
+from tests import base
+from tests.base import make_ar, make_deb
+
+
+class ArFileTest(base.BaseTestCase):
+
+    def setUp(self):
+        super(ArFileTest, self).setUp()
+        self.control = b'Package: foo\nVersion: 1.0-1\nArchitecture: amd64\n'
+        self.md5sums = b'0123456789abcdef0123456789abcdef  usr/bin/foo\n'
+        self.files = {'./control': self.control,
+                      './md5sums': self.md5sums,
+                      './postinst': b'#!/bin/sh\n'}
+
+    def test_read_stream(self):
+        for ext in ['gz', 'xz', 'bz2', '']:
+            deb = make_deb(self.files, ext=ext)
+            parts = arfile.read_stream(io.BytesIO(deb))
+            self.assertEqual(self.control, parts.control)
+            self.assertEqual(self.md5sums, parts.md5sums)
+            self.assertEqual({'postinst': b'#!/bin/sh\n'}, parts.scripts)
+
+    def test_read_stream_consumes_everything(self):
+        deb = make_deb(self.files, data=b'odd')
+        stream = io.BytesIO(deb)
+        arfile.read_stream(stream)
+        self.assertEqual(len(deb), stream.tell())
+
+    def test_read_stream_short_reads(self):
+        deb = make_deb(self.files, data=b'odd')
+        stream = io.BytesIO(deb)
+        # Like a socket: at most 7 bytes per read
+        read = stream.read
+        stream = base.mock.MagicMock(
+            read=lambda size=-1: read(min(size, 7)))
+        parts = arfile.read_stream(stream)
+        self.assertEqual(self.control, parts.control)
+        self.assertEqual(self.md5sums, parts.md5sums)
+
+    def test_read_stream_without_md5sums(self):
+        deb = make_deb({'control': self.control})
+        parts = arfile.read_stream(io.BytesIO(deb))
+        self.assertEqual(self.control, parts.control)
+        self.assertEqual(None, parts.md5sums)
+        self.assertEqual({}, parts.scripts)
+
+    def test_read_stream_errors(self):
+        deb = make_deb(self.files)
+        tests = [
+            (b'not an archive', "Not an ar archive"),
+            (deb[:-5], "Unexpected end of archive"),
+            (make_ar([('debian-binary', b'2.0\n')]),
+             "Missing control.tar member"),
+            (make_deb({'./md5sums': self.md5sums}),
+             "'control' file not found in control.tar.gz"),
+            (deb[:20], "Invalid ar member header at offset 8"),
+        ]
+        for data, msg in tests:
+            with self.assertRaises(ArchiveError) as ctx:
+                arfile.read_stream(io.BytesIO(data))
+            self.assertEqual(msg, str(ctx.exception))
+
+    def test_is_control_part(self):
+        for name in ['control.tar', 'control.tar.gz', 'control.tar.xz',
+                     'control.tar.zst']:
+            self.assertTrue(arfile.is_control_part(name))
+        for name in ['data.tar.gz', 'control.tar.foo', 'control']:
+            self.assertFalse(arfile.is_control_part(name))
+
+    def test_deb_archive(self):
+        for ext in ['gz', 'xz', 'bz2', '']:
+            deb = make_deb(self.files, ext=ext, data=b'odd')
+            path = self.mkfile('foo.deb', contents=deb)
+            with arfile.DebArchive(path) as archive:
+                self.assertEqual(len(deb), archive.size)
+                self.assertEqual(
+                    ['debian-binary', archive.control_member().name,
+                     'data.tar.gz'],
+                    [x.name for x in archive.members])
+                data = archive.members[-1]
+                self.assertEqual(b'odd', deb[data.offset:data.offset + 3])
+                self.assertEqual(arfile.read_stream(io.BytesIO(deb)),
+                                 archive.control_parts())
+            self.assertEqual(self.control,
+                             arfile.read_control(path).control)
+
+    def test_deb_archive_errors(self):
+        deb = make_deb(self.files)
+        tests = [
+            (b'', "Not an ar archive"),
+            (b'not an archive', "Not an ar archive"),
+            (deb[:-5], "Unexpected end of archive"),
+            (make_ar([('debian-binary', b'2.0\n')]),
+             "Missing control.tar member"),
+        ]
+        for data, msg in tests:
+            path = self.mkfile('bad.deb', contents=data)
+            with self.assertRaises(ArchiveError) as ctx:
+                arfile.read_control(path)
+            self.assertEqual(msg, str(ctx.exception))
@@ -0,0 +1,105 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+
+from debpkgr.aptrepo import AptRepo, AptRepoMeta
+from debpkgr.cache import IngestCache
+from debpkgr.debpkg import DebPkg
+
+from tests import base
+
+
+class IngestCacheTest(base.BaseTestCase):
+
+    def setUp(self):
+        super(IngestCacheTest, self).setUp()
+        self.deb = self.mkfile('foo.deb', base.make_package_deb('foo'))
+        self.cache_path = os.path.join(self.test_dir, 'cache', 'ingest.db')
+
+    def test_roundtrip(self):
+        pkg = DebPkg.ingest(self.deb)
+        pkg.scripts.postinst = b'#!/bin/sh\n\xff'
+        with IngestCache(self.cache_path) as cache:
+            self.assertEqual(None, cache.get(self.deb))
+            cache.put(self.deb, pkg)
+
+        cache = IngestCache(self.cache_path)
+        cached = cache.get(self.deb)
+        self.assertEqual(pkg.package, cached.package)
+        self.assertEqual(list(pkg.package.keys()),
+                         list(cached.package.keys()))
+        self.assertEqual(pkg.md5sums, cached.md5sums)
+        self.assertEqual(b'#!/bin/sh\n\xff', cached.scripts.postinst)
+        self.assertEqual((1, 0), (cache.hits, cache.misses))
+        cache.close()
+
+    def test_uncommitted_entries_are_lost(self):
+        cache = IngestCache(self.cache_path)
+        cache.put(self.deb, DebPkg.ingest(self.deb))
+        cache.close()
+        cache = IngestCache(self.cache_path)
+        self.assertEqual(None, cache.get(self.deb))
+        cache.close()
+
+    def test_changed_file(self):
+        with IngestCache(self.cache_path) as cache:
+            cache.put(self.deb, DebPkg.ingest(self.deb))
+            st = os.stat(self.deb)
+            self.assertTrue(cache.contains(self.deb))
+            os.utime(self.deb, (st.st_atime, st.st_mtime + 10))
+            self.assertFalse(cache.contains(self.deb))
+            self.assertEqual(None, cache.get(self.deb))
+            # contains() does not count
+            self.assertEqual((0, 1), (cache.hits, cache.misses))
+
+    def test_for_repo(self):
+        cache = IngestCache.for_repo(self.new_repo_dir)
+        self.assertEqual(
+            os.path.join(self.new_repo_dir, '.debpkgr', 'ingest-cache.sqlite'),
+            cache.path)
+        cache.close()
+
+    def test_add_packages_uses_cache(self):
+        files = [self.deb, self.mkfile('bar.deb',
+                                       base.make_package_deb('bar'))]
+        for workers in [None, 2]:
+            meta = AptRepoMeta(codename='stable', components=['main'],
+                               architectures=['amd64'])
+            cache = IngestCache(self.cache_path)
+            repo = AptRepo(self.new_repo_dir, metadata=meta,
+                           ingest_cache=cache)
+            repo.add_packages(files, 'main', 'amd64', single_pass=True,
+                              workers=workers)
+            cache.close()
+
+        meta = AptRepoMeta(codename='stable', components=['main'],
+                           architectures=['amd64'])
+        cache = IngestCache(self.cache_path)
+        repo = AptRepo(self.new_repo_dir, metadata=meta, ingest_cache=cache)
+        with base.mock.patch("debpkgr.aptrepo.read_package") as _read:
+            comp = repo.add_packages(files, 'main', 'amd64')
+        self.assertEqual(0, _read.call_count)
+        self.assertEqual(['foo', 'bar'],
+                         [x.name for x in comp.iter_packages()])
+        # Both the sources and the (unchanged) pool copies are cache hits
+        self.assertEqual(4, cache.hits)
+        cache.close()
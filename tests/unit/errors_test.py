@@ -44,6 +44,7 @@ class ErrorTests(base.BaseTestCase):
                  TestData(errors.BinaryBuildError, u'Binary build error'),
                  TestData(errors.InvalidKeyError, u'Invalid key error'),
                  TestData(errors.KeyNotFoundError, u'Key not found error'),
+                 TestData(errors.VerificationError, u'Verification error'),
                  ]
         for td in tests:
             self.raise_error_check(td.err, td.msg)
@@ -20,6 +20,7 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 from collections import namedtuple
+from io import BytesIO
 
 from debpkgr import hasher
 
@@ -110,3 +111,26 @@ class HasherTests(base.BaseTestCase):
         _hashlib.algorithms = ["a", "b"]
         ho = hasher.Hasher(algorithms="md5")
         self.assertEqual(["a", "b"], ho._available_algorithms())
+
+    def test_hash_stream(self):
+        stream = hasher.HashStream(BytesIO(self.data.encode('utf-8')),
+                                   algorithms=self.algs)
+        self.assertEqual(b'Unchained', stream.read(9))
+        self.assertEqual(9, stream.size)
+        self.assertEqual(len(self.data), stream.drain(blocksize=4))
+        self.assertEqual(self.expected, stream.digests)
+        self.assertEqual(
+            dict(MD5sum=self.expected['md5'], SHA1=self.expected['sha1'],
+                 SHA256=self.expected['sha256']),
+            hasher.deb_hashes(stream.digests))
+
+    def test_hash_writer(self):
+        out = BytesIO()
+        writer = hasher.HashWriter(out, algorithms=self.algs)
+        for i in range(0, len(self.data), 7):
+            writer.write(self.data[i:i + 7].encode('utf-8'))
+        self.assertEqual(len(self.data), writer.size)
+        self.assertEqual(self.expected, writer.digests)
+        self.assertEqual(self.data.encode('utf-8'), out.getvalue())
+        writer.close()
+        self.assertTrue(writer.closed)
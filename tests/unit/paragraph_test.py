@@ -0,0 +1,145 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import gzip
+import io
+
+from debian import deb822
+
+from debpkgr import paragraph
+
+from tests import base
+
+# Odd but valid input: leading blank lines, CRLF, whitespace-only
+# separators, comments, repeated fields and a missing final newline
+PACKAGES = (
+    b'\n\n'
+    b'Package: foo\n'
+    b'Version: 1.0-1\n'
+    b'Architecture: amd64\n'
+    b'Depends:   libc6 (>= 2.17)  \n'
+    b'Description: the foo\n'
+    b' It does foo.\n'
+    b' .\n'
+    b' And more foo.  \n'
+    b'Filename: pool/main/f/foo/foo_1.0-1_amd64.deb\n'
+    b'SHA256: 0123\n'
+    b'\n'
+    b'# A comment\n'
+    b'Package: bar\r\n'
+    b'Version: 2.0\r\n'
+    b'Essential:\r\n'
+    b'Version: 2.1\r\n'
+    b'Conffiles:\n'
+    b' /etc/bar 0123\n'
+    b'# Another comment\n'
+    b' /etc/baz 4567\n'
+    b' \t\n'
+    b'\n'
+    b'Package: baz\n'
+    b'Description: caf\xc3\xa9\n'
+    b'Filename: pool/main/b/baz/baz_1_all.deb\n'
+    b'Version: 1'
+)
+
+
+class ParagraphTest(base.BaseTestCase):
+
+    def test_iter_paragraphs(self):
+        expected = list(deb822.Packages.iter_paragraphs(
+            io.BytesIO(PACKAGES), use_apt_pkg=False))
+        paras = list(paragraph.iter_paragraphs(PACKAGES))
+        self.assertEqual(3, len(paras))
+        self.assertEqual(expected, paras)
+        for exp, para in zip(expected, paras):
+            self.assertEqual(list(exp.keys()), list(para.keys()))
+            self.assertEqual(exp.dump(), para.dump())
+            out = io.BytesIO()
+            para.dump(out)
+            self.assertEqual(exp.dump().encode('utf-8'), out.getvalue())
+        self.assertEqual('2.1', paras[1]['version'])
+        self.assertEqual('café', paras[2]['Description'])
+        self.assertEqual(b'caf\xc3\xa9', paras[2].get_raw('description'))
+        self.assertTrue('essential' in paras[1])
+        self.assertFalse('Essential' in paras[0])
+        self.assertEqual(expected[0], paras[0].to_deb822())
+
+    def test_iter_paragraphs_fields(self):
+        fields = ['Package', 'Version', 'Filename', 'SHA256', 'Conffiles']
+        expected = list(deb822.Packages.iter_paragraphs(
+            io.BytesIO(PACKAGES), fields=fields, use_apt_pkg=False))
+        paras = list(paragraph.iter_paragraphs(PACKAGES, fields=fields))
+        self.assertEqual(expected, paras)
+        for exp, para in zip(expected, paras):
+            self.assertEqual(list(exp.keys()), list(para.keys()))
+            self.assertEqual(exp.dump(), para.dump())
+
+    def test_iter_paragraphs_file(self):
+        path = self.mkfile('Packages', contents=PACKAGES)
+        expected = list(paragraph.iter_paragraphs(PACKAGES))
+        # Mapped
+        with open(path, 'rb') as fh:
+            self.assertEqual(expected, list(paragraph.iter_paragraphs(fh)))
+        # Read
+        with open(path, 'r') as fh:
+            self.assertEqual(expected, list(paragraph.iter_paragraphs(fh)))
+        self.assertEqual([], list(paragraph.iter_paragraphs(
+            open(self.mkfile('empty', contents=b''), 'rb'))))
+
+    def test_iter_spans(self):
+        data = b'\nA: 1\n\n \nB: 2\nC: 3\n\n\n'
+        self.assertEqual(
+            [b'A: 1\n', b'B: 2\nC: 3\n'],
+            [data[x:y] for x, y in paragraph.iter_spans(data)])
+
+    def test_paragraph_index(self):
+        data = PACKAGES + b'\n\nPackage: foo\nVersion: 2.0\n'
+        path = self.mkfile('Packages', contents=data)
+        for mode in ['rb', 'r']:
+            with open(path, mode) as fh:
+                index = paragraph.ParagraphIndex(fh)
+            self.assertEqual(['foo', 'bar', 'baz'], list(index))
+            self.assertEqual(3, len(index))
+            self.assertTrue('bar' in index)
+            self.assertFalse('Package' in index)
+            for offset, length in index.offsets('foo'):
+                self.assertTrue(
+                    data[offset:offset + length].startswith(b'Package: foo'))
+            self.assertEqual(
+                ['1.0-1', '2.0'],
+                [x['Version'] for x in index.lookup('foo')])
+            self.assertEqual([{'Version': '2.1'}],
+                             index.lookup('bar', fields=['Version']))
+            self.assertEqual([], index.lookup('qux'))
+            index.close()
+            self.assertEqual([], index.lookup('foo'))
+
+    def test_iter_paragraphs_stream(self):
+        expected = list(paragraph.iter_paragraphs(PACKAGES))
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as gz:
+            gz.write(PACKAGES)
+        for blocksize in [1, 2, 7, 100, 1 << 20]:
+            buf.seek(0)
+            with base.mock.patch.object(paragraph, 'BLOCKSIZE', blocksize):
+                stream = gzip.GzipFile(fileobj=buf, mode='rb')
+                self.assertEqual(expected,
+                                 list(paragraph.iter_paragraphs(stream)))
@@ -0,0 +1,149 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import gzip
+import os
+import random
+
+from debpkgr import pdiff
+
+from tests import base
+
+
+def stanza(name, version):
+    return ('Package: %s\nVersion: %s\nDescription: %s\n continued\n' % (
+        name, version, name)).encode('ascii')
+
+
+def packages(stanzas):
+    return b'\n'.join(stanzas)
+
+
+class PDiffTest(base.BaseTestCase):
+
+    def test_diff(self):
+        old = packages([stanza('a', 1), stanza('b', 1), stanza('c', 1)])
+        new = packages([stanza('a', 1), stanza('b', 2), stanza('c', 1),
+                        stanza('d', 1)])
+        script = pdiff.diff(old, new)
+        # The last stanza of old has no trailing blank line, so it is
+        # replaced along with b
+        self.assertEqual(
+            b'6,14c\n' + packages([stanza('b', 2), stanza('c', 1),
+                                   stanza('d', 1)]) + b'.\n', script)
+        self.assertEqual(new, pdiff.apply_patch(old, script))
+
+        old += b'\n'
+        new = packages([stanza('a', 2), stanza('b', 1)]) + b'\n'
+        script = pdiff.diff(old, new)
+        # Commands come from the end of the file backwards
+        self.assertEqual(
+            b'11,15d\n1,5c\n' + stanza('a', 2) + b'\n.\n', script)
+        self.assertEqual(new, pdiff.apply_patch(old, script))
+        self.assertEqual(b'', pdiff.diff(old, old))
+
+    def test_diff_random(self):
+        rnd = random.Random(42)
+        for _ in range(50):
+            old = [stanza('p%d' % i, 1) for i in range(rnd.randint(0, 20))]
+            new = list(old)
+            for _ in range(rnd.randint(1, 6)):
+                op = rnd.choice(['add', 'del', 'change'])
+                pos = rnd.randint(0, len(new))
+                if op == 'add' or not new:
+                    new.insert(pos, stanza('n%d' % pos, 1))
+                elif op == 'del':
+                    del new[pos % len(new)]
+                else:
+                    new[pos % len(new)] = stanza('c%d' % pos, 2)
+            old, new = packages(old), packages(new)
+            self.assertEqual(new,
+                             pdiff.apply_patch(old, pdiff.diff(old, new)))
+
+    def test_index_roundtrip(self):
+        info = pdiff.file_info(b'foo')
+        index = pdiff.PDiffIndex(info, [
+            pdiff.PatchEntry('2020-01-01-0000.00', pdiff.file_info(b'a'),
+                             pdiff.file_info(b'b'), pdiff.file_info(b'c'))])
+        path = self.mkfile('Index', contents=index.dumps())
+        loaded = pdiff.PDiffIndex.load(path)
+        self.assertEqual(index.current, loaded.current)
+        self.assertEqual(index.history, loaded.history)
+        lines = index.dumps().decode('ascii').splitlines()
+        self.assertEqual('SHA256-Current: %s 3' % info.digests['sha256'],
+                         lines[1])
+        self.assertTrue(lines[-1].endswith(' 2020-01-01-0000.00.gz'))
+        self.assertEqual(None, pdiff.PDiffIndex.load(path + '.bogus').current)
+
+    def _update(self, path, old, new, max_history, now):
+        old_path = None
+        if old is not None:
+            old_path = self.mkfile('old', contents=old)
+        new_path = self.mkfile('new', contents=new)
+        return pdiff.update(path, old_path, new_path, max_history, now=now)
+
+    def test_update(self):
+        path = os.path.join(self.test_dir, 'Packages')
+        versions = [packages([stanza('a', i), stanza('b', 1)])
+                    for i in range(4)]
+        index_path = self._update(path, None, versions[0], 2, now=0)
+        self.assertEqual([], pdiff.PDiffIndex.load(index_path).history)
+        for i in range(1, 4):
+            self._update(path, versions[i - 1], versions[i], 2, now=i)
+        # Unchanged: no new patch
+        self._update(path, versions[3], versions[3], 2, now=5)
+
+        index = pdiff.PDiffIndex.load(index_path)
+        self.assertEqual(pdiff.file_info(versions[3]), index.current)
+        self.assertEqual(['1970-01-01-0000.02', '1970-01-01-0000.03'],
+                         [x.name for x in index.history])
+        self.assertEqual(
+            sorted(['Index', '1970-01-01-0000.02.gz',
+                    '1970-01-01-0000.03.gz']),
+            sorted(os.listdir(path + '.diff')))
+        # Apply the whole chain, as a client would
+        data = versions[1]
+        for entry in index.history:
+            self.assertEqual(pdiff.file_info(data), entry.history)
+            with gzip.open(os.path.join(path + '.diff',
+                                        entry.name + '.gz')) as fh:
+                script = fh.read()
+            self.assertEqual(entry.patch, pdiff.file_info(script))
+            data = pdiff.apply_patch(data, script)
+        self.assertEqual(versions[3], data)
+
+    def test_update_empty(self):
+        path = os.path.join(self.test_dir, 'Packages')
+        new = packages([stanza('a', 1)])
+        index_path = self._update(path, b'', new, 2, now=0)
+        entry, = pdiff.PDiffIndex.load(index_path).history
+        with gzip.open(os.path.join(path + '.diff', entry.name + '.gz')) as fh:
+            self.assertEqual(new, pdiff.apply_patch(b'', fh.read()))
+
+    def test_update_broken_chain(self):
+        path = os.path.join(self.test_dir, 'Packages')
+        self._update(path, None, b'a\n', 5, now=0)
+        self._update(path, b'a\n', b'b\n', 5, now=1)
+        # Not the current version any more
+        index_path = self._update(path, b'c\n', b'd\n', 5, now=2)
+        index = pdiff.PDiffIndex.load(index_path)
+        self.assertEqual(['1970-01-01-0000.02'],
+                         [x.name for x in index.history])
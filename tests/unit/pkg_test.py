@@ -21,12 +21,14 @@ from __future__ import print_function
 # python-debian expects py2 strings or py3 strings, not py2 unicode
 
 from collections import namedtuple
+from io import BytesIO
 from debian import deb822
 from debian import debfile
 from debpkgr.debpkg import DebPkg
 from debpkgr.debpkg import DebPkgFiles
 from debpkgr.debpkg import DebPkgMD5sums
 from debpkgr.debpkg import DebPkgRequires
+from debpkgr.debpkg import PackageSortKey
 from tests import base
 
 
@@ -481,3 +483,83 @@ SHA256: d80568c932f54997713bb7832c6da6aa04992919f3d0f47afb6ba600a7586780
         "Verify that __str__ returns a string, and not unicode in python2"
         obj = ({'a': 'a'})
         self.assertTrue(isinstance(obj.__str__(), str))
+
+    def test_pkg_lazy_fields(self):
+        raw_md5sums = (b'9e2d1b5db1f1fb50621a48538d570ee8  '
+                       b'usr/share/doc/foo/changelog.Debian.gz\n'
+                       b'a664cb0d199e56bb5691d8ae29ca759a  '
+                       b'usr/share/doc/foo/copyright\n')
+        control_data = dict(self.control_data, Depends=u'bar (>= 1.0)')
+        pkg = DebPkg(control_data, self.md5sum_data, raw_md5sums,
+                     scripts=dict(postinst=b'#!/bin/sh\n'))
+        self.assertEqual(self.package_obj['Package'], pkg.package['Package'])
+        # Nothing but control and hashes is needed to dump the package
+        for attr in ['_deps', '_version']:
+            self.assertEqual(None, getattr(pkg, attr))
+        self.assertEqual(raw_md5sums, pkg._md5)
+        self.assertEqual(raw_md5sums, pkg.to_primitive()['md5sums'])
+        # Comparing does not parse md5sums either
+        other = DebPkg(control_data, self.md5sum_data, raw_md5sums)
+        self.assertEqual(pkg, other)
+        self.assertEqual(raw_md5sums, pkg._md5)
+        self.assertEqual(raw_md5sums, other._md5)
+        other = DebPkg(control_data, self.md5sum_data,
+                       raw_md5sums.replace(b'9e2d', b'0e2d'))
+        self.assertNotEqual(pkg, other)
+
+        self.assertEqual(u'bar', pkg.depends[0][0]['name'])
+        self.assertEqual(u'0.0.1-1', pkg.full_version)
+        self.assertEqual(b'#!/bin/sh\n', pkg.scripts.postinst)
+        self.assertEqual(None, pkg.scripts.prerm)
+        self.assertEqual(
+            {u'usr/share/doc/foo/changelog.Debian.gz':
+             u'9e2d1b5db1f1fb50621a48538d570ee8',
+             u'usr/share/doc/foo/copyright':
+             u'a664cb0d199e56bb5691d8ae29ca759a'},
+            dict(pkg.md5sums))
+        self.assertTrue(isinstance(pkg.md5sums, DebPkgMD5sums))
+
+    def test_pkg_stanza_cache(self):
+        pkg = DebPkg(self.control_data, self.md5sum_data, None)
+
+        def dumped():
+            buf = BytesIO()
+            pkg.dump(buf)
+            return buf.getvalue()
+
+        self.assertEqual(pkg.package.dump().encode('utf-8'), dumped())
+        with base.mock.patch.object(DebPkg, 'package') as _package:
+            dumped()
+        self.assertEqual(0, len(_package.mock_calls))
+
+        pkg.relative_path = 'pool/main/foo.deb'
+        self.assertIn(b'\nFilename: pool/main/foo.deb\n', dumped())
+        pkg.control['Priority'] = 'optional'
+        self.assertIn(b'\nPriority: optional\n', dumped())
+        pkg.hashes['SHA256'] = 'abc'
+        self.assertIn(b'\nSHA256: abc\n', dumped())
+        self.assertEqual(pkg.package.dump(), pkg.dump())
+
+        pkg.update(control={'Priority': 'extra'}, hashes={'SHA256': 'def'})
+        self.assertIn(b'\nPriority: extra\n', dumped())
+        self.assertIn(b'\nSHA256: def\n', dumped())
+
+    def test_pkg_sort_key(self):
+        keys = [PackageSortKey('foo', '1.0', 'amd64'),
+                PackageSortKey('bar', '2.0', 'amd64'),
+                PackageSortKey('foo', '1.0~rc1', 'amd64'),
+                PackageSortKey('foo', '1.0', 'all'),
+                PackageSortKey('foo', '1:0.1', 'amd64')]
+        self.assertEqual(
+            [('bar', '2.0', 'amd64'), ('foo', '1.0~rc1', 'amd64'),
+             ('foo', '1.0', 'all'), ('foo', '1.0', 'amd64'),
+             ('foo', '1:0.1', 'amd64')],
+            [(x.name, x.version, x.arch) for x in sorted(keys)])
+        self.assertEqual(PackageSortKey('foo', '1.0', 'amd64'),
+                         PackageSortKey('foo', '1.0-0', 'amd64'))
+
+    def test_pkg_md5sums_latin1(self):
+        pkg = DebPkg(self.control_data, self.md5sum_data,
+                     b'9e2d1b5db1f1fb50621a48538d570ee8  caf\xe9\n')
+        self.assertEqual('iso-8859-1', pkg.md5sums.encoding)
+        self.assertEqual([u'caf\xe9'], list(pkg.md5sums.keys()))
@@ -159,6 +159,28 @@ class RepoTest(base.BaseTestCase):
             "Architecture BOGUS not defined (expected: amd64, i386, aarch64)",
             str(ctx.exception))
 
+    def test_package_relative_path(self):
+        repo_meta = AptRepoMeta(**self.defaults)
+        comp = repo_meta.get_component_arch_binary('main', 'amd64')
+        pkg = base.mock.MagicMock(filename='libfoo1_1.0_amd64.deb',
+                                  source='libfoo', sha256='ab' + 'c' * 62)
+        tests = [
+            (None, 'pool/main/libfoo1_1.0_amd64.deb'),
+            ('flat', 'pool/main/libfoo1_1.0_amd64.deb'),
+            ('sharded', 'pool/main/libf/libfoo/libfoo1_1.0_amd64.deb'),
+            ('content', os.path.join('pool/sha256/ab', pkg.sha256,
+                                     'libfoo1_1.0_amd64.deb')),
+        ]
+        for layout, expected in tests:
+            self.assertEqual(expected,
+                             comp.package_relative_path(pkg, layout=layout))
+        pkg.source = 'foo'
+        self.assertEqual('pool/main/f/foo/libfoo1_1.0_amd64.deb',
+                         comp.package_relative_path(pkg, layout='sharded'))
+        with self.assertRaises(ValueError) as ctx:
+            comp.package_relative_path(pkg, layout='BOGUS')
+        self.assertEqual("Unknown pool layout 'BOGUS'", str(ctx.exception))
+
     @base.mock.patch("debpkgr.aptrepo.time.strftime")
     def test_metadata(self, _strftime):
         _strftime.return_value = "ABCDE"
@@ -373,7 +395,9 @@ class RepoTest(base.BaseTestCase):
         self.assertEqual(aptrepo, repo)
 
         _AptRepo.assert_called_once_with(self.new_repo_dir,
-                                         metadata=_AptRepoMeta.return_value)
+                                         metadata=_AptRepoMeta.return_value,
+                                         ingest_cache=None,
+                                         pool_layout=None)
         _AptRepoMeta.asset_called_once_with(origin=origin,
                                             label=origin,
                                             codename=self.name,
@@ -389,7 +413,8 @@ class RepoTest(base.BaseTestCase):
         upstream = base.mock.MagicMock()
         parse_repo(self.new_repo_dir, upstream, codename='stable')
         _parse.assert_called_once_with(self.new_repo_dir,
-                                       upstream, codename='stable')
+                                       upstream, codename='stable',
+                                       keep_compressed=False)
 
     def test_apt_repo_bad_signing_options(self):
         meta = AptRepoMeta(codename=self.name)
@@ -0,0 +1,65 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import random
+from io import BytesIO
+
+from debpkgr.spool import StanzaSpool
+
+from tests import base
+
+
+class StanzaSpoolTest(base.BaseTestCase):
+
+    def test_insertion_order(self):
+        spool = StanzaSpool(directory=self.test_dir)
+        stanzas = [('Package: p%d\n' % i).encode('ascii') for i in range(10)]
+        for stanza in stanzas:
+            spool.add(stanza)
+        self.assertEqual(10, len(spool))
+        self.assertEqual(1, len(spool.runs))
+        # Can be iterated more than once
+        for _ in range(2):
+            self.assertEqual(stanzas, [x.stanza for x in spool])
+        buf = BytesIO()
+        next(iter(spool)).dump(buf)
+        self.assertEqual(stanzas[0], buf.getvalue())
+        directory = spool.directory
+        spool.close()
+        self.assertFalse(os.path.exists(directory))
+
+    def test_sorted_runs(self):
+        spool = StanzaSpool(directory=self.test_dir, run_size=7)
+        rnd = random.Random(0)
+        keys = [(rnd.choice('abcde'), rnd.randint(0, 5)) for _ in range(50)]
+        for i, key in enumerate(keys):
+            spool.add(('%s %d %d\n' % (key + (i, ))).encode('ascii'),
+                      key=key)
+        # The last 1 stanza is only written out when iterating
+        self.assertEqual(7, len(spool.runs))
+        # Stable: equal keys keep the order they were added in
+        expected = [('%s %d %d\n' % (key + (i, ))).encode('ascii')
+                    for i, key in sorted(enumerate(keys),
+                                         key=lambda x: x[1])]
+        self.assertEqual(expected, [x.stanza for x in spool])
+        self.assertEqual(8, len(spool.runs))
+        spool.close()
@@ -19,10 +19,16 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import errno
+import io
 import os
+import threading
+import time
 from collections import namedtuple
 
 from debpkgr import utils
+from debpkgr.errors import VerificationError
+from debpkgr.hasher import hash_string
 
 from tests import base
 
@@ -65,3 +71,250 @@ class UtilsTests(base.BaseTestCase):
                          u"DAVE_GIVE_ME_A_BREAK")]
         for td in tests:
             self.assertEqual(td.expected, utils.normenvname(td.data))
+
+    def test_atomic_file(self):
+        path = os.path.join(self.mkdir('atomic-dir'), 'atomic')
+        with utils.AtomicFile(path) as fobj:
+            fobj.write(b'data')
+            self.assertFalse(os.path.exists(path))
+            self.assertTrue(os.path.exists(fobj.name))
+        self.assertEqual(b'data', open(path, 'rb').read())
+        self.assertEqual(0o644, os.stat(path).st_mode & 0o777)
+        self.assertEqual(['atomic'], os.listdir(os.path.dirname(path)))
+
+        with self.assertRaises(ValueError):
+            with utils.AtomicFile(path) as fobj:
+                fobj.write(b'partial')
+                raise ValueError()
+        self.assertEqual(b'data', open(path, 'rb').read())
+        self.assertEqual(['atomic'], os.listdir(os.path.dirname(path)))
+
+        other = os.path.join(os.path.dirname(path), 'other')
+        with utils.AtomicFile(path) as fobj:
+            fobj.write(b'other')
+            self.assertEqual(other, fobj.commit(other))
+        self.assertEqual(b'other', open(other, 'rb').read())
+        self.assertEqual(b'data', open(path, 'rb').read())
+
+    def test_place_file(self):
+        src = self.mkfile('src', contents=b'data' * 1000)
+        dst_dir = self.mkdir('placed')
+        for strategy in ['copy', 'kernel', 'reflink', 'hardlink', 'auto',
+                         'symlink']:
+            dst = os.path.join(dst_dir, strategy)
+            # Existing destinations are replaced
+            self.mkfile(dst, contents=b'old')
+            used = utils.place_file(src, dst, strategy=strategy)
+            self.assertEqual(b'data' * 1000, open(dst, 'rb').read())
+            if strategy in ('hardlink', 'auto'):
+                self.assertEqual('hardlink', used)
+                self.assertTrue(os.path.samefile(src, dst))
+            elif strategy == 'symlink':
+                self.assertEqual(src, os.readlink(dst))
+            else:
+                self.assertFalse(os.path.samefile(src, dst))
+        self.assertEqual(sorted(['copy', 'kernel', 'reflink', 'hardlink',
+                                 'auto', 'symlink']),
+                         sorted(os.listdir(dst_dir)))
+
+        with self.assertRaises(ValueError) as ctx:
+            utils.place_file(src, dst, strategy='teleport')
+        self.assertTrue(str(ctx.exception).startswith(
+            'Unknown placement strategy teleport'))
+
+    def test_place_file_over_hardlink(self):
+        src = self.mkfile('src', contents=b'data')
+        other = self.mkfile('other', contents=b'other')
+        dst = os.path.join(self.test_dir, 'dst')
+        for strategy in ['copy', 'kernel', 'reflink', 'hardlink']:
+            utils.place_file(src, dst, strategy='hardlink')
+            # dst is the same file as src: replacing it must not write
+            # through the link
+            utils.place_file(other, dst, strategy=strategy)
+            self.assertEqual(b'other', open(dst, 'rb').read())
+            self.assertEqual(b'data', open(src, 'rb').read())
+        # No temporary files are left behind
+        self.assertEqual([], [x for x in os.listdir(self.test_dir)
+                              if x.startswith('.')])
+
+    @base.mock.patch("debpkgr.utils.os.link")
+    def test_place_file_fallback(self, _link):
+        _link.side_effect = OSError(errno.EXDEV, "Cross-device link")
+        src = self.mkfile('src', contents=b'data' * 1000)
+        dst = os.path.join(self.test_dir, 'dst')
+        with base.mock.patch("debpkgr.utils.fcntl") as _fcntl:
+            _fcntl.ioctl.side_effect = IOError(errno.EOPNOTSUPP, "No")
+            self.assertIn(utils.place_file(src, dst, strategy='hardlink'),
+                          ['kernel', 'copy'])
+            self.assertEqual(1, _fcntl.ioctl.call_count)
+        self.assertEqual(b'data' * 1000, open(dst, 'rb').read())
+        self.assertEqual(1, _link.call_count)
+
+        _kcopy = base.mock.MagicMock(side_effect=OSError(errno.ENOSYS, "No"))
+        chain = [('kernel', _kcopy), utils._Placement_Chain[-1]]
+        with base.mock.patch.object(utils, '_Placement_Chain', chain):
+            self.assertEqual(
+                'copy', utils.place_file(src, dst, strategy='kernel'))
+        _kcopy.assert_called_once_with(src, dst)
+        self.assertEqual(b'data' * 1000, open(dst, 'rb').read())
+
+    def test_kernel_copy_file(self):
+        src = self.mkfile('src', contents=b'0123456789' * 100000)
+        os.chmod(src, 0o640)
+        dst = os.path.join(self.test_dir, 'dst')
+        utils.kernel_copy_file(src, dst)
+        self.assertEqual(open(src, 'rb').read(), open(dst, 'rb').read())
+        self.assertEqual(0o640, os.stat(dst).st_mode & 0o777)
+
+    def test_kernel_copy_file_short(self):
+        src = self.mkfile('src', contents=b'0123456789' * 1000)
+        dst = os.path.join(self.test_dir, 'dst')
+
+        def copy_file_range(infd, outfd, count, offset):
+            return 0 if offset else os.write(outfd, b'0123')
+
+        def sendfile(outfd, infd, offset, count):
+            return 0
+
+        with base.mock.patch.object(utils.os, 'copy_file_range',
+                                    copy_file_range, create=True), \
+                base.mock.patch.object(utils.os, 'sendfile', sendfile,
+                                       create=True):
+            with self.assertRaises(OSError) as ctx:
+                utils.kernel_copy_file(src, dst)
+            self.assertEqual(errno.EIO, ctx.exception.errno)
+            self.assertFalse(os.path.exists(dst))
+            # The plain copy takes over
+            self.assertEqual(
+                'copy', utils.place_file(src, dst, strategy='kernel'))
+        self.assertEqual(open(src, 'rb').read(), open(dst, 'rb').read())
+
+    def test_fetch(self):
+        data = b'0123456789' * 10000
+        src = self.mkfile('src', contents=data)
+        sha256 = hash_string(data, algs=['sha256'])['sha256']
+        dst = os.path.join(self.test_dir, 'dst')
+        self.assertEqual(len(data), utils.fetch(
+            src, dst, size=len(data), checksum=('sha256', sha256)))
+        self.assertEqual(data, open(dst, 'rb').read())
+        os.unlink(dst)
+
+        tests = [
+            (dict(size=len(data) + 1), "size is %d, expected %d" % (
+                len(data), len(data) + 1)),
+            (dict(checksum=('sha256', '0' * 64)),
+             "sha256 checksum did not match"),
+        ]
+        for kwargs, msg in tests:
+            with self.assertRaises(VerificationError) as ctx:
+                utils.fetch(src, dst, **kwargs)
+            self.assertTrue(str(ctx.exception).endswith(msg))
+            # Nothing is left behind
+            self.assertFalse(os.path.exists(dst))
+            self.assertEqual([], [x for x in os.listdir(self.test_dir)
+                                  if x.startswith('.dst')])
+
+        fobj = io.BytesIO()
+        utils.fetch('file://' + src, fobj)
+        self.assertEqual(data, fobj.getvalue())
+
+    @base.mock.patch("debpkgr.utils.urlopen")
+    def test_fetch_aborts_early(self, _urlopen):
+        # No Content-Length, and more data than expected
+        response = _urlopen.return_value
+        response.info.return_value = dict()
+        response.read.side_effect = [b'x' * 10] * 100 + [b'']
+        fobj = io.BytesIO()
+        with base.mock.patch.object(utils, 'DOWNLOAD_BLOCKSIZE', 10):
+            with self.assertRaises(VerificationError) as ctx:
+                utils.fetch('http://example.com/Packages', fobj, size=25)
+        self.assertEqual(
+            "http://example.com/Packages: more than the expected 25 bytes",
+            str(ctx.exception))
+        self.assertEqual(3, response.read.call_count)
+        self.assertEqual(20, len(fobj.getvalue()))
+        response.close.assert_called_once_with()
+
+        response.read.side_effect = [b'x' * 10, b'']
+        with self.assertRaises(VerificationError) as ctx:
+            utils.fetch('http://example.com/Packages', fobj, size=25)
+        self.assertEqual(
+            "http://example.com/Packages: got 10 bytes, expected 25",
+            str(ctx.exception))
+
+    def test_download(self):
+        data = b'Package: foo\n'
+        src = self.mkfile('Packages', contents=data)
+        digests = hash_string(data, algs=['sha256', 'md5'])
+        dst = os.path.join(self.test_dir, 'dst')
+        reqs = [
+            utils.DownloadRequest(src, dst + '1', dict(
+                size=str(len(data)), sha256=digests['sha256'])),
+            utils.DownloadRequest(src, dst + '2', dict(
+                md5sum=digests['md5'])),
+            utils.DownloadRequest(src, dst + '3', None),
+        ]
+        utils.download(reqs)
+        self.assertTrue(reqs[0].data['verified'])
+        self.assertTrue(reqs[1].data['verified'])
+        for i in range(3):
+            self.assertEqual(data, open(dst + str(i + 1), 'rb').read())
+
+        reqs = [utils.DownloadRequest(src, dst + '4', dict(
+            sha256=digests['md5']))]
+        with self.assertRaises(VerificationError):
+            utils.download(reqs)
+        self.assertFalse('verified' in reqs[0].data)
+
+    def test_downloader(self):
+        src = self.mkfile('src', contents=b'data')
+        dst = os.path.join(self.test_dir, 'dst')
+        reqs = [
+            utils.DownloadRequest(src, dst + '1', None),
+            utils.DownloadRequest(src + '-missing', dst + '2', None),
+            utils.DownloadRequest(src, dst + '3', dict(size='5')),
+            utils.DownloadRequest(src, dst + '4', dict(size='4')),
+        ]
+        for workers in [1, 3]:
+            results = utils.Downloader(workers=workers).download(reqs)
+            self.assertEqual(reqs, [x.request for x in results])
+            self.assertEqual(None, results[0].error)
+            self.assertTrue(isinstance(results[1].error, IOError))
+            self.assertTrue(isinstance(results[2].error, VerificationError))
+            self.assertEqual(None, results[3].error)
+            self.assertTrue(reqs[3].data['verified'])
+            for i in [1, 4]:
+                self.assertEqual(b'data', open(dst + str(i), 'rb').read())
+            with self.assertRaises(IOError):
+                utils.check_downloads(results)
+
+        # download() attempts everything, then raises
+        os.unlink(dst + '4')
+        with self.assertRaises(IOError):
+            utils.download(reqs, workers=2)
+        self.assertTrue(os.path.exists(dst + '4'))
+
+    def test_downloader_per_host(self):
+        lock = threading.Lock()
+        active = dict()
+        peaks = dict()
+
+        def fetch(url, destination, size=None, checksum=None, pool=None):
+            host = url.split('/')[2]
+            with lock:
+                active[host] = active.get(host, 0) + 1
+                active['all'] = active.get('all', 0) + 1
+                for key in [host, 'all']:
+                    peaks[key] = max(peaks.get(key, 0), active[key])
+            time.sleep(0.01)
+            with lock:
+                active[host] -= 1
+                active['all'] -= 1
+
+        reqs = [utils.DownloadRequest('http://%s/%d' % (host, i), None, None)
+                for i in range(10) for host in ['a', 'b', 'c']]
+        with base.mock.patch.object(utils, 'fetch', fetch):
+            results = utils.Downloader(workers=5, per_host=2).download(reqs)
+        self.assertEqual([None] * 30, [x.error for x in results])
+        self.assertEqual(2, max(peaks[x] for x in 'abc'))
+        self.assertTrue(peaks['all'] <= 5)